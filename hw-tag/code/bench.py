@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Speed benchmarks for the taggers.  For each kind of model and each training
+corpus of the scaling ladder (ensup-tiny, ensup4k, ensup10k, ensup25k, ensup,
+and Czech czsup), measures the throughput in tokens/sec of the forward and
+backward trellises, the E step, and Viterbi and posterior decoding, along with
+the wall time of an EM epoch on the untagged corpus (HMMs) or of an evaluation
+interval (CRF).
+It also measures how much time the runtime type checks add to the methods
+that have them (see typechecking.py); --fast turns those checks off for all of
+the other measurements.  Finally, it measures the startup time of tag.py and
+the import times of the modules (as with python -X importtime), in fresh
+interpreters.
+
+The results are written as JSON.  Pass an earlier results file to --compare
+to flag regressions, e.g., between two commits.
+"""
+import argparse
+from datetime import datetime, timezone
+import json
+import logging
+import os
+from pathlib import Path
+import platform
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import torch
+from more_itertools import chunked
+
+from corpus import NO_TAG, Sentence, TaggedCorpus
+from hmm import HiddenMarkovModel, EnhancedHMM
+from crf import ConditionalRandomField
+from typechecking import FAST_ENV, is_fast, set_fast
+
+log = logging.getLogger(Path(__file__).stem)  # For usage, see findsim.py in earlier assignment.
+
+CORPORA = ["ensup-tiny", "ensup4k", "ensup10k", "ensup25k", "ensup", "czsup"]
+MODELS = {"hmm": HiddenMarkovModel, "crf": ConditionalRandomField, "enhanced": EnhancedHMM}
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument("--data", type=str, default=str(Path(__file__).parent.parent / "data"),
+                        help="directory holding the corpora")
+    parser.add_argument("--corpora", type=str, nargs="+", default=CORPORA, help="training corpora to benchmark on")
+    parser.add_argument("--models", type=str, nargs="+", default=list(MODELS), choices=list(MODELS),
+                        help="kinds of model to benchmark")
+    parser.add_argument("--max_sentences", type=int, default=2000,
+                        help="the throughput measurements use at most this many sentences of each corpus")
+    parser.add_argument("--batch_size", type=int, default=64, help="sentences per batch in the throughput measurements")
+    parser.add_argument("--eval_interval", type=int, default=2000,
+                        help="sentences in the timed CRF evaluation interval (tag.py's default)")
+    parser.add_argument("--repeat", type=int, default=1, help="report the best of this many runs of each measurement")
+    parser.add_argument("--fast", action="store_true", default=False,
+                        help="skip the runtime type checks (the type check overhead is measured either way)")
+    parser.add_argument("--overhead_sentences", type=int, default=200,
+                        help="sentences to call the type-checked methods on, one at a time, to measure their overhead")
+    parser.add_argument("--startup_repeat", type=int, default=5,
+                        help="report the best of this many fresh interpreters for each startup measurement")
+    parser.add_argument("-o", "--output", type=str, default=None, help="write the results here (default: stdout)")
+    parser.add_argument("--compare", type=str, default=None,
+                        help="earlier results file: report measurements that got worse than it")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative slowdown that counts as a regression with --compare")
+
+    # for verbosity of logging
+    parser.set_defaults(logging_level=logging.INFO)
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument(
+        "-v", "--verbose", dest="logging_level", action="store_const", const=logging.DEBUG
+    )
+    verbosity.add_argument(
+        "-q", "--quiet",   dest="logging_level", action="store_const", const=logging.WARNING
+    )
+
+    return parser.parse_args()
+
+def timed(function: Callable[[], Any], repeat: int) -> float:
+    """Best wall time of calling the function `repeat` times."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def untagged(corpus: TaggedCorpus) -> TaggedCorpus:
+    """A copy of the integerized corpus without its tags (except BOS_TAG and EOS_TAG),
+    sharing its words.  An EM epoch on the tagged corpus would only count the tags,
+    without running forward-backward (see HiddenMarkovModel._supervised_counts())."""
+    assert corpus.word_ids is not None and corpus.tag_ids is not None and corpus.offsets is not None
+    tag_ids = np.full_like(corpus.tag_ids, NO_TAG)
+    for ends in (corpus.offsets[:-1], corpus.offsets[1:] - 1):    # the BOS and EOS positions
+        tag_ids[ends] = corpus.tag_ids[ends]
+    copy = TaggedCorpus(tagset=corpus.tagset, vocab=corpus.vocab)   # no files to read
+    copy.word_ids, copy.tag_ids, copy.offsets = corpus.word_ids, tag_ids, corpus.offsets
+    return copy
+
+def bench_model(kind: str, name: str, corpus: TaggedCorpus, args: argparse.Namespace) -> Dict[str, Any]:
+    """Benchmark one kind of model on one (integerized) training corpus."""
+    torch.manual_seed(1337)
+    model = MODELS[kind](corpus.tagset, corpus.vocab)
+    result: Dict[str, Any] = {"model": kind, "corpus": name, "sentences": len(corpus),
+                              "tokens": corpus.num_tokens() - len(corpus),    # not counting EOS
+                              "tags": len(corpus.tagset), "vocab": len(corpus.vocab)}
+
+    # Training first, so that decoding uses trained parameters.
+    # (The loss is free, so only the training itself is timed.)
+    quiet = lambda model: 0.0
+    raw_corpus = untagged(corpus)
+    if isinstance(model, ConditionalRandomField):
+        result["crf_interval_sentences"] = args.eval_interval
+        result["crf_interval_s"] = round(timed(lambda: model.train(corpus, loss=quiet, minibatch_size=30, lr=0.05, reg=1.0,
+                                                                   eval_interval=args.eval_interval,
+                                                                   max_steps=args.eval_interval, save_path=None),
+                                               args.repeat), 4)
+    else:
+        # An untimed epoch on the tagged corpus first, to start EM from sensible parameters
+        # (and so that the EnhancedHMM learns its tag constraints, without which it can't do EM).
+        model.train(corpus, loss=quiet, λ=1.0, max_steps=1, save_path=None)
+        result["em_epoch_s"] = round(timed(lambda: model.train(raw_corpus, loss=quiet, λ=1.0, max_steps=1, save_path=None),
+                                           args.repeat), 4)
+
+    # The throughput measurements use the first max_sentences sentences, untagged
+    # (fully tagged sentences would skip the trellises).
+    n = min(len(corpus), args.max_sentences)
+    raw = [raw_corpus.integerized_sentence(i) for i in range(n)]
+    sentences = [sentence.desupervise() for sentence, _ in zip(corpus, range(n))]
+    tokens = sum(len(isent) - 2 for isent in raw)
+    result["sample_sentences"] = n
+    result["sample_tokens"] = tokens
+    batches = list(chunked(raw, args.batch_size))
+    sentence_batches: List[List[Sentence]] = list(chunked(sentences, args.batch_size))
+
+    def throughput(function: Callable[[], Any]) -> float:
+        function()   # warm up (and compute log A and log B)
+        return round(tokens / timed(function, args.repeat), 1)
+
+    with torch.no_grad():
+        padded = [model._pad_batch(batch) for batch in batches]
+        emits = [(model._emissions(word_ids), lengths) for word_ids, _, lengths in padded]
+        result["forward_tokens_per_s"] = throughput(lambda: [model._forward_trellis(emit, lengths) for emit, lengths in emits])
+        result["backward_tokens_per_s"] = throughput(lambda: [model._backward_trellis(emit, lengths) for emit, lengths in emits])
+
+        def E_step() -> None:
+            model._zero_counts()
+            for batch in batches:
+                model.E_step_batch(batch)
+        result["e_step_tokens_per_s"] = throughput(E_step)
+
+        if isinstance(model, ConditionalRandomField):
+            supervised = [corpus.integerized_sentence(i) for i in range(n)]
+            def gradient() -> None:
+                model._zero_grad()
+                for batch in chunked(supervised, args.batch_size):
+                    model.logprob_gradient_batch(batch)
+            result["gradient_tokens_per_s"] = throughput(gradient)
+
+        result["viterbi_tokens_per_s"] = throughput(
+            lambda: [model.viterbi_tagging_batch(batch, corpus) for batch in sentence_batches])
+        result["posterior_tokens_per_s"] = throughput(
+            lambda: [model.posterior_tagging_batch(batch, corpus) for batch in sentence_batches])
+
+        result.update(typecheck_overhead(model, corpus, sentences[:args.overhead_sentences], args.repeat))
+    return result
+
+def typecheck_overhead(model: HiddenMarkovModel, corpus: TaggedCorpus, sentences: List[Sentence],
+                       repeat: int) -> Dict[str, float]:
+    """Time calls of the type-checked methods, one sentence at a time (which is
+    where the checks cost the most), with and without the checks."""
+    def calls() -> None:
+        # (look the methods up on each call, since set_fast() replaces them)
+        decode = model.decode if isinstance(model, EnhancedHMM) else model.posterior_tagging
+        for sentence in sentences:
+            model.logprob(sentence, corpus)
+            decode(sentence, corpus)
+
+    fast = is_fast()
+    seconds = {}
+    try:
+        for checks in (True, False):
+            set_fast(not checks)
+            calls()    # warm up
+            seconds[checks] = timed(calls, repeat)
+    finally:
+        set_fast(fast)
+    return {"checked_calls_per_s": round(2 * len(sentences) / seconds[True], 1),
+            "unchecked_calls_per_s": round(2 * len(sentences) / seconds[False], 1),
+            "typecheck_overhead": round(seconds[True] / seconds[False] - 1, 3)}   # fraction of the unchecked time
+
+def import_time(module: str, fast: bool = False) -> float:
+    """Cumulative time in seconds to import the module into a fresh interpreter,
+    according to python -X importtime."""
+    env = dict(os.environ, **{FAST_ENV: "1" if fast else "0"})
+    report = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], env=env,
+                            cwd=Path(__file__).parent, capture_output=True, text=True, check=True).stderr
+    for line in report.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1e6
+    raise ValueError(f"python -X importtime didn't report importing {module}")
+
+def bench_startup(repeat: int) -> Dict[str, float]:
+    """Startup time of tag.py (its --help needs no models), and import times of
+    the modules that a tagging job loads.  hmm is also imported in fast mode,
+    which skips instrumenting its methods for type checking."""
+    tag = Path(__file__).parent / "tag.py"
+    help = lambda: subprocess.run([sys.executable, str(tag), "--help"], capture_output=True, check=True)
+    help()    # warm up (e.g., compile the bytecode)
+    result = {"tag_help_s": round(timed(help, repeat), 4)}
+    for module, fast in (("tag", False), ("torch", False), ("hmm", False), ("hmm", True), ("crf", False)):
+        import_time(module, fast)
+        result[f"import_{module}{'_fast' if fast else ''}_s"] = round(min(import_time(module, fast)
+                                                                           for _ in range(repeat)), 4)
+    return result
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> int:
+    """Log each measurement that got worse than the baseline by more than the
+    threshold (a relative change), and return how many did."""
+    old = {(r["model"], r["corpus"]): r for r in baseline["results"]}
+    regressions = 0
+    for new in results["results"]:
+        before = old.get((new["model"], new["corpus"]))
+        if before is not None:
+            regressions += _regressions(f"{new['model']} on {new['corpus']}", new, before, threshold)
+    if "startup" in results and "startup" in baseline:
+        regressions += _regressions("startup", results["startup"], baseline["startup"], threshold)
+    log.info(f"{regressions} regressions compared to {baseline['meta'].get('commit')}")
+    return regressions
+
+def _regressions(what: str, new: Dict[str, Any], before: Dict[str, Any], threshold: float) -> int:
+    """Log and count the measurements of one benchmark that got worse."""
+    regressions = 0
+    for key, value in new.items():
+        if key not in before or not isinstance(value, float):
+            continue
+        if key.endswith("_per_s"):
+            change = before[key] / value - 1 if value else float("inf")    # slowdown of a throughput
+        elif key.endswith("_s"):
+            change = value / before[key] - 1 if before[key] else 0.0       # slowdown of a time
+        else:
+            continue
+        if change > threshold:
+            regressions += 1
+            log.warning(f"REGRESSION {what}: {key} {before[key]} -> {value} ({100 * change:.0f}% slower)")
+    return regressions
+
+def main() -> None:
+    args = parse_args()
+    logging.root.setLevel(args.logging_level)
+    logging.basicConfig(level=args.logging_level)
+    logging.getLogger("hmm").setLevel(max(args.logging_level, logging.WARNING))   # training is chatty
+    logging.getLogger("crf").setLevel(max(args.logging_level, logging.WARNING))
+    logging.getLogger("corpus").setLevel(max(args.logging_level, logging.WARNING))
+    if args.fast:
+        set_fast(True)
+
+    results: Dict[str, Any] = {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "threads": torch.get_num_threads(),
+            "machine": platform.machine(),
+            "typechecks": not is_fast(),
+            "args": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "logging_level")},
+        },
+        "results": [],
+    }
+    for name in args.corpora:
+        corpus = TaggedCorpus(Path(args.data) / name, integerized=True)
+        for kind in args.models:
+            log.info(f"Benchmarking {kind} on {name}")
+            result = bench_model(kind, name, corpus, args)
+            log.info(json.dumps(result))
+            results["results"].append(result)
+
+    log.info("Benchmarking startup")
+    results["startup"] = bench_startup(args.startup_repeat)
+    log.info(json.dumps(results["startup"]))
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text())
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Command-line interface for converting tagged or untagged text files (like ensup
+or enraw) into the binary corpus format, which tag.py can memory-map instead of
+parsing the text.
+"""
+import argparse
+import logging
+from pathlib import Path
+
+from corpus import TaggedCorpus
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("files", type=str, nargs="+", help="text files to convert, in the usual one-sentence-per-line format")
+
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        required=True,
+        help="where to write the binary corpus"
+    )
+
+    parser.add_argument(
+        "--vocab_from",
+        type=str,
+        default=None,
+        help="binary corpus whose tagset and vocab should be reused (e.g., to convert a dev set "
+             "consistently with its training set); otherwise they are derived from the files"
+    )
+
+    parser.add_argument(
+        "--vocab_threshold",
+        type=int,
+        default=1,
+        help="words must appear at least this many times to be in the vocab (ignored with --vocab_from)"
+    )
+
+    # for verbosity of logging
+    parser.set_defaults(logging_level=logging.INFO)
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument(
+        "-v", "--verbose", dest="logging_level", action="store_const", const=logging.DEBUG
+    )
+    verbosity.add_argument(
+        "-q", "--quiet",   dest="logging_level", action="store_const", const=logging.WARNING
+    )
+
+    return parser.parse_args()
+
+def main() -> None:
+    args = parse_args()
+    logging.root.setLevel(args.logging_level)
+    logging.basicConfig(level=args.logging_level)
+
+    files = [Path(f) for f in args.files]
+    if args.vocab_from:
+        parent = TaggedCorpus.load_binary(Path(args.vocab_from))
+        corpus = TaggedCorpus(*files, tagset=parent.tagset, vocab=parent.vocab)
+    else:
+        corpus = TaggedCorpus(*files, vocab_threshold=args.vocab_threshold)
+    corpus.save_binary(Path(args.output))
+
+if __name__ == "__main__":
+    main()
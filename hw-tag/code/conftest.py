@@ -0,0 +1,6 @@
+# Configuration for pytest.
+#
+# test_en.py and test_ic.py are scripts to run by hand (they train models on
+# the data in ../data), not pytest tests, so pytest shouldn't import them.
+
+collect_ignore = ["test_en.py", "test_ic.py"]
@@ -13,10 +13,15 @@
 # with a higher weight or sampled more often, so that they are more
 # important in the objective.
 
+from __future__ import annotations
+from array import array
+import copy
+import json
 import logging
 from pathlib import Path
 ##### TYPE DEFINITIONS (USED FOR TYPE ANNOTATIONS)
 from typing import Counter, Iterable, Iterator, List, NewType, Optional, Tuple
+import numpy as np
 from more_itertools import peekable
 from integerize import Integerizer
 
@@ -29,6 +34,9 @@ TWord = Tuple[Word, Optional[Tag]]   # a (word, tag) pair where the tag might be
 IntegerizedTWord = Tuple[int, Optional[int]]
 IntegerizedSentence = List[IntegerizedTWord]
 
+# Stands for a missing tag (None) in the integer arrays of an integerized corpus.
+NO_TAG: int = -1
+
 # Special words and tags
 OOV_WORD: Word = Word("_OOV_")
 BOS_WORD: Word = Word("_BOS_WORD_")
@@ -36,6 +44,14 @@ EOS_WORD: Word = Word("_EOS_WORD_")
 BOS_TAG: Tag = Tag("_BOS_TAG_")
 EOS_TAG: Tag = Tag("_EOS_TAG_")
 
+# Strings read back from a file are new objects, not the constants above, so
+# an `is` comparison with a constant would miss them.  Pass them through here.
+_SPECIALS = {s: s for s in (OOV_WORD, BOS_WORD, EOS_WORD, BOS_TAG, EOS_TAG)}
+
+def with_specials(strings: Iterable[str]) -> List[str]:
+    """The given strings, with any copies of the special words and tags replaced by the constants."""
+    return [_SPECIALS.get(s, s) for s in strings]
+
 # Seed the random number generator consistently, for the sake of
 # draw_sentences_forever.
 import random
@@ -64,6 +80,55 @@ class Sentence(List[TWord]):
         return all(tag is not None for _, tag in self)
 
 
+def parse_token(token: str) -> TWord:
+    """Parse a whitespace-delimited token, such as "caviar/Noun" or just "caviar"."""
+    if "/" in token:
+        w, t = token.split("/")
+        return Word(w), Tag(t)
+    return Word(token), None
+
+def parse_sentence(line: str) -> Sentence:
+    """Parse one line of a corpus file into a Sentence, padded with BOS and EOS.
+    Unlike TaggedCorpus.get_sentences(), this keeps out-of-vocabulary words as they 
+    are (integerization maps them to OOV), and doesn't need a file, so it can be used 
+    on a stream of lines."""
+    sentence = Sentence([(BOS_WORD, BOS_TAG)])
+    sentence.extend(parse_token(token) for token in line.split())
+    sentence.append((EOS_WORD, EOS_TAG))
+    return sentence
+
+
+def _align(position: int, alignment: int = 8) -> int:
+    """Round a byte position up to a multiple of alignment."""
+    return position + (-position % alignment)
+
+
+class IntegerizedView:
+    """An integerized sentence, held as read-only views into the flat arrays of
+    an integerized TaggedCorpus (see TaggedCorpus.integerize()).  Like a Sentence, 
+    it is padded with BOS and EOS.  Missing tags are NO_TAG."""
+
+    __slots__ = ("words", "tags")
+
+    def __init__(self, words: np.ndarray, tags: np.ndarray):
+        self.words = words
+        self.tags = tags
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def desupervise(self) -> IntegerizedView:
+        """Make a new version of the sentence, with the tags removed 
+        except for BOS_TAG and EOS_TAG."""
+        tags = self.tags.copy()
+        tags[1:-1] = NO_TAG
+        return IntegerizedView(self.words, tags)
+
+    def is_supervised(self) -> bool:
+        """Is the given sentence fully supervised?"""
+        return bool((self.tags != NO_TAG).all())
+
+
 class TaggedCorpus:
     """Class for a corpus of tagged sentences.
     This is read from one or more files, where each sentence is 
@@ -75,13 +140,18 @@ class TaggedCorpus:
     The tagset and vocab attributes are publicly visible integerizers.
     The objects that we return from the corpus will use strings, but 
     we provide utility functions to run them through these integerizers.
+
+    Alternatively, the corpus can be integerized once and for all (see
+    integerize()), after which it no longer reads the files, and the
+    integerized sentences can be iterated over directly.
     """
 
     def __init__(self, *files: Path,
                  tagset: Optional[Integerizer[Tag]] = None, 
                  vocab: Optional[Integerizer[Word]] = None,
                  vocab_threshold: int = 1, 
-                 add_oov: bool = True):
+                 add_oov: bool = True,
+                 integerized: bool = False):
         """Wrap the given set of files as a corpus. 
         Use the tagset and/or vocab from the parent corpus, if given.
         Otherwise they are derived as follows from the data in `files`:
@@ -94,6 +164,8 @@ class TaggedCorpus:
         But note that in an HMM model, only EOS_TAG is an event that is randomly generated.
         And in a CRF model, none of these are randomly generated.
         So, we include them at the end of the tagset so that they can be easily omitted.
+
+        If integerized is True, then integerize() the corpus right away.
         """
 
         super().__init__()
@@ -148,6 +220,13 @@ class TaggedCorpus:
                 if tag is not None:
                     self.integerize_tag(tag)  # make sure it doesn't throw exception with given tagset
 
+        # flat integer arrays holding the whole corpus (see integerize())
+        self.word_ids: Optional[np.ndarray] = None
+        self.tag_ids: Optional[np.ndarray] = None
+        self.offsets: Optional[np.ndarray] = None
+        if integerized:
+            self.integerize()
+
     def __str__(self) -> str:
         return "\n".join(str(sentence) for sentence in self)
 
@@ -160,10 +239,14 @@ class TaggedCorpus:
 
     def __iter__(self) -> Iterator[Sentence]:
         """Iterate over all the sentences in the corpus, in order."""
+        if self.is_integerized():
+            return (self._deintegerize(i) for i in range(len(self)))
         return iter(self.get_sentences())
 
     def __len__(self) -> int:
         """Number of sentences in the corpus."""
+        if self.offsets is not None:
+            return len(self.offsets) - 1
         self._num_sentences: int
         try:
             return self._num_sentences
@@ -173,6 +256,8 @@ class TaggedCorpus:
 
     def num_tokens(self) -> int: 
         """Number of tokens in the corpus, including EOS tokens."""
+        if self.word_ids is not None:
+            return len(self.word_ids) - len(self)   # every sentence has one BOS
         self._num_tokens: int
         try:
             return self._num_tokens
@@ -180,6 +265,135 @@ class TaggedCorpus:
             self._num_tokens = sum(1 for _ in self.get_tokens())
             return self._num_tokens
 
+    # Methods for the integerized representation.  The whole corpus is
+    # stored as a flat array of word ids and a parallel array of tag ids
+    # (NO_TAG where the tag is missing), with BOS and EOS padding included.
+    # offsets[i]:offsets[i+1] is the span of sentence i in those arrays.
+
+    def integerize(self) -> None:
+        """Read and integerize the corpus once, storing it in the flat arrays.
+        After this, we never need to read the files again.  (Does nothing if
+        the corpus has already been integerized.)"""
+        if self.is_integerized():
+            return
+        # (typed arrays take 4-8 bytes per token, unlike lists of Python ints)
+        words = array('i')
+        tags = array('i')
+        offsets = array('q', [0])
+        for sentence in self.get_sentences():
+            for word, tag in sentence:
+                words.append(self.integerize_word(word))
+                tags.append(NO_TAG if tag is None else self.integerize_tag(tag))
+            offsets.append(len(words))
+        self.word_ids = np.frombuffer(words, dtype=np.int32)
+        self.tag_ids = np.frombuffer(tags, dtype=np.int32)
+        self.offsets = np.frombuffer(offsets, dtype=np.int64)
+        for arr in (self.word_ids, self.tag_ids, self.offsets):
+            arr.flags.writeable = False   # views that we hand out shouldn't modify the corpus
+        log.info(f"Integerized {len(self)} sentences from {', '.join(file.name for file in self.files)}")
+
+    def is_integerized(self) -> bool:
+        return self.word_ids is not None
+
+    def integerized(self) -> TaggedCorpus:
+        """This corpus if it is already integerized; otherwise an integerized copy of it,
+        sharing its tagset and vocab.  Unlike integerize(), this leaves the corpus itself 
+        as it was, so it suits code that gets the corpus from a caller."""
+        if self.is_integerized():
+            return self
+        corpus = copy.copy(self)
+        corpus.integerize()
+        return corpus
+
+    def integerized_sentence(self, i: int) -> IntegerizedView:
+        """The i-th sentence of an integerized corpus."""
+        assert self.word_ids is not None and self.tag_ids is not None and self.offsets is not None
+        start, end = self.offsets[i], self.offsets[i+1]
+        return IntegerizedView(self.word_ids[start:end], self.tag_ids[start:end])
+
+    def integerized_sentences(self) -> Iterator[IntegerizedView]:
+        """Iterate over all the sentences of an integerized corpus, in order.
+        This involves no string processing at all."""
+        return (self.integerized_sentence(i) for i in range(len(self)))
+
+    def supervised_sentences(self) -> np.ndarray:
+        """Boolean array saying which sentences of an integerized corpus are fully tagged."""
+        assert self.tag_ids is not None and self.offsets is not None
+        if len(self) == 0:
+            return np.zeros(0, dtype=bool)
+        return np.logical_and.reduceat(self.tag_ids != NO_TAG, self.offsets[:-1])
+
+    def _deintegerize(self, i: int) -> Sentence:
+        view = self.integerized_sentence(i)
+        return Sentence([(self.vocab[w], None if t == NO_TAG else self.tagset[t])
+                         for w, t in zip(view.words.tolist(), view.tags.tolist())])
+
+    # Binary file format for an integerized corpus, so that large corpora can be
+    # loaded without parsing any text.  The file consists of
+    #     BINARY_MAGIC
+    #     the length of the header, as a little-endian uint64
+    #     the header: JSON with the vocab and tagset, and the byte offsets of the arrays
+    #     the word_ids, tag_ids and offsets arrays, in little-endian binary, each 8-byte aligned
+    #         (the header gives their positions relative to the first of them)
+    # The arrays are memory-mapped when the file is loaded, so only the
+    # parts that are actually visited need to be paged into RAM.
+
+    BINARY_MAGIC = b"TAGCORP\x01"
+    _BINARY_ARRAYS = (("word_ids", "<i4"), ("tag_ids", "<i4"), ("offsets", "<i8"))
+
+    def save_binary(self, path: Path) -> None:
+        """Integerize the corpus if necessary, and write it to path in the binary format."""
+        self.integerize()
+        header = {"version": 1,
+                  "num_sentences": len(self),
+                  "vocab": list(self.vocab),
+                  "tagset": list(self.tagset)}
+        arrays = [np.ascontiguousarray(getattr(self, name), dtype=dtype) for name, dtype in self._BINARY_ARRAYS]
+        position = 0     # relative to the start of the data, which follows the header
+        for (name, _), arr in zip(self._BINARY_ARRAYS, arrays):
+            header[name] = {"start": position, "length": len(arr)}
+            position += _align(arr.nbytes)
+        header_bytes = json.dumps(header).encode("utf-8")
+
+        with open(path, "wb") as f:
+            f.write(self.BINARY_MAGIC)
+            f.write(len(header_bytes).to_bytes(8, "little"))
+            f.write(header_bytes)
+            for arr in arrays:
+                f.write(b"\0" * (_align(f.tell()) - f.tell()))
+                f.write(arr.tobytes())
+        log.info(f"Wrote {len(self)} integerized sentences to {path}")
+
+    @classmethod
+    def load_binary(cls, path: Path) -> TaggedCorpus:
+        """Load a corpus that was written by save_binary().  Its arrays are 
+        memory-mapped read-only, rather than read into memory."""
+        with open(path, "rb") as f:
+            if f.read(len(cls.BINARY_MAGIC)) != cls.BINARY_MAGIC:
+                raise ValueError(f"{path} is not a binary corpus file")
+            header_len = int.from_bytes(f.read(8), "little")
+            header = json.loads(f.read(header_len).decode("utf-8"))
+            data_start = _align(f.tell())
+        if header["version"] != 1:
+            raise ValueError(f"{path} has unsupported binary corpus version {header['version']}")
+
+        tagset: Integerizer[Tag] = Integerizer([Tag(t) for t in with_specials(header["tagset"])])
+        vocab: Integerizer[Word] = Integerizer([Word(w) for w in with_specials(header["vocab"])])
+        corpus = cls(tagset=tagset, vocab=vocab)   # no text files to read
+        for name, dtype in cls._BINARY_ARRAYS:
+            start, length = data_start + header[name]["start"], header[name]["length"]
+            arr = (np.memmap(path, dtype=dtype, mode="r", offset=start, shape=(length,))
+                   if length else np.zeros(0, dtype=dtype))
+            setattr(corpus, name, arr)
+        log.info(f"Memory-mapped {len(corpus)} integerized sentences from {path}")
+        return corpus
+
+    @classmethod
+    def is_binary_file(cls, path: Path) -> bool:
+        """Does the given file hold a corpus in the binary format?"""
+        with open(path, "rb") as f:
+            return f.read(len(cls.BINARY_MAGIC)) == cls.BINARY_MAGIC
+
     def get_tokens(self, oovs: bool = True) -> Iterable[TWord]:
         """Iterate over the tokens in the corpus.  Tokens are whitespace-delimited.
         If oovs is True, then words that are not in vocab are replaced with OOV.
@@ -188,13 +402,7 @@ class TaggedCorpus:
             with open(file) as f:
                 for line in f:
                     for token in line.split():
-                        word: Word
-                        tag: Optional[Tag]                    # declare type to help the type checker
-                        if "/" in token:
-                            w, t = token.split("/")   
-                            word, tag = Word(w), Tag(t)       # for example, "caviar/Noun"
-                        else:
-                            word, tag = Word(token), None     # for example, "caviar" without a tag
+                        word, tag = parse_token(token)
                         if (not oovs) or word in self.vocab:
                             yield word, tag       # keep the word
                         else:
@@ -209,6 +417,10 @@ class TaggedCorpus:
         it's convenient for the particular taggers we're writing, and matches the notation
         in the handout.)"""
 
+        if self.is_integerized():
+            yield from iter(self)     # we may not even have the files
+            return
+
         sentence = Sentence([(BOS_WORD, BOS_TAG)])
         for word, tag in self.get_tokens():
             sentence.append((word, tag))
@@ -228,7 +440,7 @@ class TaggedCorpus:
         in memory at once.  (Note: This module seeds the random number generator
         so at least the randomness will be consistent across runs.)
         """
-        sentences = peekable(self.get_sentences())
+        sentences = peekable(iter(self))
         assert sentences      # there should be at least one sentence.  (This test uses peekability.)
         if not randomize:
             import itertools
@@ -239,6 +451,50 @@ class TaggedCorpus:
                 for sentence in random.sample(pool, len(pool)):
                     yield sentence
 
+    def draw_integerized_forever(self, randomize: bool = True) -> Iterable[IntegerizedView]:
+        """Like draw_sentences_forever(), but over the integerized sentences, 
+        which must already exist (see integerize()).  We shuffle indices rather than 
+        the sentences themselves, but the random number generator is used the same way, 
+        so the order of sentences is the same as draw_sentences_forever() would give."""
+        assert self.is_integerized() and len(self) > 0
+        n = len(self)
+        while True:
+            order = random.sample(range(n), n) if randomize else range(n)
+            for i in order:
+                yield self.integerized_sentence(i)
+
+    def draw_minibatches_forever(self, batch_size: int, randomize: bool = True,
+                                 bucket_batches: int = 50) -> Iterable[np.ndarray]:
+        """Infinite iterable over minibatches of sentences of an integerized corpus,
+        each given as an array of sentence indices (see integerized_sentence()).  
+        As in draw_sentences_forever(), each epoch covers every sentence exactly once.
+        Only the last minibatch of an epoch may be smaller than batch_size.
+
+        If randomize is True, each epoch shuffles the sentences with the module's
+        seeded random number generator.  So that the batched trellis code doesn't
+        waste much work on padding, the shuffled order is then cut into buckets of
+        bucket_batches minibatches, each bucket is sorted by sentence length and cut 
+        into minibatches, and the minibatches of the epoch are shuffled, except for
+        a short one, which stays at the end.  If randomize is False, the minibatches 
+        just take the sentences in order."""
+        assert self.is_integerized() and self.offsets is not None and len(self) > 0
+        n = len(self)
+        lengths = np.diff(self.offsets)
+        while True:
+            if not randomize:
+                for start in range(0, n, batch_size):
+                    yield np.arange(start, min(start + batch_size, n))
+                continue
+            order = np.array(random.sample(range(n), n))
+            batches: List[np.ndarray] = []
+            for start in range(0, n, batch_size * bucket_batches):
+                bucket = order[start : start + batch_size * bucket_batches]
+                bucket = bucket[np.argsort(lengths[bucket], kind='stable')]
+                batches.extend(bucket[i : i + batch_size] for i in range(0, len(bucket), batch_size))
+            # only the last bucket can end with a short minibatch
+            short = [batches.pop()] if len(batches[-1]) < batch_size else []
+            yield from random.sample(batches, len(batches))
+            yield from short
 
     # Utility methods for integerizing the objects that are returned above.
 
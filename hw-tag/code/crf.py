@@ -7,23 +7,24 @@ from __future__ import annotations
 import logging
 from math import inf, log, exp
 from pathlib import Path
-from typing import Callable, Optional
+from typing import Callable, Dict, List, Optional, Sequence
 from typing_extensions import override
-from typeguard import typechecked
+from typechecking import typechecked
 
 import torch
 from torch import Tensor, cuda
 from jaxtyping import Float
 
-import itertools, more_itertools
 from tqdm import tqdm # type: ignore
 
-from corpus import (BOS_TAG, BOS_WORD, EOS_TAG, EOS_WORD, Sentence, Tag,
-                    TaggedCorpus, Word)
+from corpus import (BOS_TAG, BOS_WORD, EOS_TAG, EOS_WORD, NO_TAG, Sentence, Tag,
+                    TaggedCorpus, IntegerizedSentence, IntegerizedView, Word)
 from integerize import Integerizer
 from hmm import HiddenMarkovModel
+from profiling import NULL_PROFILER, Profiler
 
 TorchScalar = Float[Tensor, ""] # a Tensor with no dimensions, i.e., a scalar
+TorchBatch = Float[Tensor, "batch"]  # one scalar per sentence in a minibatch
 
 logger = logging.getLogger(Path(__file__).stem)  # For usage, see findsim.py in earlier assignment.
     # Note: We use the name "logger" this time rather than "log" since we
@@ -33,6 +34,11 @@ logger = logging.getLogger(Path(__file__).stem)  # For usage, see findsim.py in
 torch.manual_seed(1337)
 cuda.manual_seed(69_420)  # No-op if CUDA isn't available
 
+def _decayed(WB: Tensor, log_decay: Tensor) -> Tensor:
+    """Columns of WB, each multiplied by the exp of its entry of log_decay.  Only the
+    finite weights are decayed: the factor may underflow to 0, and -inf * 0 = nan."""
+    return torch.where(torch.isfinite(WB), WB * log_decay.exp().to(WB.dtype), WB)
+
 class ConditionalRandomField(HiddenMarkovModel):
     """An implementation of a CRF that has only transition and 
     emission features, just like an HMM."""
@@ -43,6 +49,8 @@ class ConditionalRandomField(HiddenMarkovModel):
     # Really CRF and HMM should inherit from a common parent class, TaggingModel.  
     # We eliminated that to make the assignment easier to navigate.
     
+    PICKLE_DEFAULTS = {**HiddenMarkovModel.PICKLE_DEFAULTS, "_touched": None}
+
     @override
     def __init__(self, 
                  tagset: Integerizer[Tag],
@@ -53,6 +61,7 @@ class ConditionalRandomField(HiddenMarkovModel):
         method for discussion."""
 
         super().__init__(tagset, vocab, unigram)
+        self._touched: Optional[List[Tensor]] = None   # only used during sparse updates; see train()
 
     @override
     def init_params(self) -> None:
@@ -123,6 +132,17 @@ class ConditionalRandomField(HiddenMarkovModel):
             
         self.updateAB()   # compute potential matrices
 
+    @override
+    def _saved_tensors(self) -> Dict[str, Tensor]:
+        """A CRF's parameters are its weights; A and B are computed from them."""
+        return {"WA": self.WA, "WB": self.WB}
+
+    @override
+    def _restore(self, settings: dict, tensors: Dict[str, Tensor]) -> None:
+        self.WA, self.WB = tensors["WA"], tensors["WB"]
+        self._touched = None
+        self.updateAB()
+
     def updateAB(self) -> None:
         """Set the transition and emission matrices self.A and self.B, 
         based on the current parameters self.WA and self.WB.
@@ -132,12 +152,18 @@ class ConditionalRandomField(HiddenMarkovModel):
         # you should make a full k × k matrix A of transition potentials,
         # so that the forward-backward code will still work.
         # See init_params() in the parent class for discussion of this point.
+        # (expand() only makes a view of the row, and the trellis code only uses that row.)
         if self.unigram:
             self.A = torch.exp(self.WA).expand(self.k, -1)
         else:
             self.A = torch.exp(self.WA)
 
+        if self._sparse_updates():
+            # B is brought up to date column by column (see _refresh_columns()), and
+            # _log_params() keeps log B when only A has been replaced
+            return
         self.B = torch.exp(self.WB)
+        self._invalidate_log_params()
         # need some way for WA, WB to be updated in the first place... 
         
     @override
@@ -150,7 +176,9 @@ class ConditionalRandomField(HiddenMarkovModel):
               lr: float = 1.0,
               reg: float = 0.0,
               max_steps: int = 50000,
-              save_path: Optional[Path] = Path("my_hmm.pkl")) -> None:
+              save_path: Optional[Path] = Path("my_hmm.pkl"),
+              sparse_updates: bool = True,
+              profiler: Optional[Profiler] = None) -> None:
         """Train the CRF on the given training corpus, starting at the current parameters.
 
         The minibatch_size controls how often we do an update.
@@ -166,9 +194,20 @@ class ConditionalRandomField(HiddenMarkovModel):
         After that, we'll stop after reaching max_steps, or when the relative improvement 
         of the evaluation loss, since the last evalbatch, is less than the
         tolerance.  In particular, we will stop when the improvement is
-        negative, i.e., the evaluation loss is getting worse (overfitting)."""
+        negative, i.e., the evaluation loss is getting worse (overfitting).
+
+        With sparse_updates, each minibatch only updates the emission weights of
+        the words that it contains, and the L2 decay of the other columns of WB is
+        deferred until they are next used (see _refresh_columns()).  The weights are
+        the same as with dense updates, up to floating-point error.
+
+        If a profiler is given, it gets the time spent in each phase of training
+        and a report after each evaluation (see profiling.py).
+
+        Training works on an integerized copy of the corpus, unless the corpus has
+        already been integerized; either way, the corpus itself isn't changed."""
         
-        def _loss() -> float:
+        def _loss(phase: str = "dev eval") -> float:
             # Evaluate the loss on the current parameters.
             # This will print its own log messages.
             # 
@@ -177,8 +216,10 @@ class ConditionalRandomField(HiddenMarkovModel):
             # However, during evaluation on held-out data, we don't need this
             # gradient and we can save time by turning off the extra bookkeeping
             # needed to compute it.
-            with torch.no_grad():  # type: ignore 
-                return loss(self)      
+            with self._profiler.phase(phase):
+                self._flush_sparse_updates()   # the loss needs all of the current parameters
+                with torch.no_grad():  # type: ignore 
+                    return loss(self)      
 
         # did not chnage this 
 
@@ -186,52 +227,127 @@ class ConditionalRandomField(HiddenMarkovModel):
         # updateAB() step before each minibatch produces A, B matrices
         # that are then shared by all sentences in the minibatch.
         # 
-        # All of the sentences in a minibatch could be treated in
-        # parallel, since they use the same parameters.  The code
-        # below treats them in series -- but if you were using a GPU,
-        # you could get speedups by writing the forward algorithm
-        # using higher-dimensional tensor operations that update
-        # alpha[j-1] to alpha[j] for all the sentences in the
-        # minibatch at once.  PyTorch could then take better advantage
-        # of hardware parallelism on the GPU.
+        # All of the sentences in a minibatch can be treated in
+        # parallel, since they use the same parameters.  So the code
+        # below runs the forward algorithm on a whole minibatch at once,
+        # updating alpha[j-1] to alpha[j] for all of its sentences with
+        # higher-dimensional tensor operations (see logprob_gradient_batch()).
+        # The minibatches group sentences of similar length, so that
+        # little of that work is wasted on padding (see
+        # TaggedCorpus.draw_minibatches_forever()).
 
         if reg < 0: raise ValueError(f"{reg=} but should be >= 0")
         if minibatch_size <= 0: raise ValueError(f"{minibatch_size=} but should be > 0")
         if minibatch_size > len(corpus):
             minibatch_size = len(corpus)  # no point in having a minibatch larger than the corpus
-        min_steps = len(corpus)   # always do at least one epoch
 
         #self.init_params()    # initialize the parameters and call updateAB()
-        self._zero_grad()     # get ready to accumulate their gradient
+        self._profiler = profiler if profiler is not None else NULL_PROFILER
+        try:
+            with self._profiler.phase("integerize"):
+                corpus = self._integerized_corpus(corpus)   # so we draw integerized sentences
+            self._zero_grad()     # get ready to accumulate their gradient
+            if sparse_updates:
+                self._start_sparse_updates()
+            try:
+                self._train_loop(corpus, _loss, tolerance, minibatch_size, eval_interval, lr, reg, max_steps)
+            finally:
+                self._stop_sparse_updates()
+
+            # For convenience when working in a Python notebook, 
+            # we automatically save our training work by default.
+            if save_path:
+                with self._profiler.phase("checkpoint"):
+                    self.save(save_path)
+                self._profiler.end_epoch(final=True)   # report the checkpoint's time too
+        finally:
+            del self._profiler    # back to the class default
+
+    def _train_loop(self, corpus: TaggedCorpus, _loss: Callable[[str], float], tolerance: float,
+                    minibatch_size: int, eval_interval: int, lr: float, reg: float, max_steps: int) -> None:
+        """The loop of train(), on an integerized corpus.  Each evaluation batch counts
+        as an epoch for the profiler."""
+        profiler = self._profiler
+        min_steps = len(corpus)   # always do at least one epoch (the minibatches cover each epoch)
         steps = 0
-        old_loss = _loss()    # evaluate initial loss
-        for evalbatch in more_itertools.batched(
-                           itertools.islice(corpus.draw_sentences_forever(), 
-                                            max_steps),  # limit infinite iterator
-                           eval_interval): # group into "evaluation batches"
-            for sentence in tqdm(evalbatch, total=eval_interval):
-                # Accumulate the gradient of log p(tags | words) on this sentence 
-                # into A_counts and B_counts.
-                self.accumulate_logprob_gradient(sentence, corpus)
-                steps += 1
-                
-                if steps % minibatch_size == 0:              
+        old_loss = _loss("initial dev eval")    # evaluate initial loss (not "dev eval", which is the epoch's own)
+        minibatches = iter(corpus.draw_minibatches_forever(int(minibatch_size)))
+        while steps < max_steps:
+            # An "evaluation batch" of about eval_interval sentences.
+            end = min(steps + eval_interval, max_steps)
+            with tqdm(total=end - steps) as progress:
+                while steps < end:
+                    # Accumulate the gradient of log p(tags | words) on the minibatch 
+                    # into A_counts and B_counts.
+                    minibatch = next(minibatches)[:max_steps - steps]
+                    with profiler.phase("integerize"):
+                        isents = [corpus.integerized_sentence(i) for i in minibatch]
+                    with profiler.phase("gradient"):
+                        self.logprob_gradient_batch(isents)
+                    steps += len(minibatch)
+                    progress.update(len(minibatch))
+                    if profiler.enabled:
+                        profiler.count(len(isents), sum(len(isent) - 2 for isent in isents))
+
                     # Time to update params based on the accumulated 
                     # minibatch gradient and regularizer.
-                    self.logprob_gradient_step(lr)
-                    self.reg_gradient_step(lr, reg, minibatch_size / len(corpus))
-                    self.updateAB()      # update A and B potential matrices from new params
-                    self._zero_grad()    # get ready to accumulate a new gradient for next minibatch
+                    with profiler.phase("update"):
+                        self.logprob_gradient_step(lr)
+                        self.reg_gradient_step(lr, reg, len(minibatch) / len(corpus))
+                        self.updateAB()      # update A and B potential matrices from new params
+                        self._zero_grad()    # get ready to accumulate a new gradient for next minibatch
             
             # Evaluate our progress.
             curr_loss = _loss()
+            profiler.end_epoch(steps=steps, dev_loss=curr_loss)
             if steps >= min_steps and curr_loss >= old_loss * (1-tolerance):
                 break   # we haven't gotten much better since last evalbatch, so stop
             old_loss = curr_loss   # remember for next evalbatch
 
-        # For convenience when working in a Python notebook, 
-        # we automatically save our training work by default.
-        if save_path: self.save(save_path)
+    def _sparse_updates(self) -> bool:
+        """Are we in the middle of training with sparse updates?"""
+        return getattr(self, '_touched', None) is not None   # older pickles lack the attribute
+
+    def _start_sparse_updates(self) -> None:
+        """Start sparse updates.  From now on, the true weights WB[:, w] are
+        exp(_log_decay - _column_log_decay[w]) * self.WB[:, w]: that is, column w
+        still owes the decay factors of all the steps since it was last refreshed.
+        B is only up to date in the columns refreshed since the last update."""
+        self._log_decay = 0.0     # log of the product of all the decay factors so far
+        self._column_log_decay = torch.zeros(self.V, dtype=torch.float64)   # its value when each column was refreshed
+        self._touched = []        # words seen by the current minibatch
+
+    def _refresh_columns(self, words: Tensor) -> None:
+        """Bring the columns of WB, B and log B for these words up to date, before
+        the current minibatch uses them."""
+        assert self._touched is not None
+        self._touched.append(words)
+        lag = self._log_decay - self._column_log_decay[words]
+        self.WB[:, words] = _decayed(self.WB[:, words], lag)
+        self._column_log_decay[words] = self._log_decay
+        self.B[:, words] = torch.exp(self.WB[:, words])
+        _, log_B = self._log_params()
+        assert log_B is not None
+        log_B[:, words] = torch.log(self.B[:, words] + 1e-10)
+
+    def _touched_words(self) -> Tensor:
+        """The words seen by the current minibatch."""
+        assert self._touched is not None
+        return torch.cat(self._touched).unique() if self._touched else torch.zeros(0, dtype=torch.long)
+
+    def _flush_sparse_updates(self) -> None:
+        """Apply all the deferred decay, so that WB and B are completely up to date."""
+        if not self._sparse_updates():
+            return
+        self.WB = _decayed(self.WB, self._log_decay - self._column_log_decay)
+        self._column_log_decay[:] = self._log_decay
+        self.B = torch.exp(self.WB)
+        self._invalidate_log_params()
+
+    def _stop_sparse_updates(self) -> None:
+        """Go back to dense updates."""
+        self._flush_sparse_updates()
+        self._touched = None
  
     @override
     @typechecked
@@ -257,13 +373,22 @@ class ConditionalRandomField(HiddenMarkovModel):
         #desup_isent = self._integerize_sentence(sentence.desupervise(), corpus)
 
         #basically the same thing as given but doing the integerizing elsewhere
-        numerator = super().logprob(sentence, corpus)
-        
-        # Get log Z(w) = log ∑_t p(t,w) from untagged sequence
-        denominator = super().logprob(sentence.desupervise(), corpus)
-    
-        
-        return numerator - denominator
+        return self.logprob_batch([sentence], corpus)[0]
+
+    @override
+    @typechecked
+    def logprob_batch(self, sentences: List[Sentence], corpus: TaggedCorpus) -> TorchBatch:
+        """Return the vector of *conditional* log-probabilities log p(tags | words)
+        of a minibatch of sentences, as in logprob().  The sentences are integerized
+        once: the numerator scores their tags (directly, for fully tagged sentences)
+        and the denominator log Z(w) = log ∑_t p(t,w) is one unclamped forward pass."""
+
+        if not sentences:
+            return torch.zeros(0)
+        isents = self._integerize_sentences(sentences, corpus)
+        word_ids, _, lengths = self._pad_batch(isents)
+        _, log_Z = self._forward_trellis(self._emissions(word_ids), lengths)
+        return self.forward_batch(isents) - log_Z
 
     def accumulate_logprob_gradient(self, sentence: Sentence, corpus: TaggedCorpus) -> None:
         """Add the gradient of self.logprob(sentence, corpus) into a total minibatch
@@ -278,29 +403,64 @@ class ConditionalRandomField(HiddenMarkovModel):
         # backprop instead.)
         
         # Just as in logprob()
-        isent_tagged   = self._integerize_sentence(sentence, corpus)
-        isent_untagged = self._integerize_sentence(sentence.desupervise(), corpus)
-
-        # Hint: use the mult argument to E_step(). <-- clever!!
-        
-        self.E_step(isent_tagged, mult=1.0) #obs counts from tagged
-    
-        self.E_step(isent_untagged, mult=-1.0) # subtract exp counts from untagged
+        self.accumulate_integerized_gradient(self._integerize_sentence(sentence, corpus))
+
+    def accumulate_integerized_gradient(self, isent: IntegerizedSentence | IntegerizedView) -> TorchScalar:
+        """Same as accumulate_logprob_gradient(), for a sentence that is already integerized.
+        Also returns log p(tags | words), which comes for free."""
+        return self.logprob_gradient_batch([isent])[0]
+
+    def logprob_gradient_batch(self, isents: Sequence[IntegerizedSentence | IntegerizedView]) -> TorchBatch:
+        """Add the gradient of log p(tags | words) of each sentence in a minibatch into
+        self.A_counts and self.B_counts, and return the vector of those log-probabilities.
+
+        The gradient is observed counts minus expected counts.  This used to be two
+        E steps, on the tagged and the desupervised sentence.  Here the sentences are
+        padded once; a fully tagged sentence's observed counts and score come straight
+        from its path, and the expected counts and log Z come from one unclamped
+        forward-backward pass."""
+        if not isents:
+            return torch.zeros(0)
+        word_ids, tag_ids, lengths = self._pad_batch(isents)
+        if self._sparse_updates():
+            self._refresh_columns(word_ids.unique())
+
+        # observed counts, and the numerator log p(tags, words)
+        supervised = self._supervised(tag_ids, lengths)
+        numerator = torch.empty(len(isents))
+        if supervised.any():
+            with self._profiler.phase("counts"):
+                numerator[supervised] = self._path_logprob(word_ids[supervised], tag_ids[supervised], lengths[supervised])
+                self._add_path_counts(word_ids[supervised], tag_ids[supervised], lengths[supervised], mult=1.0)
+        if not supervised.all():
+            # partly tagged sentences marginalize over their unknown tags
+            rest = ~supervised
+            numerator[rest] = self._add_expected_counts(word_ids[rest], tag_ids[rest], lengths[rest], mult=1.0)
+
+        # subtract the expected counts, and get the denominator log Z(w)
+        log_Z = self._add_expected_counts(word_ids, torch.full_like(tag_ids, NO_TAG), lengths, mult=-1.0)
+        return numerator - log_Z
 
             
     def _zero_grad(self):
         """Reset the gradient accumulator to zero."""
         # You'll have to override this method in the next homework; 
         # see comments in accumulate_logprob_gradient().
-        self._zero_counts()
+        if self._sparse_updates():
+            # only the columns of the minibatch's words can be nonzero
+            self.A_counts.zero_()
+            self.B_counts[:, self._touched_words()] = 0
+            self._touched = []
+        else:
+            self._zero_counts()
 
     def logprob_gradient_step(self, lr: float) -> None:
         """Update the parameters using the accumulated logprob gradient.
         lr is the learning rate (stepsize)."""
         
         # Warning: Careful about how to handle the unigram case, where self.WA
-        # is only a vector of tag unigram potentials (even though self.A_counts
-        # is a still a matrix of tag bigram potentials).
+        # is only a vector of tag unigram potentials (and self.A_counts is a
+        # single row too; see _zero_counts() in the parent class).
         
         #copied from HMM init_params 
         if self.unigram:
@@ -321,7 +481,11 @@ class ConditionalRandomField(HiddenMarkovModel):
             
         # update parameters
         # self.WA += self.A_counts
-        self.WB += lr * self.B_counts
+        if self._sparse_updates():
+            words = self._touched_words()    # the other columns of B_counts are 0
+            self.WB[:, words] += lr * self.B_counts[:, words]
+        else:
+            self.WB += lr * self.B_counts
         #raise NotImplementedError   # you fill this in!
         
     def reg_gradient_step(self, lr: float, reg: float, frac: float):
@@ -346,8 +510,15 @@ class ConditionalRandomField(HiddenMarkovModel):
             mask = torch.isfinite(self.WA)
             self.WA[mask] *= decay
             
-        mask = torch.isfinite(self.WB) 
-        self.WB[mask] *= decay
+        if self._sparse_updates():
+            # every column of WB now owes this decay factor (see _start_sparse_updates())
+            if decay <= 0:
+                raise ValueError(f"sparse updates need a positive decay factor, but {decay=}; "
+                                 f"use a smaller lr or reg")
+            self._log_decay += log(decay)
+        else:
+            mask = torch.isfinite(self.WB) 
+            self.WB[mask] *= decay
 
         # Warning: Be careful not to do something like w -= 0.1*w,
         # because some of the weights are infinite and inf - inf = nan. 
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+# Sparse storage for the HMM's emission counts and probabilities.
+#
+# With a large vocabulary and tagset, a dense (k, V) matrix of emission
+# probabilities is big, and so is the matrix of expected counts that the
+# E-step accumulates.  But after smoothing, most entries of a row t of B
+# share the same value: they are words that were never (expected to be)
+# emitted by t, and so they only got the add-λ smoothing mass.  So we store
+# the counts as coordinate (COO) triples, and B as compressed sparse rows
+# (CSR) indexed by word, plus one "background" probability per tag that
+# stands for all the entries that aren't stored.
+
+from __future__ import annotations
+from typing import List, Optional, Tuple
+
+import torch
+from torch import Tensor
+from jaxtyping import Float, Int
+
+class SparseCounts:
+    """Counts c[t, w] of a (k, V) matrix, stored as coordinate triples.
+    add_columns() plays the role of B_counts.index_add_(1, words, values.T)
+    for a dense matrix.  Additions are buffered and merged from time to time,
+    so that memory grows with the number of distinct (t, w) pairs."""
+
+    def __init__(self, k: int, V: int):
+        self.k = k
+        self.V = V
+        self._keys: Tensor = torch.zeros(0, dtype=torch.long)   # t * V + w, sorted and unique
+        self._values: Tensor = torch.zeros(0)
+        self._pending_keys: List[Tensor] = []
+        self._pending_values: List[Tensor] = []
+        self._pending = 0
+
+    def add_columns(self, words: Int[Tensor, "n"], values: Float[Tensor, "n k"]) -> None:
+        """Add values[i, t] to c[t, words[i]], for every i and t.
+        Only the nonzero values are stored."""
+        i, t = values.nonzero(as_tuple=True)
+        self.add(t, words[i], values[i, t])
+
+    def add(self, tags: Int[Tensor, "n"], words: Int[Tensor, "n"], values: Float[Tensor, "n"]) -> None:
+        """Add values[i] to c[tags[i], words[i]], for every i."""
+        self._pending_keys.append(tags * self.V + words)
+        self._pending_values.append(values.to(self._values.dtype))
+        self._pending += len(values)
+        if self._pending > max(len(self._keys), 1 << 20):
+            self._coalesce()
+
+    def _coalesce(self) -> None:
+        """Merge the buffered additions into the sorted triples."""
+        if not self._pending_keys:
+            return
+        keys = torch.cat([self._keys] + self._pending_keys)
+        values = torch.cat([self._values] + self._pending_values)
+        self._keys, inverse = torch.unique(keys, sorted=True, return_inverse=True)
+        self._values = torch.zeros(len(self._keys), dtype=values.dtype).index_add_(0, inverse, values)
+        self._pending_keys, self._pending_values, self._pending = [], [], 0
+
+    @property
+    def nnz(self) -> int:
+        """The number of stored (t, w) pairs."""
+        self._coalesce()
+        return len(self._keys)
+
+    def triples(self) -> Tuple[Tensor, Tensor, Tensor]:
+        """The stored counts as (tags, words, values), sorted by tag and then word."""
+        self._coalesce()
+        return self._keys // self.V, self._keys % self.V, self._values
+
+    def lookup(self, tags: Int[Tensor, "n"], words: Int[Tensor, "n"]) -> Float[Tensor, "n"]:
+        """The counts c[tags[i], words[i]], which are 0 for pairs that aren't stored."""
+        self._coalesce()
+        keys = tags * self.V + words
+        if not len(self._keys):
+            return torch.zeros(len(keys), dtype=self._values.dtype)
+        where = torch.searchsorted(self._keys, keys).clamp(max=len(self._keys) - 1)
+        return torch.where(self._keys[where] == keys, self._values[where], 0)
+
+    def row_sums(self) -> Float[Tensor, "k"]:
+        tags, _, values = self.triples()
+        return torch.zeros(self.k, dtype=values.dtype).index_add_(0, tags, values)
+
+    def any_in_rows(self, rows: slice) -> bool:
+        """Are any of the counts in the given rows nonzero?"""
+        tags, _, values = self.triples()
+        selected = torch.zeros(self.k, dtype=torch.bool)
+        selected[rows] = True
+        return bool((selected[tags] & (values != 0)).any())
+
+    def to_dense(self) -> Float[Tensor, "k V"]:
+        tags, words, values = self.triples()
+        dense = torch.zeros((self.k, self.V), dtype=values.dtype)
+        dense[tags, words] = values
+        return dense
+
+
+class SparseEmissions:
+    """An emission matrix B[t, w] = p(w | t), stored as the probabilities of some
+    (t, w) pairs, together with a background probability for each tag t that
+    applies to all of its other words.  The stored pairs are grouped by word,
+    so that the columns B[:, w] needed by the trellis can be gathered quickly."""
+
+    def __init__(self, k: int, V: int,
+                 tags: Int[Tensor, "nnz"], words: Int[Tensor, "nnz"], probs: Float[Tensor, "nnz"],
+                 background: Float[Tensor, "k"]):
+        self.k = k
+        self.V = V
+        order = torch.argsort(words * k + tags)
+        self.tags = tags[order].to(torch.int32)   # tag of each stored pair, grouped by word
+        self.probs = probs[order]
+        self.word_ptr = torch.zeros(V + 1, dtype=torch.long)  # pairs for word w are word_ptr[w]:word_ptr[w+1]
+        self.word_ptr[1:] = torch.bincount(words, minlength=V).cumsum(0)
+        self.background = background
+        self._compute_logs()
+
+    def _compute_logs(self) -> None:
+        # the log-probabilities that the trellis will look up
+        self.log_probs = torch.log(self.probs + 1e-10)
+        self.log_background = torch.log(self.background + 1e-10)
+
+    @classmethod
+    def from_arrays(cls, k: int, V: int, tags: Int[Tensor, "nnz"], probs: Float[Tensor, "nnz"],
+                    word_ptr: Int[Tensor, "V+1"], background: Float[Tensor, "k"]) -> SparseEmissions:
+        """Rebuild a matrix from its stored arrays, which are already grouped by word
+        (as saved by HiddenMarkovModel.save())."""
+        B = cls.__new__(cls)
+        B.k, B.V = k, V
+        B.tags, B.probs, B.word_ptr, B.background = tags, probs, word_ptr, background
+        B._compute_logs()
+        return B
+
+    @classmethod
+    def smoothed(cls, counts: SparseCounts, smoothing: Float[Tensor, "k"],
+                 allowed: Optional[Tuple[Tensor, Tensor]] = None) -> SparseEmissions:
+        """The add-λ estimate of B from the given counts, where each row t gets
+        its own λ = smoothing[t].  That is, B[t, w] = (c[t, w] + λ) / Z[t], where the
+        smoothing mass of the unstored entries is accounted for analytically.
+
+        If `allowed` gives (tags, words) pairs, then all other entries of B are
+        structural zeros, and the smoothing only goes to the allowed pairs."""
+        k, V = counts.k, counts.V
+        if allowed is None:
+            tags, words, values = counts.triples()
+            numerators = values + smoothing[tags]
+            totals = counts.row_sums() + smoothing * V
+            background = smoothing
+        else:
+            tags, words = allowed
+            numerators = counts.lookup(tags, words) + smoothing[tags]
+            totals = torch.zeros(k, dtype=numerators.dtype).index_add_(0, tags, numerators)
+            background = torch.zeros(k)
+        totals = torch.where(totals == 0, torch.ones_like(totals), totals)
+        return cls(k, V, tags, words, numerators / totals[tags], background / totals)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return (self.k, self.V)
+
+    @property
+    def nnz(self) -> int:
+        """The number of stored (t, w) pairs."""
+        return len(self.probs)
+
+    def log_columns(self, words: Int[Tensor, "n"]) -> Float[Tensor, "n k"]:
+        """log B[:, words[i]] for each i, which is what torch.index_select(log_B, 1, words).T
+        would return for a dense matrix."""
+        n = len(words)
+        starts = self.word_ptr[words]
+        sizes = self.word_ptr[words + 1] - starts
+        rows = torch.repeat_interleave(torch.arange(n), sizes)   # which column each stored pair goes to
+        ends = sizes.cumsum(0)
+        pairs = torch.arange(int(ends[-1]) if n else 0) + torch.repeat_interleave(starts - ends + sizes, sizes)
+        columns = self.log_background.repeat(n, 1)
+        columns[rows, self.tags[pairs].long()] = self.log_probs[pairs]
+        return columns
+
+    def row_sums(self) -> Float[Tensor, "k"]:
+        """The sum of each row of B, including the background probabilities."""
+        tags = self.tags.long()
+        stored = torch.zeros(self.k, dtype=self.probs.dtype).index_add_(0, tags, self.probs)
+        unstored = self.V - torch.bincount(tags, minlength=self.k)
+        return stored + self.background * unstored
+
+    def to_dense(self) -> Float[Tensor, "k V"]:
+        words = torch.repeat_interleave(torch.arange(self.V), self.word_ptr.diff())
+        dense = self.background.unsqueeze(1).repeat(1, self.V)
+        dense[self.tags.long(), words] = self.probs
+        return dense
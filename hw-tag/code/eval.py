@@ -2,13 +2,17 @@
 
 # CS465 at Johns Hopkins University.
 # Evaluation of taggers.
+from collections import deque
+from concurrent.futures import Executor, Future
 import logging
 from pathlib import Path
 from math import nan, exp
-from typing import Counter, Tuple, Optional, Callable, Union
+from typing import Counter, Deque, Iterable, Iterator, List, Tuple, Optional, Callable, TypeVar, Union
 
+import numpy as np
 import torch
 from torch import nn as nn
+from more_itertools import chunked
 from tqdm import tqdm # type: ignore
 
 from corpus import Sentence, Word, EOS_WORD, BOS_WORD, OOV_WORD, TaggedCorpus
@@ -17,21 +21,80 @@ from integerize import Integerizer
 
 log = logging.getLogger(Path(__file__).stem)  # For usage, see findsim.py in earlier assignment.
 
+# The tagging counts of eval_tagging() are kept in a fixed-size array, with a row
+# for each of these kinds and a column for each of these categories.
+COUNT_KINDS = ['NUM', 'DENOM']
+CATEGORIES = ['ALL', 'KNOWN', 'SEEN', 'NOVEL']
+
+T = TypeVar('T')
+S = TypeVar('S')
+
+def lazy_map(function: Callable[[S], T],
+             items: Iterable[S],
+             pool: Optional[Executor],
+             ahead: int = 32) -> Iterator[T]:
+    """Like map(function, items), but run on the pool if one is given.
+    Unlike pool.map(), which takes all of the items at once, this submits an item
+    only when fewer than `ahead` are pending, so that a long stream of items (such
+    as batches of a big corpus) is never all in memory.  Results are in order."""
+    if pool is None:
+        yield from map(function, items)
+        return
+    pending: Deque[Future] = deque()
+    try:
+        for item in items:
+            if len(pending) >= ahead:
+                yield pending.popleft().result()
+            pending.append(pool.submit(function, item))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:   # if the caller stopped early
+            future.cancel()
+
+def _map_shards(function: Callable[[List[Sentence]], T],
+                eval_corpus: TaggedCorpus,
+                batch_size: int,
+                pool: Optional[Executor]) -> Iterable[T]:
+    """Apply the function to successive shards of batch_size sentences from the corpus,
+    and yield the results in corpus order (not in order of completion), so that
+    reducing them gives the same answer whether or not a pool is used.
+    
+    The pool may be a ThreadPoolExecutor, which works well since torch releases
+    the GIL during tensor operations.  The threads share the model, so the callers
+    first have it compute what it caches (see HiddenMarkovModel._prepare_for_threads())."""
+    if batch_size <= 0: raise ValueError(f"{batch_size=} but should be > 0")
+    sized = lambda shard: (len(shard), function(shard))
+    with tqdm(total=len(eval_corpus)) as progress:
+        for size, result in lazy_map(sized, chunked(eval_corpus, batch_size), pool):
+            yield result
+            progress.update(size)
+
 def viterbi_tagger(model: HiddenMarkovModel, eval_corpus: TaggedCorpus) -> Callable[[Sentence], Sentence]:
     def tagger(input:Sentence) -> Sentence:
         return model.viterbi_tagging(input, eval_corpus)
     return tagger
 
 def model_cross_entropy(model: HiddenMarkovModel,
-                        eval_corpus: TaggedCorpus) -> float:
+                        eval_corpus: TaggedCorpus,
+                        batch_size: int = 64,
+                        pool: Optional[Executor] = None) -> float:
     """Return cross-entropy per token of the model on the given evaluation corpus.
     That corpus may be either supervised or unsupervised.
+    Sentences are scored in minibatches of batch_size by the batched forward algorithm,
+    concurrently if a pool is given.
     Warning: Return value is in nats, not bits."""
+    def score(batch: List[Sentence]) -> Tuple[float, int]:
+        return (model.logprob_batch(batch, eval_corpus).sum().item(),
+                sum(len(gold) - 1 for gold in batch))    # count EOS but not BOS
+
+    if pool is not None:
+        model._prepare_for_threads()
     logprob = 0.0
     token_count = 0
-    for gold in tqdm(eval_corpus, total=len(eval_corpus)):
-        logprob += model.logprob(gold, eval_corpus).item()
-        token_count += len(gold) - 1    # count EOS but not BOS
+    for batch_logprob, batch_tokens in _map_shards(score, eval_corpus, batch_size, pool):
+        logprob += batch_logprob
+        token_count += batch_tokens
     cross_entropy = -logprob / token_count
     log.info(f"Cross-entropy: {cross_entropy:.4f} nats (= perplexity {exp(cross_entropy):.3f})")
     return cross_entropy
@@ -39,34 +102,52 @@ def model_cross_entropy(model: HiddenMarkovModel,
 def viterbi_error_rate(model: HiddenMarkovModel,
                      eval_corpus: TaggedCorpus,
                      known_vocab: Optional[Integerizer[Word]] = None,
-                     show_cross_entropy = True) -> float:
+                     show_cross_entropy = True,
+                     batch_size: int = 64,
+                     pool: Optional[Executor] = None) -> float:
     """Return the error rate of Viterbi tagging with the given model on the given 
     evaluation corpus, after logging cross-entropy (optionally) and a breakdown 
     of accuracy."""
 
     if show_cross_entropy:
-        model_cross_entropy(model, eval_corpus)  # call this for its side effect (logging)
-    return tagger_error_rate(viterbi_tagger(model, eval_corpus),
-                             eval_corpus,
-                             known_vocab=known_vocab)
+        model_cross_entropy(model, eval_corpus, batch_size, pool)  # call this for its side effect (logging)
+    return tagger_error_rate(model, eval_corpus, known_vocab=known_vocab, batch_size=batch_size, pool=pool)
 
-def tagger_error_rate(tagger: Callable[[Sentence], Sentence],
+def tagger_error_rate(model_or_tagger: Union[HiddenMarkovModel, Callable[[Sentence], Sentence]],
                      eval_corpus: TaggedCorpus,
-                     known_vocab: Optional[Integerizer[Word]] = None) -> float:
+                     known_vocab: Optional[Integerizer[Word]] = None,
+                     batch_size: int = 64,
+                     pool: Optional[Executor] = None) -> float:
     """Return the error rate of the given generic tagger on the given evaluation corpus,
-    after printing cross-entropy and a breakdown of accuracy (using the logger)."""
+    after printing cross-entropy and a breakdown of accuracy (using the logger).
+    A model is used as a Viterbi tagger, which tags batch_size sentences at a time.
+    The corpus is split into shards of batch_size sentences, which are tagged
+    concurrently if a pool is given; their counts are added up at the end."""
+
+    if isinstance(model_or_tagger, HiddenMarkovModel):
+        model = model_or_tagger
+        if pool is not None:
+            model._prepare_for_threads()
+        tag_batch = lambda batch: model.viterbi_tagging_batch(batch, eval_corpus)
+    else:
+        tagger = model_or_tagger
+        tag_batch = lambda batch: [tagger(input) for input in batch]
+
+    def shard_counts(shard: List[Sentence]) -> np.ndarray:
+        counts = np.zeros((len(COUNT_KINDS), len(CATEGORIES)), dtype=np.int64)
+        for predicted, gold in zip(tag_batch([gold.desupervise() for gold in shard]), shard):
+            counts += tagging_counts(predicted, gold, known_vocab)
+        return counts
 
-    counts: Counter[Tuple[str, str]] = Counter()  # keep running totals here
-    for gold in tqdm(eval_corpus, total=len(eval_corpus)):
-        predicted = tagger(gold.desupervise())
-        counts += eval_tagging(predicted, gold, known_vocab)   # += works on dictionaries
+    counts = sum(_map_shards(shard_counts, eval_corpus, batch_size, pool),   # keep running totals here
+                 np.zeros((len(COUNT_KINDS), len(CATEGORIES)), dtype=np.int64))
 
     def fraction(c:str) -> float:
-        num = counts['NUM',c]
-        denom = counts['DENOM',c]
+        num = int(counts[COUNT_KINDS.index('NUM'), CATEGORIES.index(c)])
+        denom = int(counts[COUNT_KINDS.index('DENOM'), CATEGORIES.index(c)])
         return nan if denom==0 else num / denom
 
-    categories = ['ALL', 'KNOWN', 'SEEN', 'NOVEL']
+    categories = list(CATEGORIES)
     if known_vocab is None:
         categories.remove('KNOWN')
     results = [f"{c.lower()}: {(fraction(c)):.3%}" for c in categories]            
@@ -85,9 +166,26 @@ def eval_tagging(predicted: Sentence,
     supervised part of the corpus."""
 
     counts: Counter[Tuple[str, str]] = Counter()
+    array = tagging_counts(predicted, gold, known_vocab)
+    for i, kind in enumerate(COUNT_KINDS):
+        for j, c in enumerate(CATEGORIES):
+            if array[i, j]:
+                counts[kind, c] = int(array[i, j])
+    return counts
+
+def tagging_counts(predicted: Sentence, 
+                   gold: Sentence, 
+                   known_vocab: Optional[Integerizer[Word]]) -> np.ndarray:
+    """Like eval_tagging(), but returns the counts as an array indexed by
+    [COUNT_KINDS.index(kind), CATEGORIES.index(category)], which is cheaper
+    to add up over many sentences than a Counter."""
+
+    counts = np.zeros((len(COUNT_KINDS), len(CATEGORIES)), dtype=np.int64)
+    num, denom = COUNT_KINDS.index('NUM'), COUNT_KINDS.index('DENOM')
     for ((word, tag), (goldword, goldtag)) in zip(predicted, gold):
         assert word == goldword or word == OOV_WORD   # sentences being compared should have the same words!
-        if word is BOS_WORD or word is EOS_WORD:  # not fair to get credit for these
+        if word == BOS_WORD or word == EOS_WORD:  # not fair to get credit for these
+                                                  # (==, since a loaded vocab has its own copies of these strings)
             continue
         if goldtag is None:                # no way to score if we don't know answer
             continue
@@ -96,21 +194,27 @@ def eval_tagging(predicted: Sentence,
         elif known_vocab and word in known_vocab: category = 'KNOWN'
         else:                                     category = 'SEEN'    
 
-        for c in (category, 'ALL'):
-            counts['DENOM', c] += 1      # denominator of accuracy in category c
+        for c in (CATEGORIES.index(category), CATEGORIES.index('ALL')):
+            counts[denom, c] += 1      # denominator of accuracy in category c
             if tag == goldtag:
-                counts['NUM', c] += 1    # numerator of accuracy in category c
+                counts[num, c] += 1    # numerator of accuracy in category c
 
     return counts
 
 def write_tagging(model_or_tagger: Union[HiddenMarkovModel, Callable[[Sentence], Sentence]],
                         eval_corpus: TaggedCorpus,
-                        output_path: Path) -> None:
+                        output_path: Path,
+                        batch_size: int = 64) -> None:
+    """Write the Viterbi tagging of each sentence to output_path.  A model
+    tags batch_size sentences at a time; a generic tagger goes one by one."""
     if isinstance(model_or_tagger, HiddenMarkovModel):
-        tagger = viterbi_tagger(model_or_tagger, eval_corpus)
+        model = model_or_tagger
+        tag_batch = lambda batch: model.viterbi_tagging_batch(batch, eval_corpus)
     else:
         tagger = model_or_tagger
-    with open(output_path, 'w') as f:
-        for gold in tqdm(eval_corpus, total=len(eval_corpus)):
-            predicted = tagger(gold.desupervise())
-            f.write(str(predicted)+"\n")
+        tag_batch = lambda batch: [tagger(input) for input in batch]
+    with open(output_path, 'w') as f, tqdm(total=len(eval_corpus)) as progress:
+        for batch in chunked(eval_corpus, batch_size):
+            for predicted in tag_batch([gold.desupervise() for gold in batch]):
+                f.write(str(predicted)+"\n")
+            progress.update(len(batch))
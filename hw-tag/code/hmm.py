@@ -5,23 +5,51 @@
 
 from __future__ import annotations
 from collections import defaultdict
+from contextlib import nullcontext
 import logging
+from multiprocessing.pool import Pool
 from math import inf, log, exp
+import json
+import os
 from pathlib import Path
-from typing import Callable, List, Optional, cast
-from typeguard import typechecked
+from typing import Any, Callable, ContextManager, Dict, List, NamedTuple, Optional, Sequence, Tuple, cast
+from typechecking import typechecked
 
+import numpy as np
 import torch
 from torch import Tensor, cuda, nn
-from jaxtyping import Float
+import torch.multiprocessing
+from jaxtyping import Float, Int
 
+from more_itertools import chunked
 from tqdm import tqdm # type: ignore
-import pickle
 
 from integerize import Integerizer
-from corpus import BOS_TAG, BOS_WORD, EOS_TAG, EOS_WORD, Sentence, Tag, TaggedCorpus, IntegerizedSentence, Word
+from emissions import SparseCounts, SparseEmissions
+from profiling import NULL_PROFILER, Profiler
+from corpus import (BOS_TAG, BOS_WORD, EOS_TAG, EOS_WORD, NO_TAG, Sentence, Tag, TaggedCorpus,
+                    IntegerizedSentence, IntegerizedView, Word, _align, with_specials)
 
 TorchScalar = Float[Tensor, ""] # a Tensor with no dimensions, i.e., a scalar
+TorchBatch = Float[Tensor, "batch"]  # one scalar per sentence in a minibatch
+
+class ForwardBackward(NamedTuple):
+    """The result of HiddenMarkovModel.forward_backward() on a padded minibatch.
+    It belongs to the caller: the model doesn't keep any of it, so several
+    threads can run inference with the same model at once.
+
+    alpha[b, j] and beta[b, j] are the alpha and beta vectors at position j of
+    sentence b (position 0 is BOS, and positions beyond lengths[b] are junk), 
+    and log_Z[b] is its log Z."""
+    word_ids: Int[Tensor, "batch n"]
+    lengths: Int[Tensor, "batch"]
+    alpha: Float[Tensor, "batch n+1 k"]
+    beta: Float[Tensor, "batch n+1 k"]
+    log_Z: TorchBatch
+
+    def log_posteriors(self) -> Float[Tensor, "batch n k"]:
+        """Log posterior marginals log p(t_j = t | w) at positions 1 .. n."""
+        return self.alpha[:, 1:] + self.beta[:, 1:] - self.log_Z[:, None, None]
 
 logger = logging.getLogger(Path(__file__).stem)  # For usage, see findsim.py in earlier assignment.
     # Note: We use the name "logger" this time rather than "log" since we
@@ -45,17 +73,33 @@ class HiddenMarkovModel:
     # As usual in Python, attributes and methods starting with _ are intended as private;
     # in this case, they might go away if you changed the parametrization of the model.
 
+    # What train() reports the time of its phases to (see profiling.py).  It is only
+    # set during training; otherwise this default does nothing.
+    _profiler: Profiler = NULL_PROFILER
+
     def __init__(self, 
                  tagset: Integerizer[Tag],
                  vocab: Integerizer[Word],
-                 unigram: bool = False):
+                 unigram: bool = False,
+                 sparse: bool = False):
         """Construct an HMM with initially random parameters, with the
         given tagset, vocabulary, and lexical features.
         
         Normally this is an ordinary first-order (bigram) HMM.  The `unigram` flag
         says to fall back to a zeroth-order HMM, in which the different
         positions are generated independently.  (The code could be extended to
-        support higher-order HMMs: trigram HMMs used to be popular.)"""
+        support higher-order HMMs: trigram HMMs used to be popular.)
+        
+        The `sparse` flag says to store the emission counts and B sparsely
+        (see emissions.py) instead of as dense (k, V) matrices, which saves 
+        memory when the vocabulary and tagset are large."""
+
+        self._init_structure(tagset, vocab, unigram, sparse)
+        self.init_params()     # create and initialize model parameters
+
+    def _init_structure(self, tagset: Integerizer[Tag], vocab: Integerizer[Word], unigram: bool, sparse: bool) -> None:
+        """Everything that the constructor sets up besides the parameters.  load()
+        calls this too, and then reads the parameters from the model file."""
 
         # We'll use the variable names that we used in the reading handout, for
         # easy reference.  (It's typically good practice to use more descriptive names.)
@@ -69,6 +113,7 @@ class HiddenMarkovModel:
         self.k = len(tagset)       # number of tag types
         self.V = len(vocab) - 2    # number of word types (not counting EOS_WORD and BOS_WORD)
         self.unigram = unigram     # do we fall back to a unigram model?
+        self.sparse = sparse       # do we store emissions sparsely?
 
         self.tagset = tagset
         self.vocab = vocab
@@ -81,7 +126,9 @@ class HiddenMarkovModel:
         assert self.eos_t is not None    # we need this to exist
         self.eye: Tensor = torch.eye(self.k)  # identity matrix, used as a collection of one-hot tag vectors
 
-        self.init_params()     # create and initialize model parameters
+        # How many times log A and log B have been computed from A and B (see _log_params()).
+        # Compare this before and after an epoch to see how often they were recomputed.
+        self.log_param_computations: int = 0
  
     def init_params(self) -> None:
         """Initialize params to small random values (which breaks ties in the fully unsupervised case).  
@@ -99,16 +146,19 @@ class HiddenMarkovModel:
         # which don't have columns in this matrix).
         ###
 
-        WB = 0.1*torch.rand(self.k, self.V)  # I added a slightly larger scale to help break initial symmetry
-
-        # bias term to make each tag slightly prefer certain words initially
-        for t in range(self.k):
-            word_subset = torch.randperm(self.V)[:self.V // self.k]  # assign some words to each tag
-            WB[t, word_subset] += 1.0 
-        #this is same 
-        self.B = WB.softmax(dim=1)            # construct emission distributions p(w | t)
-        self.B[self.eos_t, :] = 0             # EOS_TAG can't emit any column's word
-        self.B[self.bos_t, :] = 0             # BOS_TAG can't emit any column's word
+        if self.sparse:
+            self._init_sparse_B()
+        else:
+            WB = 0.1*torch.rand(self.k, self.V)  # I added a slightly larger scale to help break initial symmetry
+
+            # bias term to make each tag slightly prefer certain words initially
+            for t in range(self.k):
+                word_subset = torch.randperm(self.V)[:self.V // self.k]  # assign some words to each tag
+                WB[t, word_subset] += 1.0 
+            #this is same 
+            self.B = WB.softmax(dim=1)            # construct emission distributions p(w | t)
+            self.B[self.eos_t, :] = 0             # EOS_TAG can't emit any column's word
+            self.B[self.bos_t, :] = 0             # BOS_TAG can't emit any column's word
         
         ###
         # Randomly initialize transition probabilities, in a similar way.
@@ -133,10 +183,75 @@ class HiddenMarkovModel:
             # p(t | s) doesn't depend on s. 
             # 
             # By treating a unigram model as a special case of a bigram model,
-            # we can simply use the bigram code for our unigram experiments,
-            # although unfortunately that preserves the O(nk^2) runtime instead
-            # of letting us speed up to O(nk) in the unigram case.
-            self.A = self.A.repeat(self.k, 1)   # copy the single row k times  
+            # we can simply use the bigram code for our unigram experiments.
+            # The matrix is only a view of the single row (expand doesn't copy it),
+            # and the trellis code uses only that row (see _log_params()), which
+            # speeds it up from O(nk^2) to O(nk) in the unigram case.
+            self.A = self.A.expand(self.k, -1)   # view the single row as k rows
+        self._invalidate_log_params()
+
+    def _init_sparse_B(self) -> None:
+        """The sparse version of the random emission probabilities above.  Each tag
+        again prefers a random subset of the words, by a factor of e, but we leave
+        out the small noise on the other words so that they can share a single
+        background probability."""
+        counts = SparseCounts(self.k, self.V)
+        for t in range(self.k):
+            if t in (self.eos_t, self.bos_t):
+                continue
+            word_subset = torch.randperm(self.V)[:self.V // self.k]
+            counts.add(torch.full_like(word_subset, t), word_subset, torch.full((len(word_subset),), exp(1) - 1))
+        smoothing = torch.ones(self.k)
+        smoothing[[self.eos_t, self.bos_t]] = 0   # EOS_TAG and BOS_TAG can't emit any column's word
+        self.B = SparseEmissions.smoothed(counts, smoothing)
+
+    def _log_params(self) -> Tuple[Tensor, Optional[Tensor]]:
+        """Return log A and log B, which are used by all of the trellis algorithms.
+        They are cached, and only recomputed after the parameters change:
+        that is, after _invalidate_log_params(), which is called by the methods that
+        set A and B, or if A or B has been replaced by a different tensor 
+        (test_ic.py assigns them directly).
+        
+        For a unigram model, every row of A is the same, so log A is just the
+        (1, k) row of log p(t).  The trellis methods check self.unigram and use
+        O(nk) recursions with that row instead of O(nk^2) recursions with the matrix.
+        
+        If B is stored sparsely, log B is None: the SparseEmissions object
+        keeps its own log-probabilities (see _emissions()).
+        
+        If only A has been replaced, the cached log B is kept.  (The CRF's sparse
+        updates rely on this: they replace A but edit B and log B column by column.)
+        
+        The cache is a tuple that is replaced in a single assignment, so threads that
+        share the model see a complete old or new cache, never a mixture of the two."""
+        cache = self._log_cache
+        if cache is None or cache[0] is not self.A or cache[1] is not self.B:
+            log_A = torch.log((self.A[:1] if self.unigram else self.A) + 1e-10)
+            if cache is not None and cache[1] is self.B:
+                log_B = cache[3]
+            else:
+                log_B = None if isinstance(self.B, SparseEmissions) else torch.log(self.B + 1e-10)
+            cache = (self.A, self.B, log_A, log_B)
+            self._log_cache = cache
+            self.log_param_computations += 1
+        return cache[2], cache[3]
+
+    def _invalidate_log_params(self) -> None:
+        """Forget the cached log A and log B, because A or B has changed."""
+        self._log_cache: Optional[Tuple[Tensor, Tensor | SparseEmissions, Tensor, Optional[Tensor]]] = None
+
+    def __getstate__(self) -> dict:
+        # don't pickle the cache; it will be recomputed on demand
+        state = self.__dict__.copy()
+        state["_log_cache"] = None
+        state.pop("_profiler", None)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        # models pickled before the cache was added don't have these
+        state.setdefault("_log_cache", None)
+        state.setdefault("log_param_computations", 0)
+        self.__dict__.update(state)
 
     def printAB(self) -> None:
         """Print the A and B matrices in a more human-readable format (tab-separated)."""
@@ -147,10 +262,11 @@ class HiddenMarkovModel:
             row = [str(self.tagset[s])] + [f"{self.A[s,t]:.3f}" for t in range(self.A.size(1))]
             print("\t".join(row))
         print("\nEmission matrix B:")        
-        col_headers = [""] + [str(self.vocab[w]) for w in range(self.B.size(1))]
+        B = self.B.to_dense() if isinstance(self.B, SparseEmissions) else self.B
+        col_headers = [""] + [str(self.vocab[w]) for w in range(B.size(1))]
         print("\t".join(col_headers))
         for t in range(self.A.size(0)):   # rows
-            row = [str(self.tagset[t])] + [f"{self.B[t,w]:.3f}" for w in range(self.B.size(1))]
+            row = [str(self.tagset[t])] + [f"{B[t,w]:.3f}" for w in range(B.size(1))]
             print("\t".join(row))
         print("\n")
 
@@ -169,19 +285,24 @@ class HiddenMarkovModel:
         # we should have seen no "tag -> BOS" or "BOS -> tag" transitions
         assert self.A_counts[:, self.bos_t].any() == 0, 'Your expected transition counts ' \
                 'to BOS are not all zero, meaning you\'ve accumulated them incorrectly!'
-        assert self.A_counts[self.eos_t, :].any() == 0, 'Your expected transition counts ' \
+        assert self.unigram or self.A_counts[self.eos_t, :].any() == 0, 'Your expected transition counts ' \
                 'from EOS are not all zero, meaning you\'ve accumulated them incorrectly!'
 
         # we should have seen no emissions from BOS or EOS tags
-        assert self.B_counts[self.eos_t:self.bos_t, :].any() == 0, 'Your expected emission counts ' \
+        assert not self._B_counts_any(slice(self.eos_t, self.bos_t)), 'Your expected emission counts ' \
                 'from EOS and BOS are not all zero, meaning you\'ve accumulated them incorrectly!'
 
         # emission probabilities (this part works well)
-        self.B_counts[:self.eos_t] += λ
-        row_sums_B = self.B_counts.sum(dim=1, keepdim=True)
-        row_sums_B = torch.where(row_sums_B == 0, torch.ones_like(row_sums_B), row_sums_B)
-        self.B = self.B_counts / row_sums_B
-        self.B[self.eos_t:, :] = 0
+        if isinstance(self.B_counts, SparseCounts):
+            smoothing = torch.full((self.k,), float(λ))
+            smoothing[self.eos_t:] = 0
+            self.B = SparseEmissions.smoothed(self.B_counts, smoothing)
+        else:
+            self.B_counts[:self.eos_t] += λ
+            row_sums_B = self.B_counts.sum(dim=1, keepdim=True)
+            row_sums_B = torch.where(row_sums_B == 0, torch.ones_like(row_sums_B), row_sums_B)
+            self.B = self.B_counts / row_sums_B
+            self.B[self.eos_t:, :] = 0
 
         # transition probabilities maybe overkill for normalization
         if self.unigram:
@@ -189,7 +310,7 @@ class HiddenMarkovModel:
             WA = torch.log(row_counts + 1e-10).unsqueeze(0)
             WA[:, self.bos_t] = -float('inf')
             self.A = WA.softmax(dim=1)
-            self.A = self.A.repeat(self.k, 1)
+            self.A = self.A.expand(self.k, -1)
         else:
             # smoothed copy
             smoothed_A = self.A_counts.clone()
@@ -211,17 +332,36 @@ class HiddenMarkovModel:
 
         # debugging :  probabilities sum to 1 where they should
         A_row_sums = self.A[:self.eos_t].sum(dim=1)
-        B_row_sums = self.B[:self.eos_t].sum(dim=1)
+        B_row_sums = self._B_row_sums()[:self.eos_t]
         assert torch.allclose(A_row_sums, torch.ones_like(A_row_sums), rtol=1e-3), \
             "Transition probabilities don't sum to 1"
         assert torch.allclose(B_row_sums, torch.ones_like(B_row_sums), rtol=1e-3), \
             "Emission probabilities don't sum to 1"
+        self._invalidate_log_params()
         
+    def _B_counts_any(self, rows: slice) -> bool:
+        """Are any of the given rows of B_counts nonzero?"""
+        if isinstance(self.B_counts, SparseCounts):
+            return self.B_counts.any_in_rows(rows)
+        return bool(self.B_counts[rows, :].any())
+
+    def _B_row_sums(self) -> Tensor:
+        """The sum of each row of B, however B is stored."""
+        if isinstance(self.B, SparseEmissions):
+            return self.B.row_sums()
+        return self.B.sum(dim=1)
+
     def _zero_counts(self):
         """Set the expected counts to 0.  
-        (This creates the count attributes if they didn't exist yet.)"""
-        self.A_counts = torch.zeros((self.k, self.k), requires_grad=False)
-        self.B_counts = torch.zeros((self.k, self.V), requires_grad=False)
+        (This creates the count attributes if they didn't exist yet.)
+        
+        A unigram model only needs the expected count of each tag t, regardless
+        of the previous tag, so its A_counts has a single row."""
+        self.A_counts = torch.zeros((1 if self.unigram else self.k, self.k), requires_grad=False)
+        if self.sparse:
+            self.B_counts: Tensor | SparseCounts = SparseCounts(self.k, self.V)
+        else:
+            self.B_counts = torch.zeros((self.k, self.V), requires_grad=False)
 
     def train(self,
               corpus: TaggedCorpus,
@@ -229,14 +369,36 @@ class HiddenMarkovModel:
               λ: float = 0,
               tolerance: float = 0.001,
               max_steps: int = 50000,
-              save_path: Optional[Path|str] = "my_hmm.pkl") -> None:
+              save_path: Optional[Path|str] = "my_hmm.pkl",
+              batch_size: int = 64,
+              workers: int = 1,
+              profiler: Optional[Profiler] = None) -> None:
         """Train the HMM on the given training corpus, starting at the current parameters.
         We will stop when the relative improvement of the development loss,
         since the last epoch, is less than the tolerance.  In particular,
         we will stop when the improvement is negative, i.e., the development loss 
         is getting worse (overfitting).  To prevent running forever, we also
-        stop if we exceed the max number of steps."""
+        stop if we exceed the max number of steps.
+
+        The E step runs forward-backward on batch_size sentences at a time.
+        This doesn't change the result, only the speed.
+
+        If workers > 1, the E step is split across that many processes, each
+        of which handles a fixed shard of the corpus (see _parallel_E_step()).
+        The result can differ from workers=1 by floating-point rounding, since
+        the counts are added up in a different order, but it is the same from
+        run to run with the same number of workers.
+
+        If a profiler is given, it gets the time spent in each phase of training
+        and a report at the end of each epoch (see profiling.py).
+
+        Training works on an integerized copy of the corpus, unless the corpus has
+        already been integerized; either way, the corpus itself isn't changed."""
         
+        if batch_size <= 0:
+            raise ValueError(f"{batch_size=} but should be > 0")
+        if workers <= 0:
+            raise ValueError(f"{workers=} but should be > 0")
         if λ < 0:
             raise ValueError(f"{λ=} but should be >= 0")
         elif λ == 0:
@@ -252,52 +414,185 @@ class HiddenMarkovModel:
             # multiplied by 0 and added into a sum.  A summand of 0 * nan would
             # regrettably turn the entire sum into nan.      
       
-        dev_loss = loss(self)   # evaluate the model at the start of training
+        self._profiler = profiler if profiler is not None else NULL_PROFILER
+        try:
+            self._train_epochs(corpus, loss, λ, tolerance, max_steps, save_path, batch_size, workers)
+        finally:
+            del self._profiler    # back to the class default
+
+    def _train_epochs(self, corpus: TaggedCorpus, loss: Callable[[HiddenMarkovModel], float], λ: float,
+                      tolerance: float, max_steps: int, save_path: Optional[Path|str],
+                      batch_size: int, workers: int) -> None:
+        """The epochs of train(), after it has checked its arguments."""
+        profiler = self._profiler
+        with profiler.phase("integerize"):
+            corpus = self._integerized_corpus(corpus)   # so we don't re-read it on every epoch
+        tokens = corpus.num_tokens() - len(corpus)      # not counting EOS
+
+        # The counts from fully supervised sentences don't depend on the parameters,
+        # so we count them once, and only run the E step on the other sentences.
+        with profiler.phase("counts"):
+            supervised_A_counts, supervised_B_counts, unsupervised = self._supervised_counts(corpus)
+
+        with profiler.phase("initial dev eval"):   # (not "dev eval", which is the epoch's own)
+            dev_loss = loss(self)   # evaluate the model at the start of training
         
         old_dev_loss: float = dev_loss     # loss from the last epoch
         steps: int = 0   # total number of sentences the model has been trained on so far      
-        while steps < max_steps:
-            
-            # E step: Run forward-backward on each sentence, and accumulate the
-            # expected counts into self.A_counts, self.B_counts.
-            #
-            # Note: If you were using a GPU, you could get a speedup by running
-            # forward-backward on several sentences in parallel.  This would
-            # require writing the algorithm using higher-dimensional tensor
-            # operations, allowing PyTorch to take advantage of hardware
-            # parallelism.  For example, you'd update alpha[j-1] to alpha[j] for
-            # all the sentences in the minibatch at once (with appropriate
-            # handling for short sentences of length < j-1).  
-
-            self._zero_counts()
-            for sentence in tqdm(corpus, total=len(corpus), leave=True):
-                isent = self._integerize_sentence(sentence, corpus)
-                self.E_step(isent)
-                steps += 1
-
-            # M step: Update the parameters based on the accumulated counts.
-            self.M_step(λ)
-            if save_path: self.save(save_path)  # save incompletely trained model in case we crash
-            
-            # Evaluate with the new parameters
-            dev_loss = loss(self)   # this will print its own log messages
-            if dev_loss >= old_dev_loss * (1-tolerance):
-                # we haven't gotten much better, so perform early stopping
-                break
-            old_dev_loss = dev_loss            # remember for next eval batch
+        with self._E_step_pool(corpus, workers) as pool:
+            while steps < max_steps:
+                
+                # E step: Run forward-backward on each sentence, and accumulate the
+                # expected counts into self.A_counts, self.B_counts.
+                #
+                # We run forward-backward on a minibatch of sentences in parallel,
+                # using higher-dimensional tensor operations that update alpha[j-1]
+                # to alpha[j] for all the sentences in the minibatch at once (with
+                # masking for short sentences of length < j-1).  
+
+                computations = self.log_param_computations
+                with profiler.phase("E step"):
+                    self._zero_counts()
+                    self._add_counts(supervised_A_counts, supervised_B_counts)
+                    if pool is not None:
+                        self._parallel_E_step(pool, unsupervised, workers, batch_size)
+                    else:
+                        with tqdm(total=len(unsupervised), leave=True) as progress:
+                            for batch in chunked((corpus.integerized_sentence(i) for i in unsupervised), batch_size):
+                                self.E_step_batch(batch)
+                                progress.update(len(batch))
+                steps += len(corpus)
+                profiler.count(len(corpus), tokens)
+
+                # M step: Update the parameters based on the accumulated counts.
+                with profiler.phase("M step"):
+                    self.M_step(λ)
+                if save_path: 
+                    with profiler.phase("checkpoint"):
+                        self.save(save_path)  # save incompletely trained model in case we crash
+                
+                # Evaluate with the new parameters
+                with profiler.phase("dev eval"):
+                    dev_loss = loss(self)   # this will print its own log messages
+                logger.debug(f"Computed log A, log B {self.log_param_computations - computations} times this epoch")
+                profiler.end_epoch(steps=steps, dev_loss=dev_loss)
+                if dev_loss >= old_dev_loss * (1-tolerance):
+                    # we haven't gotten much better, so perform early stopping
+                    break
+                old_dev_loss = dev_loss            # remember for next eval batch
         
         # Save the trained model.
         if save_path: self.save(save_path)
   
-    def _integerize_sentence(self, sentence: Sentence, corpus: TaggedCorpus) -> IntegerizedSentence:
-        """Integerize the words and tags of the given sentence, which came from the given corpus."""
+    def _E_step_pool(self, corpus: TaggedCorpus, workers: int) -> ContextManager[Optional[Pool]]:
+        """A pool of worker processes for the E step, or None if we are to run it
+        in this process.  Each worker gets its own copy of the model and the
+        corpus when it starts (on Linux, they are simply inherited by fork)."""
+        if workers == 1:
+            return nullcontext(None)
+        return torch.multiprocessing.get_context().Pool(workers, initializer=_init_E_step_worker, initargs=(self, corpus))
+
+    def _parallel_E_step(self, pool: Pool, indices: np.ndarray, workers: int, batch_size: int) -> None:
+        """Add the expected counts of the given sentences of the workers' corpus to
+        self.A_counts and self.B_counts, by splitting them into one contiguous shard
+        per worker.  The workers get the current parameters A and B with each shard.
+        Since we are using torch.multiprocessing, those tensors are passed through
+        shared memory rather than copied, and so are the partial counts that come back.
+
+        The partial counts are summed in shard order, not in order of completion, 
+        so the result only depends on the number of workers."""
+        shards = [(self.A, self.B, shard, batch_size) for shard in np.array_split(indices, workers)]
+        with tqdm(total=len(indices), leave=True) as progress:
+            for (_, _, shard, _), (A_counts, B_counts) in zip(shards, pool.imap(_E_step_shard, shards)):
+                self._add_counts(A_counts, B_counts)
+                progress.update(len(shard))
+
+    def _add_counts(self, A_counts: Tensor, B_counts: Tensor | SparseCounts) -> None:
+        """Add counts that were accumulated elsewhere to self.A_counts and self.B_counts."""
+        self.A_counts += A_counts
+        if isinstance(self.B_counts, SparseCounts):
+            assert isinstance(B_counts, SparseCounts)
+            self.B_counts.add(*B_counts.triples())
+        else:
+            self.B_counts += B_counts
+
+    def _supervised_counts(self, corpus: TaggedCorpus, chunk: int = 1 << 20
+                           ) -> Tuple[Tensor, Tensor | SparseCounts, np.ndarray]:
+        """The counts of all the fully supervised sentences of an integerized corpus,
+        computed in closed form with bincount over its flat arrays rather than by
+        the E step.  Also returns the indices of the other sentences, which still
+        need the E step.
+
+        The flat arrays are read `chunk` tokens at a time, so that a big (e.g.
+        memory-mapped) corpus is never copied into memory whole."""
+        assert corpus.word_ids is not None and corpus.tag_ids is not None and corpus.offsets is not None
+        supervised = corpus.supervised_sentences()
+        offsets = np.asarray(corpus.offsets, dtype=np.int64)
+
+        A_counts = torch.zeros((1 if self.unigram else self.k, self.k))
+        B_counts: Tensor | SparseCounts
+        B_counts = SparseCounts(self.k, self.V) if self.sparse else torch.zeros((self.k, self.V))
+        prev_tag = torch.zeros(1, dtype=torch.long)    # the last token of the previous chunk,
+        prev_edge = torch.zeros(1, dtype=torch.bool)   # and whether it transitions to this chunk's first
+        for start in range(0, len(corpus.tag_ids), chunk):
+            tags = torch.from_numpy(corpus.tag_ids[start:start+chunk].astype(np.int64))
+            words = torch.from_numpy(corpus.word_ids[start:start+chunk].astype(np.int64))
+            positions = np.arange(start, start + len(tags))
+            sentence = np.searchsorted(offsets, positions, side='right') - 1   # of each token
+            in_supervised = torch.from_numpy(supervised[sentence])
+            first = torch.from_numpy(positions == offsets[sentence])           # BOS of each sentence
+            last = torch.from_numpy(positions == offsets[sentence + 1] - 1)    # EOS of each sentence
+
+            # emissions at the positions other than BOS and EOS
+            emitting = in_supervised & ~first & ~last
+            emit_tags, emit_words = tags[emitting], words[emitting]
+            if isinstance(B_counts, SparseCounts):
+                keys, counts = torch.unique(emit_tags * self.V + emit_words, return_counts=True)
+                B_counts.add(keys // self.V, keys % self.V, counts.float())
+            else:
+                B_counts += torch.bincount(emit_tags * self.V + emit_words, minlength=self.k * self.V
+                                           ).reshape(self.k, self.V)
+
+            # transitions from each token to the next one in the same sentence,
+            # including the one from the previous chunk's last token
+            chain = torch.cat([prev_tag, tags])
+            edges = torch.cat([prev_edge, in_supervised & ~last])[:-1]
+            prev, nxt = chain[:-1][edges], chain[1:][edges]
+            if self.unigram:
+                A_counts += torch.bincount(nxt, minlength=self.k).reshape(1, self.k)
+            else:
+                A_counts += torch.bincount(prev * self.k + nxt, minlength=self.k * self.k).reshape(self.k, self.k)
+            prev_tag, prev_edge = tags[-1:], (in_supervised & ~last)[-1:]
 
-        if corpus.tagset != self.tagset or corpus.vocab != self.vocab:
-            # Sentence comes from some other corpus that this HMM was not set up to handle.
-            raise TypeError("The corpus that this sentence came from uses a different tagset or vocab")
+        return A_counts, B_counts, np.flatnonzero(~supervised)
 
+    def _integerize_sentence(self, sentence: Sentence, corpus: TaggedCorpus) -> IntegerizedSentence:
+        """Integerize the words and tags of the given sentence, which came from the given corpus."""
+        self._check_corpus(corpus)
         return corpus.integerize_sentence(sentence)
 
+    def _integerize_sentences(self, sentences: Sequence[Sentence], corpus: TaggedCorpus) -> List[IntegerizedSentence]:
+        """Integerize a minibatch of sentences from the given corpus, checking the corpus only once."""
+        self._check_corpus(corpus)
+        return [corpus.integerize_sentence(sentence) for sentence in sentences]
+
+    def _check_corpus(self, corpus: TaggedCorpus) -> None:
+        """Make sure that integers from the given corpus mean the same thing to this HMM.
+        Usually the corpus shares our integerizers; otherwise we compare their
+        fingerprints, which are cached, so this takes constant time either way."""
+        for ours, theirs in ((self.tagset, corpus.tagset), (self.vocab, corpus.vocab)):
+            if theirs is not ours and (len(theirs) != len(ours) or theirs.fingerprint() != ours.fingerprint()):
+                # Sentence comes from some other corpus that this HMM was not set up to handle.
+                raise TypeError("The corpus that this sentence came from uses a different tagset or vocab")
+
+    def _integerized_corpus(self, corpus: TaggedCorpus) -> TaggedCorpus:
+        """Integerize the corpus once (if it wasn't already), so that training
+        can iterate over its integerized sentences with no string processing.
+        The caller's corpus isn't changed: if it wasn't integerized, we get an
+        integerized copy (see TaggedCorpus.integerized())."""
+        self._check_corpus(corpus)
+        return corpus.integerized()
+
     @typechecked
     def logprob(self, sentence: Sentence, corpus: TaggedCorpus) -> TorchScalar:
         """Compute the log probability of a single sentence under the current
@@ -312,107 +607,146 @@ class HiddenMarkovModel:
         correctly."""
 
         # Integerize the words and tags of the given sentence, which came from the given corpus.
-        isent = self._integerize_sentence(sentence, corpus)
-        return self.forward_pass(isent) # (Z(w))
+        # This is just a minibatch of size 1.
+        return self.logprob_batch([sentence], corpus)[0] # (Z(w))
+
+    @typechecked
+    def logprob_batch(self, sentences: List[Sentence], corpus: TaggedCorpus) -> TorchBatch:
+        """Compute the log probabilities of a minibatch of sentences at once, as
+        a vector with one entry per sentence.  Each entry is what logprob() would
+        return for that sentence, but the forward algorithm runs on the whole
+        minibatch together (see forward_batch())."""
+
+        isents = self._integerize_sentences(sentences, corpus)
+        return self.forward_batch(isents)
 
-    def E_step(self, isent: IntegerizedSentence, mult: float = 1) -> None:
+    def E_step(self, isent: IntegerizedSentence | IntegerizedView, mult: float = 1) -> None:
         """Runs the forward backward algorithm on the given sentence. The forward step computes
         the alpha probabilities.  The backward step computes the beta probabilities and
         adds expected counts to self.A_counts and self.B_counts.  
         
         The multiplier `mult` says how many times to count this sentence. 
         
-        When the logging level is set to DEBUG, the alpha and beta vectors and posterior counts
-        are logged.  You can check this against the ice cream spreadsheet."""
-        
-
-        #we run the forward pass for alpha and logZ
-        # originally this caused me some trouble bc i thought we would have to save something 
-        # here, but this is just an internal update !
-
-        self.forward_pass(isent)
-
-        # we run backward for beta and expected counts w the updated values :)
-        self.backward_pass(isent, mult)
-
-        # check that the two values are close 
-        #if not torch.isclose(self.log_Z, log_Z_backward, atol=1e-5):
-            #print(f"Warning: log_Z from forward pass ({self.log_Z.item()}) and backward pass ({log_Z_backward.item()}) do not match.")
-
-        # no need to return anything everything is in the model 
-
-        #for count accum 
-        word_ids = torch.tensor([w for w, _ in isent], dtype=torch.long)
-        tag_ids = torch.tensor([t if t is not None else -1 for _, t in isent], dtype=torch.long)
-        T = len(word_ids) - 2
-
-       # Create mask for valid tags once
-        valid_mask = torch.ones(self.k, dtype=torch.bool)
-        valid_mask[self.bos_t] = False
-        valid_mask[self.eos_t] = False
-        valid_indices = torch.where(valid_mask)[0]
-
-        log_A = torch.log(self.A + 1e-10)
-        log_B = torch.log(self.B + 1e-10)
-
-        for j in range(1, T + 1):  # skip BOS position
-            word_id = word_ids[j]
-            tag_id = tag_ids[j]
-
-            # all of these have two cases, for supervised and for unsupervised 
-            if tag_id != -1:  # supervised # don't need to use alpha and beta probabilities, there's only one path through the trellis 
-                self.B_counts[tag_id, word_id] += mult
-                if j < T and tag_ids[j+1] != -1:
-                    self.A_counts[tag_id, tag_ids[j+1]] += mult
-            else:  # unsupervised # need to use alpha and beta probabilities 
-                # emission probabilities
-                log_posterior = self.alpha[j, valid_indices] + self.beta[j, valid_indices] - self.log_Z # probability of getting the
-                posterior = torch.exp(log_posterior)
-                self.B_counts[valid_indices, word_id] += mult * posterior
-
-                # transition probabilities
-                if j < T:
-                    next_word = word_ids[j + 1]
-                    next_tag = tag_ids[j+1]
-
-                    if next_tag != -1:
-                        log_posterior = (self.alpha[j, valid_indices] +
-                                        log_A[valid_indices, next_tag] +
-                                        log_B[next_tag, next_word] +
-                                        self.beta[j + 1, next_tag] -
-                                        self.log_Z)
-                        posterior = torch.exp(log_posterior)
-                        self.A_counts[valid_indices, next_tag] += mult * posterior
-                    else:  
-                        # All valid current tags to all valid next tags
-                        for curr_tag in valid_indices:
-                            log_posterior = (self.alpha[j, curr_tag] +
-                                        log_A[curr_tag, valid_indices] +
-                                        log_B[valid_indices, next_word] +
-                                        self.beta[j + 1, valid_indices] -
-                                        self.log_Z)
-                            posterior = torch.exp(log_posterior)
-                            self.A_counts[curr_tag, valid_indices] += mult * posterior
-
-        # BOS transitions
-        if tag_ids[1] != -1: 
-            self.A_counts[self.bos_t, tag_ids[1]] += mult
+        This is just E_step_batch() on a minibatch of size 1."""
+        self.E_step_batch([isent], mult)
+
+    def E_step_batch(self, isents: Sequence[IntegerizedSentence | IntegerizedView], mult: float = 1) -> None:
+        """Run forward-backward on a whole minibatch of sentences at once and add
+        their expected counts to self.A_counts and self.B_counts.
+
+        Each sentence may be supervised, partly supervised, or raw.  A fully supervised 
+        sentence has only one path, whose counts are added directly (see _add_path_counts()).  
+        The other sentences go through forward-backward with their known tags clamped
+        (see _clamped_emissions()), so the posterior at a position with a known tag is 
+        one-hot, and the posteriors elsewhere take the known tags into account."""
+
+        if not isents:
+            return
+        word_ids, tag_ids, lengths = self._pad_batch(isents)
+        supervised = self._supervised(tag_ids, lengths)
+        if supervised.any():
+            with self._profiler.phase("counts"):
+                self._add_path_counts(word_ids[supervised], tag_ids[supervised], lengths[supervised], mult)
+        if not supervised.all():
+            rest = ~supervised
+            self._add_expected_counts(word_ids[rest], tag_ids[rest], lengths[rest], mult)
+
+    def _supervised(self, tag_ids: Int[Tensor, "batch n"], lengths: Int[Tensor, "batch"]) -> Tensor:
+        """Boolean vector saying which sentences of a padded minibatch have all their tags."""
+        in_sent = torch.arange(tag_ids.size(1)) < lengths.unsqueeze(1)
+        return ((tag_ids >= 0) | ~in_sent).all(dim=1)
+
+    def _path_tags(self, tag_ids: Int[Tensor, "batch n"], lengths: Int[Tensor, "batch"]) -> Int[Tensor, "batch n+2"]:
+        """The tags at positions 0 .. n+1 of each sentence, including BOS and EOS.
+        Beyond EOS, the padding is EOS too."""
+        batch, max_len = tag_ids.shape
+        in_sent = torch.arange(max_len) < lengths.unsqueeze(1)
+        tags = torch.full((batch, max_len + 2), self.eos_t, dtype=torch.long)
+        tags[:, 0] = self.bos_t
+        tags[:, 1:-1] = torch.where(in_sent, tag_ids, self.eos_t)
+        return tags
+
+    def _add_path_counts(self, word_ids: Int[Tensor, "batch n"], tag_ids: Int[Tensor, "batch n"], 
+                         lengths: Int[Tensor, "batch"], mult: float) -> None:
+        """Add the counts of fully supervised sentences, which are just the counts of
+        the transitions and emissions along their tag paths."""
+        batch, max_len = word_ids.shape
+        in_sent = torch.arange(max_len) < lengths.unsqueeze(1)
+        words, tags = word_ids[in_sent], tag_ids[in_sent]
+        if isinstance(self.B_counts, SparseCounts):
+            self.B_counts.add(tags, words, torch.full((len(words),), float(mult)))
         else:
-            log_posterior = (log_A[self.bos_t, valid_indices] +
-                            log_B[valid_indices, word_ids[1]] +
-                            self.beta[1, valid_indices] -
-                            self.log_Z)
-            posterior = torch.exp(log_posterior)
-            self.A_counts[self.bos_t, valid_indices] += mult * posterior
-
-        # EOS transitions
-        if tag_ids[T] != -1:  
-            self.A_counts[tag_ids[T], self.eos_t] += mult
+            self.B_counts.index_put_((tags, words), torch.full((len(words),), float(mult)), accumulate=True)
+
+        path = self._path_tags(tag_ids, lengths)
+        edge = torch.arange(max_len + 1) <= lengths.unsqueeze(1)     # edges (j, j+1) for j = 0 .. n
+        cur, nxt = path[:, :-1][edge], path[:, 1:][edge]
+        self.A_counts.index_put_((torch.zeros_like(cur) if self.unigram else cur, nxt),
+                                 torch.full((len(cur),), float(mult)), accumulate=True)
+
+    def _add_expected_counts(self, word_ids: Int[Tensor, "batch n"], tag_ids: Int[Tensor, "batch n"], 
+                             lengths: Int[Tensor, "batch"], mult: float) -> TorchBatch:
+        """Add the expected counts of a minibatch of raw or partly supervised sentences,
+        by running forward-backward with their known tags clamped.  Returns the
+        log Z of each sentence, which the forward pass computed along the way."""
+        with self._profiler.phase("forward-backward"):
+            emit = self._clamped_emissions(word_ids, tag_ids)
+            alpha, log_Z = self._forward_trellis(emit, lengths)
+            beta = self._backward_trellis(emit, lengths)
+        with self._profiler.phase("counts"):
+            self._add_posterior_counts(word_ids, lengths, emit, alpha, beta, log_Z, mult)
+        return log_Z
+
+    def _add_posterior_counts(self, word_ids: Int[Tensor, "batch n"], lengths: Int[Tensor, "batch"],
+                              emit: Float[Tensor, "batch n k"], alpha: Float[Tensor, "batch n+1 k"],
+                              beta: Float[Tensor, "batch n+1 k"], log_Z: TorchBatch, mult: float) -> None:
+        """The second half of _add_expected_counts(): add the posterior counts
+        that come from the trellises of forward-backward."""
+        batch, max_len = word_ids.shape
+        log_A, _ = self._log_params()
+
+        valid = self._valid_mask()   # tags other than BOS, EOS
+        positions = torch.arange(max_len + 1)
+        in_sent = positions[1:] <= lengths.unsqueeze(1)          # (batch, n): real words
+
+        # Emission counts at positions 1 .. n: the posterior p(t_j = t | w),
+        # which is one-hot where the tag is known.
+        log_post = alpha[:, 1:] + beta[:, 1:] - log_Z[:, None, None]
+        post = torch.where(valid, log_post.exp(), torch.zeros(()))
+        if isinstance(self.B_counts, SparseCounts):
+            self.B_counts.add_columns(word_ids[in_sent], mult * post[in_sent])
         else:
-            log_posterior = self.alpha[T, valid_indices] + log_A[valid_indices, self.eos_t] - self.log_Z
-            posterior = torch.exp(log_posterior)
-            self.A_counts[valid_indices, self.eos_t] += mult * posterior
-    
+            self.B_counts.index_add_(1, word_ids[in_sent], mult * post[in_sent].T)
+
+        # Transition counts for the edges (j, j+1), j = 0 .. n, where position n+1 is EOS.
+        # Each edge gets the posterior
+        #     p(t_j = s, t_j+1 = t | w) = exp(alpha[j,s] + log A[s,t] + log B[t,w_j+1] + beta[j+1,t] - log Z),
+        # which factors as an outer product of a left vector over s and a right vector over t.
+        # Summing those outer products over every edge in the minibatch is a single
+        # (k × edges) @ (edges × k) contraction, which is finally multiplied elementwise by A.
+        left = torch.where(valid, alpha, float('-inf'))
+        left[:, 0] = alpha[:, 0]                                  # BOS
+
+        right = torch.full((batch, max_len + 1, self.k), float('-inf'))
+        right[:, :-1] = emit + beta[:, 1:]
+        right = torch.where(valid, right, float('-inf'))
+        right[torch.arange(batch), lengths] = torch.where(torch.arange(self.k) == self.eos_t, 0.0, float('-inf'))
+        right = right - log_Z[:, None, None]
+
+        edge = positions <= lengths.unsqueeze(1)                  # (batch, n+1)
+        left, right = left[edge], right[edge]                    # (edges, k)
+        left_max = left.max(dim=1, keepdim=True).values.clamp(min=-1e30)
+        right_max = right.max(dim=1, keepdim=True).values.clamp(min=-1e30)
+        scale = (left_max + right_max).exp()                     # rescale each edge after exponentiating
+        if self.unigram:
+            # A[s,t] = p(t) doesn't depend on s, so we only need the column sums of the
+            # outer products, which we get by summing each left vector first: O(edges × k).
+            inner = (scale * (left - left_max).exp()).sum(dim=1) @ (right - right_max).exp()
+            self.A_counts += mult * log_A.exp() * inner
+        else:
+            outer = (scale * (left - left_max).exp()).T @ (right - right_max).exp()
+            self.A_counts += mult * log_A.exp() * outer
+
     @typechecked
     def forward_pass(self, isent: IntegerizedSentence) -> TorchScalar:
         """Run the forward algorithm from the handout on a tagged, untagged, 
@@ -420,201 +754,429 @@ class HiddenMarkovModel:
         probability) as a TorchScalar.  If the sentence is not fully tagged, the 
         forward probability will marginalize over all possible tags.  
         
-        As a side effect, remember the alpha probabilities and log_Z
-        (store some representation of them into attributes of self)
-        so that they can subsequently be used by the backward pass."""
-        
-        # The "nice" way to construct the sequence of vectors alpha[0],
-        # alpha[1], ...  is by appending to a List[Tensor] at each step.
-        # But to better match the notation in the handout, we'll instead
-        # preallocate a list alpha of length n+2 so that we can assign 
-        # directly to each alpha[j] in turn.
+        This doesn't store alpha on the model.  To get the alpha and beta vectors,
+        use forward_backward(), which returns them instead."""
         
-        # extract word IDs excluding BOS and EOS
-        word_ids = torch.tensor([w for w, _ in isent[1:-1]], dtype=torch.long)  # exclude BOS and EOS
-        T = len(word_ids) + 1  
-
-        alpha = torch.full((T,self.k), float('-inf'))
-        # initial alpha for BOS, log(1)
-        alpha[0, self.bos_t] = 0.0 
-        
-        #valid_tags = [t for t in range(self.k) if t != self.bos_t and t != self.eos_t]
-
-        log_A = torch.log(self.A + 1e-10)
-        log_B = torch.log(self.B + 1e-10)
-
-        #scaling as in other functions
-        #scaling_factors  = []
-
-        # Forward pass
-        for t in range(1, T):
-        
-            # Compute alpha[t] for all states
-            alpha_t = torch.logsumexp(alpha[t-1].unsqueeze(1) + log_A, dim=0)
-            alpha_t[self.bos_t] = float('-inf')
-            alpha[t] = alpha_t + log_B[:, word_ids[t-1]]
-
-            # scaling to prevent underflow
-            #max_alpha = torch.max(alpha_t)
-            #alpha[t] = alpha_t - max_alpha
-            #scaling_factors.append(max_alpha)
-
-        #  log probability (log Z) is alpha at EOS position plus scaling
-        self.log_Z = torch.logsumexp(alpha[T-1] + log_A[:, self.eos_t], dim=0)
-
-        #  alpha for backward pass
-        self.alpha = alpha
-        #self.scaling_factors = scaling_factors
-
-            # Note: once you have this working on the ice cream data, you may
-            # have to modify this design slightly to avoid underflow on the
-            # English tagging data. See section C in the reading handout.
+        # This is just the batched forward algorithm on a minibatch of size 1.
+        word_ids, tag_ids, lengths = self._pad_batch([isent])
+        _, log_Z = self._forward_trellis(self._clamped_emissions(word_ids, tag_ids), lengths)
+        return log_Z[0]
+
+    def forward_backward(self, isents: Sequence[IntegerizedSentence | IntegerizedView],
+                         clamp: bool = True) -> ForwardBackward:
+        """Run the forward and backward algorithms on a minibatch of integerized
+        sentences and return the trellises.  This never changes the model, so one
+        model can serve several threads at once.
+
+        Known tags are clamped (see _clamped_emissions()), so that the result
+        marginalizes over the unknown tags only.  The decoders pass clamp=False,
+        since they ignore the tags of their input."""
+        word_ids, tag_ids, lengths = self._pad_batch(isents)
+        emit = self._clamped_emissions(word_ids, tag_ids) if clamp else self._emissions(word_ids)
+        alpha, log_Z = self._forward_trellis(emit, lengths)
+        beta = self._backward_trellis(emit, lengths)
+        return ForwardBackward(word_ids, lengths, alpha, beta, log_Z)
+
+    def _pad_batch(self, isents: Sequence[IntegerizedSentence | IntegerizedView]
+                   ) -> Tuple[Int[Tensor, "batch n"], Int[Tensor, "batch n"], Int[Tensor, "batch"]]:
+        """Pad a minibatch of integerized sentences into rectangular tensors.
+        Returns the word ids and tag ids of the words between BOS and EOS, as
+        (batch, max_len) tensors, along with the length n of each sentence.
+        Unknown tags are NO_TAG (-1); padding positions hold word 0 and NO_TAG and are
+        ignored by the callers (use the lengths to build a mask).
+
+        The sentences may be lists of (word, tag) pairs or views into an
+        integerized corpus; the latter are copied without any Python-level loop."""
+        lengths = [len(isent) - 2 for isent in isents]
+        max_len = max(lengths, default=0)
+        word_ids = np.zeros((len(isents), max_len), dtype=np.int64)
+        tag_ids = np.full((len(isents), max_len), NO_TAG, dtype=np.int64)
+        for b, isent in enumerate(isents):
+            n = lengths[b]
+            if isinstance(isent, IntegerizedView):
+                word_ids[b, :n] = isent.words[1:-1]
+                tag_ids[b, :n] = isent.tags[1:-1]
+            elif n > 0:
+                word_ids[b, :n] = [w for w, _ in isent[1:-1]]
+                tag_ids[b, :n] = [NO_TAG if t is None else t for _, t in isent[1:-1]]
+        return (torch.as_tensor(word_ids), torch.as_tensor(tag_ids), 
+                torch.as_tensor(lengths, dtype=torch.long))
+
+    def _emissions(self, word_ids: Int[Tensor, "batch n"]) -> Float[Tensor, "batch n k"]:
+        """Gather the emission log-probabilities log B[t, w] of every word in a padded
+        minibatch, for all tags t, with a single index_select on log B.  The trellis
+        code then reads emit[b, j-1] at position j of sentence b, rather than indexing 
+        into the full (k, V) matrix at every step."""
+        batch, max_len = word_ids.shape
+        if isinstance(self.B, SparseEmissions):
+            columns = self.B.log_columns(word_ids.reshape(-1))
+        else:
+            _, log_B = self._log_params()
+            assert log_B is not None
+            columns = torch.index_select(log_B, 1, word_ids.reshape(-1)).T
+        return columns.reshape(batch, max_len, self.k)
+
+    def _clamped_emissions(self, word_ids: Int[Tensor, "batch n"], tag_ids: Int[Tensor, "batch n"]) -> Float[Tensor, "batch n k"]:
+        """Like _emissions(), but at each position with a known tag, every other tag 
+        gets an emission log-probability of -inf.  This clamps the trellis to the
+        known tags: the paths through any other tag there get probability 0."""
+        emit = self._emissions(word_ids)
+        other = (tag_ids >= 0).unsqueeze(2) & (torch.arange(self.k) != tag_ids.unsqueeze(2))
+        return emit.masked_fill(other, float('-inf'))
+
+    def _forward_trellis(self, emit: Float[Tensor, "batch n k"], lengths: Int[Tensor, "batch"]
+                         ) -> Tuple[Float[Tensor, "batch n+1 k"], TorchBatch]:
+        """The forward algorithm on a padded minibatch.  This is the same
+        recursion as forward_pass(), but alpha[:, j] is updated for every
+        sentence in the minibatch with one set of tensor operations.
+
+        Returns alpha, where alpha[b, j] is the alpha vector at position j of
+        sentence b (position 0 is BOS), along with the vector of log Z values.
+        Positions beyond a sentence's length hold junk from the padding words;
+        they never feed back into that sentence's log Z."""
+
+        batch, max_len, _ = emit.shape
+        log_A, _ = self._log_params()
+
+        alpha = torch.full((batch, max_len + 1, self.k), float('-inf'))
+        alpha[:, 0, self.bos_t] = 0.0
+        for j in range(1, max_len + 1):
+            if self.unigram:
+                # log A[s,t] = log p(t) for all s, so sum out the previous tag first
+                alpha_j = torch.logsumexp(alpha[:, j-1], dim=1, keepdim=True) + log_A
+            else:
+                # (batch, k, 1) + (k, k), summing out the previous tag
+                alpha_j = torch.logsumexp(alpha[:, j-1].unsqueeze(2) + log_A, dim=1)
+            alpha_j[:, self.bos_t] = float('-inf')
+            alpha[:, j] = alpha_j + emit[:, j-1]
 
-        return self.log_Z
+        # each sentence transitions to EOS from its own final position
+        final = alpha[torch.arange(batch), lengths]
+        if self.unigram:
+            log_Z = torch.logsumexp(final, dim=1) + log_A[0, self.eos_t]
+        else:
+            log_Z = torch.logsumexp(final + log_A[:, self.eos_t], dim=1)
+        return alpha, log_Z
+
+    def forward_batch(self, isents: Sequence[IntegerizedSentence | IntegerizedView]) -> TorchBatch:
+        """Run the forward algorithm on a minibatch of integerized sentences,
+        which are padded to a common length.  Return a vector of log Z values,
+        one per sentence, each matching what forward_pass() would return.
+        (Unlike forward_pass(), this doesn't store alpha on the model.)
+
+        Fully supervised sentences have only one path, so they are scored directly
+        (see _path_logprob()) instead of by the forward algorithm."""
+        if not isents:
+            return torch.zeros(0)
+        word_ids, tag_ids, lengths = self._pad_batch(isents)
+        supervised = self._supervised(tag_ids, lengths)
+        log_Z = torch.empty(len(isents))
+        if supervised.any():
+            log_Z[supervised] = self._path_logprob(word_ids[supervised], tag_ids[supervised], lengths[supervised])
+        if not supervised.all():
+            rest = ~supervised
+            _, log_Z[rest] = self._forward_trellis(self._clamped_emissions(word_ids[rest], tag_ids[rest]), lengths[rest])
+        return log_Z
+
+    def _path_logprob(self, word_ids: Int[Tensor, "batch n"], tag_ids: Int[Tensor, "batch n"], 
+                      lengths: Int[Tensor, "batch"]) -> TorchBatch:
+        """The log-probability of the tag path of each fully supervised sentence in 
+        a padded minibatch: the sum of its transition and emission log-probabilities."""
+        batch, max_len = word_ids.shape
+        log_A, _ = self._log_params()
+        in_sent = torch.arange(max_len) < lengths.unsqueeze(1)
+        emit = self._emissions(word_ids).gather(2, tag_ids.clamp(min=0).unsqueeze(2)).squeeze(2)
+
+        path = self._path_tags(tag_ids, lengths)
+        edge = torch.arange(max_len + 1) <= lengths.unsqueeze(1)
+        trans = log_A[0 if self.unigram else path[:, :-1], path[:, 1:]]
+        return (torch.where(edge, trans, 0.0).sum(dim=1) + torch.where(in_sent, emit, 0.0).sum(dim=1))
+
+    def _backward_trellis(self, emit: Float[Tensor, "batch n k"], lengths: Int[Tensor, "batch"]
+                          ) -> Float[Tensor, "batch n+1 k"]:
+        """The backward algorithm on a padded minibatch, as in backward_pass().
+        Returns beta, where beta[b, j] is the beta vector at position j of sentence b.
+        Each sentence starts its recursion at its own final position, so positions
+        beyond a sentence's length are junk.  At position 0, only the BOS tag has
+        a finite beta, which is log Z."""
+
+        batch, max_len, _ = emit.shape
+        log_A, _ = self._log_params()
+
+        valid = self._valid_mask()                         # the tags at positions 1 .. n
+        bos = torch.arange(self.k) == self.bos_t           # the tag at position 0
+        if self.unigram:
+            log_A_valid = torch.where(valid, log_A, float('-inf'))
+        else:
+            # transitions between tags at positions 1 .. n, and from BOS at position 0
+            log_A_valid = torch.where(valid.unsqueeze(1) & valid, log_A, float('-inf'))
+            log_A_bos = torch.where(bos.unsqueeze(1) & valid, log_A, float('-inf'))
+
+        beta = torch.full((batch, max_len + 1, self.k), float('-inf'))
+        for j in range(max_len, -1, -1):
+            here = valid if j > 0 else bos
+            if j < max_len:
+                nxt = emit[:, j] + beta[:, j+1]
+                if self.unigram:
+                    # the sum over the next tag is the same for every previous tag
+                    total = torch.logsumexp(log_A_valid + nxt, dim=1, keepdim=True)
+                    beta[:, j] = torch.where(here, total, float('-inf'))
+                else:
+                    # (k, k) + (batch, 1, k), summing out the next tag
+                    beta[:, j] = torch.logsumexp((log_A_valid if j > 0 else log_A_bos) + nxt.unsqueeze(1), dim=2)
+            # transitions to EOS, for the sentences that end here
+            beta[lengths == j, j] = torch.where(here, log_A[:, self.eos_t], float('-inf'))
+        return beta
 
     @typechecked
     def backward_pass(self, isent: IntegerizedSentence, mult: float = 1) -> TorchScalar:
         """
-        We wanted this to work for supervised, semi-supervised, and unsupervised data."""
-        word_ids = torch.tensor([w for w, _ in isent], dtype=torch.long)
-        T = len(word_ids) - 2  # exclude BOS and EOS
- 
-
-        # pre comp these for faster alg 
-        log_A = torch.log(self.A + 1e-10)
-        log_B = torch.log(self.B + 1e-10)
-
-        beta = torch.full((T + 2, self.k), float('-inf'))
-        beta[-1, self.eos_t] = 0.0
-
-        # Create mask for valid tags
-        valid_mask = torch.ones(self.k, dtype=torch.bool)
-        valid_mask[self.bos_t] = False
-        valid_mask[self.eos_t] = False
-        valid_indices = torch.where(valid_mask)[0]
-        
-        # Handle T position first (transitions to EOS)
-        beta[T, valid_indices] = log_A[valid_indices, self.eos_t]
-        
-        # backward pass with scaling
-        for j in range(T, -1, -1):
-            next_word = word_ids[j+1]
-
-            if j == T:
-                beta[j, valid_indices] = log_A[valid_indices, self.eos_t]
-            else:
-                trans_scores = (log_A[valid_indices][:, valid_indices] + 
-                            log_B[valid_indices, next_word].unsqueeze(0) + 
-                            beta[j + 1, valid_indices].unsqueeze(0))
-                
-                beta[j, valid_indices] = torch.logsumexp(trans_scores, dim=1)
-
-            #if j < T :  # don't scale at position 0
-               #beta[j] = beta[j] - self.scaling_factors[j]
-            
-        self.beta = beta 
-
-        return torch.logsumexp(beta[0], dim=0)
+        We wanted this to work for supervised, semi-supervised, and unsupervised data.
+        Like forward_pass(), this doesn't store beta on the model; see forward_backward()."""
+        # This is just the batched backward algorithm on a minibatch of size 1.
+        word_ids, tag_ids, lengths = self._pad_batch([isent])
+        beta = self._backward_trellis(self._clamped_emissions(word_ids, tag_ids), lengths)[0]
+        return beta[0, self.bos_t]
 
 
     def viterbi_tagging(self, sentence: Sentence, corpus: TaggedCorpus) -> Sentence:
         """Find the most probable tagging for the given sentence, according to the
-        current model."""
-
+        current model.  Like the other inference methods, this doesn't change the 
+        model, so it can be called from several threads at once."""
+        return self.viterbi_tagging_batch([sentence], corpus)[0]
+
+    def viterbi_tagging_batch(self, sentences: List[Sentence], corpus: TaggedCorpus) -> List[Sentence]:
+        """Find the most probable tagging for each sentence in a minibatch.
+        The Viterbi trellises of all the sentences are computed together and
+        then backtracked together (see _viterbi_tags())."""
+
+        # We'll start by integerizing the input Sentences.  We deintegerize the
+        # tags again when constructing the return value, since downstream methods
+        # like eval_tagging will expect Sentence objects.
+        if not sentences:
+            return []
+        isents = self._integerize_sentences(sentences, corpus)
+        word_ids, _, lengths = self._pad_batch(isents)
+        tags = self._viterbi_tags(self._emissions(word_ids), lengths)
+        return [self._tagged_sentence(sentence, tags[b]) for b, sentence in enumerate(sentences)]
+
+    def _viterbi_tags(self, emit: Float[Tensor, "batch n k"], lengths: Int[Tensor, "batch"]) -> Int[Tensor, "batch n"]:
+        """Run Viterbi on a padded minibatch and return the best tag ids at each
+        position (padding positions are junk)."""
 
         # Note: This code is mainly copied from the forward algorithm.
         # We just switch to using max, and follow backpointers.
         # The code continues to use the name alpha, rather than \hat{alpha}
         # as in the handout.
 
-        # We'll start by integerizing the input Sentence. You'll have to
-        # deintegerize the words and tags again when constructing the return
-        # value, since the type annotation on this method says that it returns a
-        # Sentence object, and that's what downstream methods like eval_tagging
-        # will expect.  (Running mypy on your code will check that your code
-        # conforms to the type annotations ...)
-
-        isent = self._integerize_sentence(sentence, corpus)
-        n = len(isent) - 2  # exclude BOS and EOS
-        
-        word_ids = torch.tensor([w for w, _ in isent[1:-1]], dtype=torch.long)
-        log_A = torch.log(torch.where(self.A > 0, self.A, torch.tensor(1e-10)))
-        log_B = torch.log(torch.where(self.B > 0, self.B, torch.tensor(1e-10)))
-        
-        # exclusing BOS and EOS valid tag mask  
-        valid_mask = torch.ones(self.k, dtype=torch.bool)
-        valid_mask[self.bos_t] = False
-        valid_mask[self.eos_t] = False
-        valid_indices = torch.where(valid_mask)[0]
-        
-        alpha = torch.full((n + 2, self.k), float('-inf'))
-        backpointers = torch.full((n + 2, self.k), -1, dtype=torch.long)
-
-        # (log probability of 1)
-        alpha[0, self.bos_t] = 0.0
+        batch, max_len, _ = emit.shape
+        log_A, _ = self._log_params()
 
-        # for position 1, first word after BOS handle more efficiently 
-        word_id = word_ids[0]
-        scores_1 = log_A[self.bos_t, valid_indices] + log_B[valid_indices, word_id]
-        alpha[1, valid_indices] = scores_1
-        backpointers[1, valid_indices] = self.bos_t
-
-        for j in range(2, n + 1):  # Positions 2 to n
-            word_id = word_ids[j-1]
-        
-            # all possible transitions at once [prev_tags, curr_tags]
-            scores = (alpha[j-1, valid_indices].unsqueeze(1) +  
-                    log_A[valid_indices][:, valid_indices] +   
-                    log_B[valid_indices, word_id])            
-            
-            # best previous tag for each current tag
-            max_scores, best_prev = torch.max(scores, dim=0)  # max along previous tags
-
-            alpha[j, valid_indices] = max_scores
-            backpointers[j, valid_indices] = valid_indices[best_prev]
-
-        # transition to EOS at position n+1, more efficient
-        final_scores = alpha[n, valid_indices] + log_A[valid_indices, self.eos_t]
-        max_final_score, best_final = torch.max(final_scores, dim=0)
-        alpha[n + 1, self.eos_t] = max_final_score
-        backpointers[n + 1, self.eos_t] = valid_indices[best_final]
-
-        # backtracking
-        tags = []
-        current_tag = self.eos_t
-        for j in range(n + 1, 0, -1):
-            prev_tag = backpointers[j, current_tag].item()
-            if j != n + 1:  # don't include EOS tag
-                tags.insert(0, current_tag)
-            current_tag = prev_tag
-
-        # now include BOS and EOS
+        # exclude BOS and EOS from the tags at positions 1 .. n
+        valid = self._valid_mask()
+        if not self.unigram:
+            log_A_valid = torch.where(valid.unsqueeze(1) & valid, log_A, float('-inf'))
+        rows = torch.arange(batch)
+
+        alpha = torch.full((batch, self.k), float('-inf'))
+        backpointers = torch.zeros((batch, max_len + 1, self.k), dtype=torch.long)
+        best_last = torch.zeros(batch, dtype=torch.long)   # best tag at each sentence's position n
+        for j in range(1, max_len + 1):
+            if j == 1:
+                # position 1 follows BOS
+                alpha = torch.where(valid, log_A[0 if self.unigram else self.bos_t] + emit[:, 0], float('-inf'))
+                backpointers[:, 1] = self.bos_t
+            elif self.unigram:
+                # the best previous tag is the same for every current tag
+                best, backpointers[:, j] = torch.max(alpha, dim=1, keepdim=True)
+                alpha = torch.where(valid, best + log_A, float('-inf')) + emit[:, j-1]
+            else:
+                # all possible transitions at once [batch, prev_tags, curr_tags]
+                scores = alpha.unsqueeze(2) + log_A_valid
+                alpha, backpointers[:, j] = torch.max(scores, dim=1)   # max along previous tags
+                alpha = alpha + emit[:, j-1]
+
+            # transition to EOS, for the sentences that end here
+            ending = lengths == j
+            if ending.any():
+                final_scores = alpha[ending] + log_A[:, self.eos_t]
+                best_last[ending] = torch.where(valid, final_scores, float('-inf')).argmax(dim=1)
+
+        # backtracking, for all sentences at once: each sentence starts
+        # from its own best final tag when we reach its position n
+        tags = torch.zeros((batch, max_len), dtype=torch.long)
+        current = best_last
+        for j in range(max_len, 0, -1):
+            current = torch.where(lengths == j, best_last, current)
+            tags[:, j-1] = current
+            current = backpointers[rows, j, current]
+        return tags
+
+    def _tagged_sentence(self, sentence: Sentence, tags: Int[Tensor, "n"]) -> Sentence:
+        """Copy the words of sentence, tagging its interior positions with the
+        given tag ids (which may run past the end of the sentence), plus BOS and EOS."""
+        tag_list = tags.tolist()
         result = []
         for i, (word, _) in enumerate(sentence):
-            if i == 0:  
+            if i == 0:
                 result.append((word, BOS_TAG))  # Use constant from corpus.py
             elif i == len(sentence) - 1:
                 result.append((word, EOS_TAG))  # Use constant from corpus.py
             else:
-                tag_idx = tags[i-1]
-                result.append((word, self.tagset[tag_idx]))
-
+                result.append((word, self.tagset[tag_list[i-1]]))
         return Sentence(result)
 
+    def _valid_mask(self) -> Tensor:
+        """Boolean mask over tags, excluding BOS_TAG and EOS_TAG.
+        This depends only on the tagset, so it is computed once.  Don't modify it."""
+        try:
+            return self._valid
+        except AttributeError:
+            # finish the mask before storing it, since another thread may be reading it
+            valid = torch.ones(self.k, dtype=torch.bool)
+            valid[self.bos_t] = False
+            valid[self.eos_t] = False
+            self._valid = valid
+            return valid
+
+    def _prepare_for_threads(self) -> None:
+        """Compute the state that inference caches on the model (log A and log B, and
+        the mask of valid tags) right away.  Call this before several threads decode
+        with the model, so that they only ever read that state."""
+        self._log_params()
+        self._valid_mask()
+
+    # File format for a trained model, which can be loaded much faster than a pickle
+    # of the whole object (compare the binary corpus format in corpus.py).  The file consists of
+    #     MODEL_MAGIC
+    #     the length of the header, as a little-endian uint64
+    #     the header: JSON with the format version, the class of the model, its settings,
+    #         and the positions of the blobs that follow (the dtype and shape of each tensor,
+    #         and the number of strings in each string table)
+    #     the string tables of the tagset and vocab: their strings, in UTF-8, separated by
+    #         newlines (which can't occur in a tag or word)
+    #     the parameter tensors, in little-endian binary
+    #         (each blob is 64-byte aligned, and the header gives their positions
+    #         relative to the first of them)
+    # Only the parameters are stored: not the counts or cached log-probabilities,
+    # which are recomputed when needed.  The tensors are memory-mapped copy-on-write
+    # when the file is loaded, so loading takes hardly any time, and processes that
+    # load the same model share its pages of memory.
+    #
+    # load() still accepts the pickled models that save() used to write.  Those lack
+    # the attributes added since then, which _load_pickle() sets to these values.
+
+    MODEL_MAGIC = b"TAGMODL\x01"
+    PICKLE_DEFAULTS: Dict[str, Any] = {"sparse": False, "_log_cache": None, "log_param_computations": 0}
+
+    def _saved_settings(self) -> dict:
+        """The settings that load() needs besides the tagset, vocab, and tensors
+        (JSON-serializable).  Subclasses with more settings extend this."""
+        return {"unigram": self.unigram, "sparse": self.sparse}
+
+    def _saved_tensors(self) -> Dict[str, Tensor]:
+        """The parameters that save() writes, by name."""
+        tensors = {"A": self.A[:1] if self.unigram else self.A}   # a unigram model's A is one row, expanded
+        if isinstance(self.B, SparseEmissions):
+            tensors.update(B_tags=self.B.tags, B_probs=self.B.probs,
+                           B_word_ptr=self.B.word_ptr, B_background=self.B.background)
+        else:
+            tensors["B"] = self.B
+        return tensors
+
+    def _restore(self, settings: dict, tensors: Dict[str, Tensor]) -> None:
+        """Set the parameters of a model that has only been through _init_structure(),
+        from the settings and tensors that save() wrote."""
+        self.A = tensors["A"].expand(self.k, -1) if self.unigram else tensors["A"]
+        if self.sparse:
+            self.B = SparseEmissions.from_arrays(self.k, self.V, tensors["B_tags"], tensors["B_probs"],
+                                                 tensors["B_word_ptr"], tensors["B_background"])
+        else:
+            self.B = tensors["B"]
+        self._invalidate_log_params()
+
     def save(self, model_path: Path) -> None:
         logger.info(f"Saving model to {model_path}")
-        torch.save(self, model_path, pickle_protocol=pickle.HIGHEST_PROTOCOL)
+        model_path = Path(model_path)
+        arrays = {name: np.ascontiguousarray(tensor.detach().cpu().numpy())
+                  for name, tensor in self._saved_tensors().items()}
+        arrays = {name: arr.astype(arr.dtype.newbyteorder("<"), copy=False) for name, arr in arrays.items()}
+        tables = {name: "\n".join(strings).encode("utf-8")
+                  for name, strings in (("tagset", self.tagset), ("vocab", self.vocab))}
+        header: dict = {"version": 1,
+                        "class": type(self).__name__,
+                        "settings": self._saved_settings(),
+                        "strings": {},
+                        "tensors": {}}
+        position = 0     # relative to the start of the data, which follows the header
+        for name, table in tables.items():
+            count = len(getattr(self, name))
+            if table.count(b"\n") != max(count - 1, 0):
+                raise ValueError(f"Can't save a {name} with a newline in one of its strings")
+            header["strings"][name] = {"count": count, "length": len(table), "start": position}
+            position += _align(len(table), 64)
+        for name, arr in arrays.items():
+            header["tensors"][name] = {"dtype": arr.dtype.str, "shape": list(arr.shape), "start": position}
+            position += _align(arr.nbytes, 64)
+        header_bytes = json.dumps(header).encode("utf-8")
+
+        # Write a new file and then rename it, rather than overwriting the old one,
+        # since the old one may be memory-mapped (e.g., by the model that is being saved).
+        temp_path = model_path.with_name(model_path.name + ".tmp")
+        with open(temp_path, "wb") as f:
+            f.write(self.MODEL_MAGIC)
+            f.write(len(header_bytes).to_bytes(8, "little"))
+            f.write(header_bytes)
+            for blob in [*tables.values(), *(arr.tobytes() for arr in arrays.values())]:
+                f.write(b"\0" * (_align(f.tell(), 64) - f.tell()))
+                f.write(blob)
+        os.replace(temp_path, model_path)
         logger.info(f"Saved model to {model_path}")
 
     @classmethod
     def load(cls, model_path: Path, device: str = 'cpu') -> HiddenMarkovModel:
-        model = torch.load(model_path, map_location=device)\
+        with open(model_path, "rb") as f:
+            if f.read(len(cls.MODEL_MAGIC)) != cls.MODEL_MAGIC:
+                return cls._load_pickle(model_path, device)
+            header_len = int.from_bytes(f.read(8), "little")
+            header = json.loads(f.read(header_len).decode("utf-8"))
+            data_start = _align(f.tell(), 64)
+            strings = {}
+            for name, info in header["strings"].items():
+                f.seek(data_start + info["start"])
+                strings[name] = f.read(info["length"]).decode("utf-8").split("\n") if info["count"] else []
+        if header["class"] != cls.__name__:
+            raise ValueError(f"Type Error: expected object of type {cls.__name__} but got {header['class']} " \
+                             f"from saved file {model_path}.")
+        if header["version"] != 1:
+            raise ValueError(f"{model_path} has unsupported model file version {header['version']}")
+        tensors = {}
+        for name, info in header["tensors"].items():
+            shape = tuple(info["shape"])
+            arr = (np.memmap(model_path, dtype=info["dtype"], mode="c", offset=data_start + info["start"], shape=shape)
+                   if np.prod(shape) else np.zeros(shape, dtype=info["dtype"]))
+            tensors[name] = torch.from_numpy(arr).to(device)
+        model = cls.__new__(cls)     # don't run the constructor, which would make random parameters
+        settings = header["settings"]
+        model._init_structure(Integerizer(cast(List[Tag], with_specials(strings["tagset"]))),  # (Tag and Word are just str)
+                              Integerizer(cast(List[Word], with_specials(strings["vocab"]))),
+                              unigram=settings["unigram"], sparse=settings["sparse"])
+        model._restore(settings, tensors)
+        logger.info(f"Memory-mapped model from {model_path}")
+        return model
+
+    @classmethod
+    def _load_pickle(cls, model_path: Path, device: str = 'cpu') -> HiddenMarkovModel:
+        """Load a model that an older version of save() pickled whole."""
+        model = torch.load(model_path, map_location=device, weights_only=False)   # a whole pickled model, not just weights
             
         # torch.load is similar to pickle.load but handles tensors too
         # map_location allows loading tensors on different device than saved
         if model.__class__ != cls:
             raise ValueError(f"Type Error: expected object of type {cls.__name__} but got {model.__class__.__name__} " \
                              f"from saved file {model_path}.")
+        for name, value in cls.PICKLE_DEFAULTS.items():
+            model.__dict__.setdefault(name, value)
 
         logger.info(f"Loaded model from {model_path}")
         return model
@@ -622,38 +1184,44 @@ class HiddenMarkovModel:
     @typechecked
     def posterior_tagging(self, sentence: Sentence, corpus: TaggedCorpus) -> Sentence:
         """find the best tag for each position with posterior marginal probs."""
-        isent = self._integerize_sentence(sentence, corpus)
-        n = len(isent) - 2  # exclude BOS and EOS
-        
-        self.forward_pass(isent)
-        self.backward_pass(isent)
-        
-        valid_mask = torch.ones(self.k, dtype=torch.bool)
-        valid_mask[self.bos_t] = False
-        valid_mask[self.eos_t] = False
-        valid_indices = torch.where(valid_mask)[0]
-        
+        return self.posterior_tagging_batch([sentence], corpus)[0]
+
+    def posterior_tagging_batch(self, sentences: List[Sentence], corpus: TaggedCorpus) -> List[Sentence]:
+        """posterior decoding for a whole minibatch, using the batched forward and backward trellises."""
+        if not sentences:
+            return []
+        isents = self._integerize_sentences(sentences, corpus)
+        log_posterior = self.forward_backward(isents, clamp=False).log_posteriors()
+
         # find tag with highest posterior probability
-        tags = []
-        for j in range(1, n+1):  # skip bos and include up to last real word
-            log_posterior = self.alpha[j, valid_indices] + self.beta[j, valid_indices] - self.log_Z
-            
-            # get most probable tag
-            best_tag_idx = torch.argmax(log_posterior)
-            best_tag = valid_indices[best_tag_idx]
-            tags.append(best_tag)
-        
-        result = []
-        for i, (word, _) in enumerate(sentence):
-            if i == 0:
-                result.append((word, BOS_TAG))  # Use constant from corpus.py
-            elif i == len(sentence) - 1:
-                result.append((word, EOS_TAG))  # Use constant from corpus.py
-            else:
-                tag_idx = tags[i-1]
-                result.append((word, self.tagset[tag_idx]))
-        
-        return Sentence(result)
+        valid = self._valid_mask()
+        tags = torch.where(valid, log_posterior, float('-inf')).argmax(dim=2)
+        return [self._tagged_sentence(sentence, tags[b]) for b, sentence in enumerate(sentences)]
+
+###
+# Worker processes for HiddenMarkovModel._parallel_E_step().
+# These have to be top-level functions so that the pool can find them.
+###
+
+_worker_model: Optional[HiddenMarkovModel] = None
+_worker_corpus: Optional[TaggedCorpus] = None
+
+def _init_E_step_worker(model: HiddenMarkovModel, corpus: TaggedCorpus) -> None:
+    global _worker_model, _worker_corpus
+    _worker_model, _worker_corpus = model, corpus
+    torch.set_num_threads(1)   # the parallelism comes from the processes instead
+
+def _E_step_shard(shard: Tuple[Tensor, Tensor | SparseEmissions, np.ndarray, int]) -> Tuple[Tensor, Tensor | SparseCounts]:
+    """Run the E step on the given sentences of the worker's corpus, using parameters
+    A and B, and return the expected counts (A_counts, B_counts)."""
+    A, B, indices, batch_size = shard
+    model, corpus = _worker_model, _worker_corpus
+    assert model is not None and corpus is not None
+    model.A, model.B = A, B    # a new A and B, so _log_params() will recompute log A and log B
+    model._zero_counts()
+    for batch in chunked((corpus.integerized_sentence(i) for i in indices), batch_size):
+        model.E_step_batch(batch)
+    return model.A_counts, model.B_counts
 
 @typechecked
 class EnhancedHMM(HiddenMarkovModel):
@@ -664,8 +1232,9 @@ class EnhancedHMM(HiddenMarkovModel):
                 vocab: Integerizer[Word], 
                  unigram: bool = False, 
                  supervised_constraint: bool = True,
-                 better_smoothing: bool = True):
-        super().__init__(tagset, vocab, unigram)
+                 better_smoothing: bool = True,
+                 sparse: bool = False):
+        super().__init__(tagset, vocab, unigram, sparse)
         self.supervised_constraint = supervised_constraint
         self.better_smoothing = better_smoothing
         self.tag_word_counts = defaultdict(set)  # allowed tags per word
@@ -677,11 +1246,21 @@ class EnhancedHMM(HiddenMarkovModel):
         So unfortunately this wont do too much for our purely unsupervised case, but it's really impressive for the others """
         
         # learn word-tag associations 
-        for sentence in corpus:
-            isent = self._integerize_sentence(sentence, corpus)
-            for word_id, tag_id in isent:
-                if tag_id is not None:
-                    self.tag_word_counts[word_id].add(tag_id)
+        corpus = self._integerized_corpus(corpus)
+        assert corpus.word_ids is not None and corpus.tag_ids is not None
+        # The distinct (word, tag) pairs, found a chunk at a time with numpy, so that
+        # a big (e.g. memory-mapped) corpus doesn't turn into a Python int per token.
+        # Each pair is coded as the single number word_id * k + tag_id.
+        chunk = 1 << 20
+        pairs = []
+        for start in range(0, len(corpus.word_ids), chunk):
+            word_ids = corpus.word_ids[start:start+chunk].astype(np.int64)
+            tag_ids = corpus.tag_ids[start:start+chunk].astype(np.int64)
+            known = tag_ids != NO_TAG
+            pairs.append(np.unique(word_ids[known] * self.k + tag_ids[known]))
+        for pair in np.unique(np.concatenate(pairs)).tolist() if pairs else []:
+            word_id, tag_id = divmod(pair, self.k)
+            self.tag_word_counts[word_id].add(tag_id)
 
         # find tags that only appear with a small vocab
         tag_vocab_sizes = defaultdict(set)
@@ -696,6 +1275,41 @@ class EnhancedHMM(HiddenMarkovModel):
 
         super().train(corpus, *args, **kwargs)
 
+    def _saved_settings(self) -> dict:
+        return {**super()._saved_settings(),
+                "supervised_constraint": self.supervised_constraint,
+                "better_smoothing": self.better_smoothing,
+                "open_class_threshold": self.open_class_threshold,
+                "closed_class_tags": sorted(self.closed_class_tags)}
+
+    def _saved_tensors(self) -> Dict[str, Tensor]:
+        # the allowed tags of each word, as (word, tag) pairs
+        pairs = sorted((word_id, tag_id) for word_id, tag_ids in self.tag_word_counts.items() for tag_id in tag_ids)
+        return {**super()._saved_tensors(),
+                "allowed_words": torch.tensor([word_id for word_id, _ in pairs], dtype=torch.long),
+                "allowed_tags": torch.tensor([tag_id for _, tag_id in pairs], dtype=torch.long)}
+
+    def _restore(self, settings: dict, tensors: Dict[str, Tensor]) -> None:
+        super()._restore(settings, tensors)
+        self.supervised_constraint = settings["supervised_constraint"]
+        self.better_smoothing = settings["better_smoothing"]
+        self.open_class_threshold = settings["open_class_threshold"]
+        self.closed_class_tags = set(settings["closed_class_tags"])
+        # tag_word_counts is only rebuilt when it's first needed (see __getattr__()),
+        # since a dict of sets for a big vocab takes longer to build than the rest of load()
+        self._allowed_pairs = (tensors["allowed_words"], tensors["allowed_tags"])
+
+    def __getattr__(self, name: str):
+        # only called for attributes that haven't been set
+        if name == "tag_word_counts" and "_allowed_pairs" in self.__dict__:
+            tag_word_counts = defaultdict(set)
+            words, tags = self._allowed_pairs
+            for word_id, tag_id in zip(words.tolist(), tags.tolist()):
+                tag_word_counts[word_id].add(tag_id)
+            self.tag_word_counts = tag_word_counts
+            return tag_word_counts
+        raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+
     def M_step(self, λ: float = 0.01) -> None:
         """set the transition and emission matrices with bounds checking for vocabulary."""
         if λ < 0:
@@ -705,38 +1319,41 @@ class EnhancedHMM(HiddenMarkovModel):
 
         # Verify structural zeros agaaiiiiin
         assert self.A_counts[:, self.bos_t].any() == 0
-        assert self.A_counts[self.eos_t, :].any() == 0
-        assert self.B_counts[self.eos_t:self.bos_t, :].any() == 0
+        assert self.unigram or self.A_counts[self.eos_t, :].any() == 0
+        assert not self._B_counts_any(slice(self.eos_t, self.bos_t))
 
-        if self.better_smoothing:
-            #  smoothing matrix - varies by tag type
-            B_smoothing = torch.full((self.k, self.V), λ)
-            for tag_id in self.closed_class_tags:
-                B_smoothing[tag_id, :] = λ * 0.1
-            smoothed_B = self.B_counts + B_smoothing
+        if isinstance(self.B_counts, SparseCounts):
+            self.B = self._sparse_M_step_B(self.B_counts, λ)
+        else:
+            if self.better_smoothing:
+                #  smoothing matrix - varies by tag type
+                B_smoothing = torch.full((self.k, self.V), λ)
+                for tag_id in self.closed_class_tags:
+                    B_smoothing[tag_id, :] = λ * 0.1
+                smoothed_B = self.B_counts + B_smoothing
             
-            #  supervised constraints if enabled
-            if self.supervised_constraint:
-                mask = torch.zeros((self.k, self.V), dtype=torch.bool)
-                for word_id, tag_ids in self.tag_word_counts.items():
-                    # skip words that are outside our vocabulary size
-                    if word_id >= self.V:
-                        continue
-                    for tag_id in tag_ids:
-                        if tag_id >= self.k:
+                #  supervised constraints if enabled
+                if self.supervised_constraint:
+                    mask = torch.zeros((self.k, self.V), dtype=torch.bool)
+                    for word_id, tag_ids in self.tag_word_counts.items():
+                        # skip words that are outside our vocabulary size
+                        if word_id >= self.V:
                             continue
-                        mask[tag_id, word_id] = True
-                smoothed_B = torch.where(mask, smoothed_B, torch.zeros_like(smoothed_B))
-        else:
-            # simple as the fallback case
-            smoothed_B = self.B_counts.clone()
-            smoothed_B[:self.eos_t] += λ
+                        for tag_id in tag_ids:
+                            if tag_id >= self.k:
+                                continue
+                            mask[tag_id, word_id] = True
+                    smoothed_B = torch.where(mask, smoothed_B, torch.zeros_like(smoothed_B))
+            else:
+                # simple as the fallback case
+                smoothed_B = self.B_counts.clone()
+                smoothed_B[:self.eos_t] += λ
 
-        # norm emission 
-        row_sums_B = smoothed_B.sum(dim=1, keepdim=True)
-        row_sums_B = torch.where(row_sums_B == 0, torch.ones_like(row_sums_B), row_sums_B)
-        self.B = smoothed_B / row_sums_B
-        self.B[self.eos_t:, :] = 0
+            # norm emission 
+            row_sums_B = smoothed_B.sum(dim=1, keepdim=True)
+            row_sums_B = torch.where(row_sums_B == 0, torch.ones_like(row_sums_B), row_sums_B)
+            self.B = smoothed_B / row_sums_B
+            self.B[self.eos_t:, :] = 0
 
         # handle transitions
         if self.unigram:
@@ -744,7 +1361,7 @@ class EnhancedHMM(HiddenMarkovModel):
             WA = torch.log(row_counts + 1e-10).unsqueeze(0)
             WA[:, self.bos_t] = -float('inf')
             self.A = WA.softmax(dim=1)
-            self.A = self.A.repeat(self.k, 1)
+            self.A = self.A.expand(self.k, -1)
         else:
             # transition smoothing matrix 
             A_smoothing = torch.full((self.k, self.k), λ)
@@ -763,56 +1380,60 @@ class EnhancedHMM(HiddenMarkovModel):
 
         # Verify probabilities sum to 1
         A_row_sums = self.A[:self.eos_t].sum(dim=1)
-        B_row_sums = self.B[:self.eos_t].sum(dim=1)
+        B_row_sums = self._B_row_sums()[:self.eos_t]
         assert torch.allclose(A_row_sums, torch.ones_like(A_row_sums), rtol=1e-3)
         assert torch.allclose(B_row_sums, torch.ones_like(B_row_sums), rtol=1e-3)
+        self._invalidate_log_params()
     
+    def _sparse_M_step_B(self, counts: SparseCounts, λ: float) -> SparseEmissions:
+        """the emission part of M_step when the counts are sparse. same smoothing and constraints,
+        but the smoothing is one number per tag and the constraint mask is a list of (tag, word) pairs,
+        so neither one is a (k, V) matrix."""
+        smoothing = torch.full((self.k,), float(λ))
+        if self.better_smoothing:
+            for tag_id in self.closed_class_tags:
+                smoothing[tag_id] = λ * 0.1
+        smoothing[self.eos_t:] = 0
+
+        allowed = None
+        if self.better_smoothing and self.supervised_constraint:
+            pairs = [(tag_id, word_id) for word_id, tag_ids in self.tag_word_counts.items() if word_id < self.V
+                     for tag_id in tag_ids if tag_id < self.eos_t]
+            tags, words = torch.tensor(pairs, dtype=torch.long).reshape(-1, 2).T
+            allowed = (tags, words)
+        return SparseEmissions.smoothed(counts, smoothing, allowed)
+
     def decode(self, sentence: Sentence, corpus: TaggedCorpus, method: str = 'viterbi') -> Sentence:
         """picks best tags for a sentence. can use viterbi, posterior, or hybrid method.
         hybrid uses constraints for known words and posterior for unknowns - usually works best."""
+        return self.decode_batch([sentence], corpus, method)[0]
+
+    def decode_batch(self, sentences: List[Sentence], corpus: TaggedCorpus, method: str = 'viterbi') -> List[Sentence]:
+        """same as decode, but for a whole minibatch of sentences at once."""
         
         if method == 'viterbi':
-            return self.viterbi_tagging(sentence, corpus)
+            return self.viterbi_tagging_batch(sentences, corpus)
         elif method == 'posterior':
-            return self.posterior_tagging(sentence, corpus)
+            return self.posterior_tagging_batch(sentences, corpus)
         elif method == 'hybrid':
             # we got inspired by the mix of training files so this will use 
             # constraints for known words, posterior for unknown
-            isent = self._integerize_sentence(sentence, corpus)
-            self.forward_pass(isent)
-            self.backward_pass(isent)
-            
-            tags = []
-            for j, (word_id, _) in enumerate(isent[1:-1], 1):
-                if word_id in self.tag_word_counts:
-                    # for known words, only consider tags we've seen before
-                    allowed_tags = list(self.tag_word_counts[word_id])
-                    log_probs = (self.alpha[j, allowed_tags] + 
-                            self.beta[j, allowed_tags] - 
-                            self.log_Z)  
-                    best_idx = torch.argmax(log_probs)
-                    tags.append(allowed_tags[best_idx])
-                else:
-                    valid_mask = torch.ones(self.k, dtype=torch.bool)
-                    valid_mask[self.bos_t] = False
-                    valid_mask[self.eos_t] = False
-                    valid_indices = torch.where(valid_mask)[0]
-                    # for unknown words, use posterior over all tags
-                    log_probs = self.alpha[j, valid_indices] + self.beta[j, valid_indices] - self.log_Z
-                    best_idx = torch.argmax(log_probs)
-                    tags.append(valid_indices[best_idx])
-        
-            result = []
-            for i, (word, _) in enumerate(sentence):
-                if i == 0:  # BOS
-                    result.append((word, BOS_TAG))
-                elif i == len(sentence) - 1:  # EOS
-                    result.append((word, EOS_TAG))
-                else:
-                    # Convert tag index to actual tag using tagset
-                    tag_idx = tags[i-1]  # -1 because we don't include BOS
-                    result.append((word, self.tagset[tag_idx]))
-            
-            return Sentence(result)
+            if not sentences:
+                return []
+            isents = self._integerize_sentences(sentences, corpus)
+            result = self.forward_backward(isents, clamp=False)
+            log_probs = result.log_posteriors()
+
+            # for known words, only consider tags we've seen before;
+            # for unknown words, use posterior over all tags.
+            # only the words of this minibatch matter.  (we use get() because
+            # looking up a new word in the defaultdict would add it, changing the model.)
+            words, inverse = result.word_ids.unique(return_inverse=True)
+            allowed = torch.zeros((len(words), self.k), dtype=torch.bool)
+            for i, word_id in enumerate(words.tolist()):
+                allowed[i, list(self.tag_word_counts.get(word_id, ()))] = True
+            allowed = torch.where(allowed.any(dim=1, keepdim=True), allowed, self._valid_mask())
+            tags = torch.where(allowed[inverse], log_probs, float('-inf')).argmax(dim=2)
+            return [self._tagged_sentence(sentence, tags[b]) for b, sentence in enumerate(sentences)]
         else:
-            raise ValueError(f"Unknown decoding method: {method}")
\ No newline at end of file
+            raise ValueError(f"Unknown decoding method: {method}")
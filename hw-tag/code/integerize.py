@@ -76,6 +76,7 @@ class Integerizer(Generic[T]):
         # Set up a pair of data structures to convert objects to ints and back again.
         self._objects: List[T] = []  # list of all unique objects that have been added so far
         self._indices: Dict[T, int] = {}  # maps each object to its integer position in the list
+        self._fingerprint: Optional[int] = None  # cached by fingerprint(); forgotten when an object is added
         # Add any objects that were given.
         self.update(iterable)
 
@@ -91,10 +92,32 @@ class Integerizer(Generic[T]):
 
     def __eq__(self, other: object) -> bool:
         if isinstance(other, Integerizer):
+            if self is other:
+                return True
+            if len(self) != len(other) or self.fingerprint() != other.fingerprint():
+                return False  # quick check, without comparing the lists
             return self._objects == other._objects  # other._objects is List[Unknown] but that is ok since `==` allows any object
         else:
             return False
 
+    def fingerprint(self) -> int:
+        """
+        A hash of the objects in the collection and their order.  Two integerizers with 
+        the same contents have the same fingerprint, and two with different contents
+        almost certainly don't.  It is computed once, and then cached until another object
+        is added, so comparing the fingerprints of big vocabularies is cheap.
+        """
+        fingerprint = getattr(self, '_fingerprint', None)
+        if fingerprint is None:
+            fingerprint = self._fingerprint = hash(tuple(self._objects))
+        return fingerprint
+
+    def __getstate__(self) -> dict:
+        # Don't pickle the fingerprint: hashes of strings differ from one Python process to another.
+        state = self.__dict__.copy()
+        state['_fingerprint'] = None
+        return state
+
     def __len__(self) -> int:
         """
         Number of objects in the collection.
@@ -141,6 +164,7 @@ class Integerizer(Generic[T]):
             i = len(self)
             self._objects.append(obj)
             self._indices[obj] = i
+            self._fingerprint = None
             return i
 
     def add(self, obj: T) -> None:
@@ -155,6 +179,13 @@ class Integerizer(Generic[T]):
         Add all the objects if they are not already in the collection.
         Similar to `set.update` (or `list.extend`).
         """
+        if not self._objects:
+            # Starting from empty (e.g., in the constructor), we can build both data
+            # structures at C speed, which matters for big vocabularies.
+            self._objects = list(dict.fromkeys(iterable))   # unique objects, in order of first occurrence
+            self._indices = dict(zip(self._objects, range(len(self._objects))))
+            self._fingerprint = None
+            return
         for obj in iterable:
             self.add(obj)
 
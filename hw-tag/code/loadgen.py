@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Load generator for serve.py.  Sends the sentences of a file to a running tagging
+server from many concurrent connections, and reports the throughput and latency
+seen by the clients, along with the server's own /stats.
+"""
+import argparse
+import asyncio
+import json
+import logging
+from pathlib import Path
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+log = logging.getLogger(Path(__file__).stem)  # For usage, see findsim.py in earlier assignment.
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument("input", type=str, help="sentences to send, one per line (tags, if any, are removed by the server)")
+
+    where = parser.add_mutually_exclusive_group()
+    where.add_argument("--port", type=int, default=8465, help="the server is on this port of localhost")
+    where.add_argument("--unix", type=str, default=None, help="the server is on this Unix socket instead")
+
+    parser.add_argument("--connections", type=int, default=16, help="number of concurrent client connections")
+    parser.add_argument("--requests", type=int, default=2000, help="total number of requests to send")
+    parser.add_argument("--sentences_per_request", type=int, default=1, help="sentences in each request")
+    parser.add_argument("-o", "--output", type=str, default=None, help="write the summary here as JSON")
+
+    # for verbosity of logging
+    parser.set_defaults(logging_level=logging.INFO)
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument(
+        "-v", "--verbose", dest="logging_level", action="store_const", const=logging.DEBUG
+    )
+    verbosity.add_argument(
+        "-q", "--quiet",   dest="logging_level", action="store_const", const=logging.WARNING
+    )
+
+    return parser.parse_args()
+
+class Connection:
+    """One keep-alive HTTP connection to the server."""
+
+    def __init__(self, port: int, unix: Optional[str]):
+        self.port = port
+        self.unix = unix
+
+    async def open(self) -> None:
+        if self.unix:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.unix)
+        else:
+            self.reader, self.writer = await asyncio.open_connection("127.0.0.1", self.port)
+
+    async def request(self, method: str, target: str, body: bytes = b"") -> Tuple[int, bytes]:
+        """Send a request and return the status code and body of the reply.  If the
+        server closed the connection or didn't send a status line, the status is 0, 
+        and the connection should be reopened."""
+        self.writer.write(f"{method} {target} HTTP/1.1\r\nHost: localhost\r\n"
+                          f"Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body)
+        await self.writer.drain()
+        status_line = (await self.reader.readline()).split()
+        if len(status_line) < 2 or not status_line[1].isdigit():
+            return 0, b""
+        status = int(status_line[1])
+        length = 0
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value)
+        return status, await self.reader.readexactly(length)
+
+    def close(self) -> None:
+        self.writer.close()
+
+async def generate(args: argparse.Namespace, lines: List[str]) -> dict:
+    bodies = ["".join(lines[(i * args.sentences_per_request + j) % len(lines)] + "\n"
+                      for j in range(args.sentences_per_request)).encode("utf-8")
+              for i in range(args.requests)]
+    next_request = 0
+    latencies: List[float] = []
+    errors = 0
+
+    async def client() -> None:
+        nonlocal next_request, errors
+        connection = Connection(args.port, args.unix)
+        await connection.open()
+        try:
+            while next_request < len(bodies):
+                body = bodies[next_request]
+                next_request += 1
+                start = time.perf_counter()
+                try:
+                    status, _ = await connection.request("POST", "/tag", body)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    status = 0
+                if status == 200:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors += 1
+                    if status == 0:       # the connection is broken; start another
+                        connection.close()
+                        await connection.open()
+        finally:
+            connection.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.connections)))
+    elapsed = time.perf_counter() - start
+
+    connection = Connection(args.port, args.unix)
+    await connection.open()
+    stats_status, server_stats = await connection.request("GET", "/stats")
+    connection.close()
+
+    # throughput and latency are of the successful requests only
+    if latencies:
+        p50, p99 = (round(1000 * float(p), 3) for p in np.percentile(latencies, [50, 99]))
+    else:
+        log.warning(f"No requests succeeded ({errors} failed)")
+        p50 = p99 = None
+    return {
+        "requests": len(latencies),
+        "sentences": len(latencies) * args.sentences_per_request,
+        "errors": errors,
+        "connections": args.connections,
+        "seconds": round(elapsed, 3),
+        "requests_per_s": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "sentences_per_s": round(len(latencies) * args.sentences_per_request / elapsed, 2) if elapsed else 0.0,
+        "latency_p50_ms": p50,
+        "latency_p99_ms": p99,
+        "server": json.loads(server_stats) if stats_status == 200 else None,
+    }
+
+def main() -> None:
+    args = parse_args()
+    logging.root.setLevel(args.logging_level)
+    logging.basicConfig(level=args.logging_level)
+
+    with open(args.input) as f:
+        lines = [line.strip() for line in f if line.strip()]
+    if not lines:
+        raise ValueError(f"No sentences in {args.input}")
+    summary = asyncio.run(generate(args, lines))
+    log.info(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Phase-level profiling of the training loops.  HiddenMarkovModel.train() and
+ConditionalRandomField.train() mark their phases (integerization, forward-backward,
+count accumulation, M step, checkpointing, dev evaluation, ...) with
+
+    with self._profiler.phase("M step"):
+        ...
+
+and a Profiler adds up the wall time of each phase, along with the number of
+sentences and tokens trained on.  At the end of each epoch (for the CRF, each
+evaluation interval), it writes one JSON line with those totals, the
+throughput, and the peak resident memory of the process.
+
+The phases are exclusive: time spent in a phase nested inside another is only
+charged to the inner one, and time outside of any phase is charged to "other",
+so the phase times add up to the epoch's wall time.  The first epoch also
+includes the setup before it, such as the evaluation of the initial model, which
+is charged to its own "initial dev eval" phase so that the "dev eval" phase of
+every epoch times the same thing.
+
+When nobody is profiling, the models use NULL_PROFILER, whose phases are a
+shared do-nothing context manager, so the hooks cost next to nothing.
+"""
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+import json
+import sys
+import time
+from typing import Any, ContextManager, DefaultDict, Dict, Iterator, List, TextIO
+
+try:
+    import resource
+except ImportError:   # e.g., on Windows
+    resource = None   # type: ignore
+
+_NO_PHASE = nullcontext()
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far, in megabytes (0 if unknown).
+    This doesn't include the worker processes of a parallel E step."""
+    if resource is None:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10   # bytes on macOS, KB on Linux
+
+class Profiler:
+    """Accumulates per-phase wall times and throughput counters, and writes a
+    JSON-lines report with one record per epoch to the given stream."""
+
+    enabled = True
+
+    def __init__(self, out: TextIO, label: str = ""):
+        self.out = out
+        self.label = label     # included in each record, e.g., the model class
+        self.epoch = 0
+        self._reset()
+
+    def _reset(self) -> None:
+        self.seconds: DefaultDict[str, float] = defaultdict(float)
+        self.sentences = 0
+        self.tokens = 0
+        self._stack: List[str] = ["other"]
+        self._start = self._last = time.perf_counter()
+
+    def _charge(self) -> None:
+        """Charge the time since the last phase boundary to the innermost phase."""
+        now = time.perf_counter()
+        self.seconds[self._stack[-1]] += now - self._last
+        self._last = now
+
+    @contextmanager
+    def _phase(self, name: str) -> Iterator[None]:
+        self._charge()
+        self._stack.append(name)
+        try:
+            yield
+        finally:
+            self._charge()
+            self._stack.pop()
+
+    def phase(self, name: str) -> ContextManager[Any]:
+        """Context manager that times a phase of training."""
+        return self._phase(name)
+
+    def count(self, sentences: int, tokens: int) -> None:
+        """Record that we trained on this many more sentences and tokens (not counting BOS, EOS)."""
+        self.sentences += sentences
+        self.tokens += tokens
+
+    def end_epoch(self, **extra: Any) -> Dict[str, Any]:
+        """Write the record of the epoch that just ended (with any extra fields,
+        such as the dev loss), and start timing the next one."""
+        self._charge()
+        wall = time.perf_counter() - self._start
+        self.epoch += 1
+        record: Dict[str, Any] = {"model": self.label, "epoch": self.epoch, **extra,
+                                  "sentences": self.sentences, "tokens": self.tokens,
+                                  "seconds": round(wall, 6),
+                                  "sentences_per_s": round(self.sentences / wall, 2) if wall else 0.0,
+                                  "tokens_per_s": round(self.tokens / wall, 2) if wall else 0.0,
+                                  "phases": {name: round(seconds, 6) for name, seconds in self.seconds.items()},
+                                  "peak_rss_mb": round(peak_rss_mb(), 1)}
+        self.out.write(json.dumps(record) + "\n")
+        self.out.flush()
+        stack = self._stack
+        self._reset()
+        self._stack = stack     # (an epoch can end inside a phase)
+        return record
+
+class NullProfiler(Profiler):
+    """A profiler that does nothing, for when profiling is off."""
+
+    enabled = False
+
+    def __init__(self) -> None:
+        pass
+
+    def phase(self, name: str) -> ContextManager[Any]:
+        return _NO_PHASE
+
+    def count(self, sentences: int, tokens: int) -> None:
+        pass
+
+    def end_epoch(self, **extra: Any) -> Dict[str, Any]:
+        return {}
+
+NULL_PROFILER = NullProfiler()
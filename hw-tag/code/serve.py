@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+Long-lived tagging service.  Loads a trained model once and tags sentences sent
+over HTTP, on localhost or on a Unix socket:
+
+    POST /tag     body: one untagged sentence per line;  reply: one word/tag line per sentence
+    GET  /stats   reply: JSON with request counts, throughput, and p50/p99 latency
+
+Sentences from concurrent requests are gathered into micro-batches, which are
+decoded in worker threads by the batched decoders (see loadgen.py for a client).
+"""
+import argparse
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+from pathlib import Path
+import time
+from typing import Any, Deque, Dict, List, Set, Tuple, Union
+
+import numpy as np
+
+from corpus import Sentence, TaggedCorpus, parse_sentence
+from hmm import HiddenMarkovModel, EnhancedHMM
+from crf import ConditionalRandomField
+from tag import check_decoder, decode_batch
+
+log = logging.getLogger(Path(__file__).stem)  # For usage, see findsim.py in earlier assignment.
+
+MAX_BODY = 1 << 20   # bytes in a request body
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument("model", type=str, help="trained model file, as saved by tag.py -m")
+    parser.add_argument("--crf", action="store_true", default=False, help="the model is a CRF")
+    parser.add_argument("--awesome", action="store_true", default=False, help="the model is an EnhancedHMM")
+    parser.add_argument(
+        "--decoder",
+        type=str,
+        default="viterbi",
+        choices=['viterbi', 'posterior', 'hybrid'],
+        help="decoding method to use (hybrid needs --awesome)"
+    )
+
+    where = parser.add_mutually_exclusive_group()
+    where.add_argument("--port", type=int, default=8465, help="serve HTTP on this port of localhost")
+    where.add_argument("--unix", type=str, default=None, help="serve HTTP on this Unix socket instead")
+
+    parser.add_argument(
+        "--max_batch",
+        type=int,
+        default=64,
+        help="most sentences to decode together"
+    )
+    parser.add_argument(
+        "--max_delay",
+        type=float,
+        default=5.0,
+        help="most milliseconds that a sentence waits for others to join its micro-batch"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of threads that decode micro-batches concurrently (they share the model)"
+    )
+
+    # for verbosity of logging
+    parser.set_defaults(logging_level=logging.INFO)
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument(
+        "-v", "--verbose", dest="logging_level", action="store_const", const=logging.DEBUG
+    )
+    verbosity.add_argument(
+        "-q", "--quiet",   dest="logging_level", action="store_const", const=logging.WARNING
+    )
+
+    args = parser.parse_args()
+    if args.max_batch <= 0: parser.error(f"--max_batch should be > 0")
+    if args.max_delay < 0: parser.error(f"--max_delay should be >= 0")
+    if args.workers <= 0: parser.error(f"--workers should be > 0")
+    return args
+
+class ServerStats:
+    """Counters for GET /stats.  The latency percentiles are over the most
+    recent sentences only, so they follow the current load."""
+
+    def __init__(self, window: int = 10_000):
+        self.start = time.perf_counter()
+        self.sentences = 0         # sentences tagged
+        self.requests = 0          # HTTP requests answered
+        self.batches = 0           # micro-batches decoded
+        self.decode_seconds = 0.0  # time spent decoding them
+        self.latencies: Deque[float] = deque(maxlen=window)   # seconds from arrival to answer
+
+    def record_batch(self, latencies: List[float], seconds: float) -> None:
+        self.sentences += len(latencies)
+        self.batches += 1
+        self.decode_seconds += seconds
+        self.latencies.extend(latencies)
+
+    def snapshot(self) -> Dict[str, Any]:
+        uptime = time.perf_counter() - self.start
+        p50, p99 = np.percentile(self.latencies, [50, 99]) if self.latencies else (0.0, 0.0)
+        return {
+            "uptime_s": round(uptime, 3),
+            "requests": self.requests,
+            "sentences": self.sentences,
+            "batches": self.batches,
+            "mean_batch_size": round(self.sentences / self.batches, 2) if self.batches else 0.0,
+            "sentences_per_s": round(self.sentences / uptime, 2) if uptime else 0.0,
+            "decode_sentences_per_s": round(self.sentences / self.decode_seconds, 2) if self.decode_seconds else 0.0,
+            "latency_p50_ms": round(1000 * float(p50), 3),
+            "latency_p99_ms": round(1000 * float(p99), 3),
+        }
+
+class MicroBatcher:
+    """Gathers sentences from concurrent requests into micro-batches of at most
+    max_batch sentences.  A micro-batch is decoded as soon as it is full, or
+    max_delay seconds after its first sentence arrived.  Decoding happens in a
+    thread pool, so the event loop keeps accepting sentences meanwhile."""
+
+    def __init__(self, model: Union[HiddenMarkovModel, ConditionalRandomField], decoder: str,
+                 max_batch: int, max_delay: float, workers: int, stats: ServerStats):
+        check_decoder(model, decoder)
+        self.model = model
+        self.decoder = decoder
+        self.corpus = TaggedCorpus(tagset=model.tagset, vocab=model.vocab)   # no files; it just integerizes
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.stats = stats
+        self.executor = ThreadPoolExecutor(workers)
+        self.slots = asyncio.Semaphore(workers)     # micro-batches being decoded
+        self.queue: asyncio.Queue[Tuple[Sentence, asyncio.Future, float]] = asyncio.Queue(max_batch * 64)
+        # The tasks decoding micro-batches.  asyncio only keeps weak references to
+        # tasks, so we hold on to them until they are done.
+        self.tasks: Set[asyncio.Task] = set()
+
+    async def tag(self, sentence: Sentence) -> Sentence:
+        """Tag one (untagged) sentence, as part of some micro-batch."""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((sentence, future, time.perf_counter()))
+        return await future
+
+    async def run(self) -> None:
+        """Form micro-batches and hand them to the decoding threads, forever."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                if self.queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(self.queue.get_nowait())
+            await self.slots.acquire()
+            task = asyncio.create_task(self._decode(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def close(self) -> None:
+        """Wait for the micro-batches that are being decoded, then stop the threads.
+        (Call this after stopping run().)"""
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.executor.shutdown(wait=False)
+
+    async def _decode(self, batch: List[Tuple[Sentence, asyncio.Future, float]]) -> None:
+        try:
+            start = time.perf_counter()
+            sentences = [sentence for sentence, _, _ in batch]
+            try:
+                tagged = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, decode_batch, self.model, sentences, self.corpus, self.decoder)
+            except Exception as e:
+                log.warning(f"Error tagging a micro-batch of {len(batch)} sentences: {e}")
+                for _, future, _ in batch:
+                    if not future.done(): future.set_exception(e)
+                return
+            done = time.perf_counter()
+            for (_, future, _), result in zip(batch, tagged):
+                if not future.done(): future.set_result(result)   # (the client may have gone away)
+            self.stats.record_batch([done - arrival for _, _, arrival in batch], done - start)
+        finally:
+            self.slots.release()
+
+class TaggingServer:
+    """A minimal HTTP/1.1 front end (with keep-alive) for a MicroBatcher."""
+
+    def __init__(self, batcher: MicroBatcher, stats: ServerStats):
+        self.batcher = batcher
+        self.stats = stats
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers: Dict[str, str] = {}
+                try:
+                    method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                    while True:
+                        line = await reader.readline()
+                        if line in (b"\r\n", b"\n", b""):
+                            break
+                        name, _, value = line.decode("latin-1").partition(":")
+                        headers[name.strip().lower()] = value.strip()
+                    length = int(headers.get("content-length", 0))
+                    if length < 0:
+                        raise ValueError(f"negative Content-Length {length}")
+                except ValueError as e:
+                    # we can't tell where this request ends, so this is the last one
+                    await self._respond(writer, "400 Bad Request", "text/plain", f"bad request: {e}\n".encode())
+                    break
+                if length > MAX_BODY:
+                    await self._respond(writer, "413 Payload Too Large", "text/plain", b"request too large\n")
+                    break
+                body = await reader.readexactly(length)
+                status, content_type, payload = await self._route(method, target, body)
+                await self._respond(writer, status, content_type, payload)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass   # the client went away
+        finally:
+            writer.close()
+
+    async def _route(self, method: str, target: str, body: bytes) -> Tuple[str, str, bytes]:
+        if method == "POST" and target == "/tag":
+            try:
+                sentences = [parse_sentence(line).desupervise() for line in body.decode("utf-8").splitlines()]
+            except ValueError as e:    # e.g., a token like a/b/c, or bad UTF-8
+                return "400 Bad Request", "text/plain", f"bad sentence: {e}\n".encode()
+            try:
+                tagged = await asyncio.gather(*(self.batcher.tag(sentence) for sentence in sentences))
+            except Exception as e:
+                return "500 Internal Server Error", "text/plain", f"{e}\n".encode()
+            self.stats.requests += 1
+            return "200 OK", "text/plain; charset=utf-8", "".join(f"{t}\n" for t in tagged).encode("utf-8")
+        if method == "GET" and target == "/stats":
+            return "200 OK", "application/json", json.dumps(self.stats.snapshot()).encode()
+        return "404 Not Found", "text/plain", b"try POST /tag or GET /stats\n"
+
+    async def _respond(self, writer: asyncio.StreamWriter, status: str, content_type: str, payload: bytes) -> None:
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(payload)}\r\n\r\n".encode("latin-1") + payload)
+        await writer.drain()
+
+async def serve(args: argparse.Namespace, model: Union[HiddenMarkovModel, ConditionalRandomField],
+                stats: ServerStats) -> None:
+    batcher = MicroBatcher(model, args.decoder, args.max_batch, args.max_delay / 1000, args.workers, stats)
+    front_end = TaggingServer(batcher, stats)
+    if args.unix:
+        server = await asyncio.start_unix_server(front_end.handle, path=args.unix)
+        log.info(f"Serving on Unix socket {args.unix}")
+    else:
+        server = await asyncio.start_server(front_end.handle, host="127.0.0.1", port=args.port)
+        log.info(f"Serving on http://127.0.0.1:{args.port}")
+    batching = asyncio.create_task(batcher.run())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batching.cancel()
+        await batcher.close()
+
+def main() -> None:
+    args = parse_args()
+    logging.root.setLevel(args.logging_level)
+    logging.basicConfig(level=args.logging_level)
+
+    model_class = ConditionalRandomField if args.crf else EnhancedHMM if args.awesome else HiddenMarkovModel
+    model = model_class.load(Path(args.model))
+    stats = ServerStats()
+    try:
+        asyncio.run(serve(args, model, stats))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.unix: Path(args.unix).unlink(missing_ok=True)
+        log.info(f"Final stats: {json.dumps(stats.snapshot())}")
+
+if __name__ == "__main__":
+    main()
@@ -2,19 +2,25 @@
 """
 Command-line interface for training and evaluating HMM and CRF taggers.
 """
+# The heavy modules (torch and the models that use it) are only imported once
+# they are needed, so that --help and argument errors are instant, and only the
+# chosen kind of model is loaded.  See the startup measurements in bench.py.
+from __future__ import annotations
 import argparse
-from concurrent.futures import ProcessPoolExecutor
-from itertools import product
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import nullcontext
 import logging
 from pathlib import Path
-from typing import Callable, Tuple, Union
+import sys
+from typing import TYPE_CHECKING, Callable, Iterable, List, Optional, TextIO, Tuple, Type, Union
 
-import numpy as np
-import torch
-from eval import model_cross_entropy, viterbi_error_rate, write_tagging
-from hmm import HiddenMarkovModel, EnhancedHMM
-from crf import ConditionalRandomField
-from corpus import TaggedCorpus
+from profiling import Profiler
+
+if TYPE_CHECKING:
+    from hmm import HiddenMarkovModel
+    from crf import ConditionalRandomField
+    from corpus import Sentence, Tag, TaggedCorpus, Word
+    from integerize import Integerizer
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description=__doc__)
@@ -25,7 +31,8 @@ def parse_args() -> argparse.Namespace:
 
     filegroup = parser.add_argument_group("Model and data files")
 
-    filegroup.add_argument("input", type=str, help="input sentences for evaluation (labeled dev set or test set)")
+    filegroup.add_argument("input", type=str, help="input sentences for evaluation (labeled dev set or test set), as text or as a binary corpus from binarize.py; "
+                                                   "with --stream, a text file or - for stdin")
 
     filegroup.add_argument(
         "-m",
@@ -40,7 +47,7 @@ def parse_args() -> argparse.Namespace:
         type=str,
         nargs="*",
         default=[],
-        help="optional training data files to train the model further"
+        help="optional training data files to train the model further (text files, or a single binary corpus from binarize.py)"
     )
 
     filegroup.add_argument(
@@ -51,6 +58,15 @@ def parse_args() -> argparse.Namespace:
         help="where to save the prediction outputs"
     )
 
+    filegroup.add_argument(
+        "--stream",
+        action="store_true",
+        default=False,
+        help="just tag the input with an existing model (-m), reading it line by line and writing "
+             "each micro-batch of decode_batch_size sentences as word/tag lines as soon as it is tagged "
+             "(to stdout unless -o is given), so that memory use doesn't grow with the input"
+    )
+
     traingroup = parser.add_argument_group("Training procedure")
 
     traingroup.add_argument(
@@ -75,6 +91,28 @@ def parse_args() -> argparse.Namespace:
         help="maximum number of training steps (measured in sentences, not epochs or minibatches)"
     )
 
+    traingroup.add_argument(
+        "--eval_batch_size",
+        type=int,
+        default=64,
+        help="number of sentences scored or tagged together when evaluating on the eval corpus"
+    )
+
+    traingroup.add_argument(
+        "--eval_workers",
+        type=int,
+        default=1,
+        help="number of threads that evaluate and tag batches of the eval corpus concurrently"
+    )
+
+    traingroup.add_argument(
+        "--profile",
+        type=str,
+        default=None,
+        help="write a JSON line per training epoch to this file ('-' for stderr), giving the throughput, "
+             "the time spent in each phase of training, and the peak memory use"
+    )
+
     modelgroup = parser.add_argument_group("Tagging model structure")
 
     modelgroup.add_argument(
@@ -94,6 +132,13 @@ def parse_args() -> argparse.Namespace:
         help="decoding method to use (viterbi or posterior)"
     )
     
+    modelgroup.add_argument(
+        "--decode_batch_size",
+        type=int,
+        default=64,
+        help="number of sentences to decode at once when writing the output"
+    )
+    
     modelgroup.add_argument(
         "--crf",
         action="store_true",
@@ -135,6 +180,13 @@ def parse_args() -> argparse.Namespace:
         help="device to use for PyTorch (cpu or cuda, or mps if you are on a mac)"
     )
 
+    parser.add_argument(
+        "--fast",
+        action="store_true",
+        default=False,
+        help="skip the runtime type checks of the models (as does setting the environment variable HW_TAG_FAST=1)"
+    )
+
     hmmgroup = parser.add_argument_group("HMM-specific options (ignored for CRF)")
 
     hmmgroup.add_argument(
@@ -145,6 +197,27 @@ def parse_args() -> argparse.Namespace:
         help="lambda for add-lambda smoothing in the HMM M-step"
     )
 
+    hmmgroup.add_argument(
+        "--estep_batch_size",
+        type=int,
+        default=64,
+        help="number of sentences that the E-step runs forward-backward on at once"
+    )
+
+    hmmgroup.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes to split the E-step across"
+    )
+
+    hmmgroup.add_argument(
+        "--sparse",
+        action="store_true",
+        default=False,
+        help="store the emission counts and probabilities sparsely, to save memory with a large vocab and tagset"
+    )
+
     crfgroup = parser.add_argument_group("CRF-specific options (ignored for HMM)")
 
     crfgroup.add_argument(
@@ -224,60 +297,142 @@ def parse_args() -> argparse.Namespace:
         if not args.load_path.exists(): args.load_path = None  # only save here
 
     # Default path where we'll save the outupt
-    if args.output_file is None:
+    if args.stream:
+        if args.load_path is None:
+            parser.error("--stream needs an existing model (-m)")
+        if args.train:
+            parser.error("--stream doesn't train; train the model first")
+    elif args.output_file is None:
         args.output_file = args.input+"_output"
 
-    # What kind of model should we build?        
-    if not args.crf:
-        if args.awesome:
-            args.model_class = EnhancedHMM
-        else:
-            args.model_class = HiddenMarkovModel
-            if args.lexicon or args.rnn_dim:
-                raise NotImplementedError("Neural HMM not implemented")
-    else:
-        args.model_class = ConditionalRandomField
-        if args.lexicon or args.rnn_dim:
-            raise NotImplementedError("Neural CRF not implemented")
-    
-
+    # What kind of model should we build?  (See import_model_class().)
+    if args.lexicon or args.rnn_dim:
+        raise NotImplementedError(f"Neural {'CRF' if args.crf else 'HMM'} not implemented")
 
     return args
 
+def import_model_class(args: argparse.Namespace) -> Type[HiddenMarkovModel]:
+    """Import the kind of model that the arguments ask for, and nothing else
+    (the HMMs don't need crf.py)."""
+    if args.crf:
+        from crf import ConditionalRandomField
+        return ConditionalRandomField
+    elif args.awesome:
+        from hmm import EnhancedHMM
+        return EnhancedHMM
+    else:
+        from hmm import HiddenMarkovModel
+        return HiddenMarkovModel
+
+def read_corpus(files: List[str],
+                tagset: Optional[Integerizer[Tag]] = None,
+                vocab: Optional[Integerizer[Word]] = None,
+                integerized: bool = False) -> TaggedCorpus:
+    """Read a corpus from text files, or memory-map it from a single binary
+    corpus file made by binarize.py.  A binary corpus already has its own
+    tagset and vocab, so if tagset and vocab are given, they must match."""
+    from corpus import TaggedCorpus
+    paths = [Path(f) for f in files]
+    binary = [path for path in paths if path.exists() and TaggedCorpus.is_binary_file(path)]
+    if not binary:
+        return TaggedCorpus(*paths, tagset=tagset, vocab=vocab, integerized=integerized)
+    if len(paths) > 1:
+        raise ValueError(f"Can't combine binary corpus {binary[0]} with other files; "
+                         f"convert them together with binarize.py")
+    corpus = TaggedCorpus.load_binary(paths[0])
+    if (tagset is not None and corpus.tagset != tagset) or (vocab is not None and corpus.vocab != vocab):
+        raise ValueError(f"Binary corpus {paths[0]} uses a different tagset or vocab; "
+                         f"convert it with binarize.py --vocab_from")
+    if tagset is not None: corpus.tagset = tagset   # share the caller's integerizers
+    if vocab is not None: corpus.vocab = vocab
+    return corpus
+
 #for extra cred
 def write_tagging(model: Union[HiddenMarkovModel, ConditionalRandomField], 
                  corpus: TaggedCorpus, 
                  output_file: Path,
-                 decoder: str = "viterbi") -> None:
-    """writes model predictions to file using specified decoding method"""
+                 decoder: str = "viterbi",
+                 batch_size: int = 64,
+                 pool: Optional[Executor] = None) -> None:
+    """writes model predictions to file using specified decoding method,
+    decoding batch_size sentences at a time.  if a (thread) pool is given, the batches
+    are decoded concurrently with the same model, whose caches are computed up front
+    so that the threads only read it; they are still written in order.
+
+    if a sentence can't be tagged, we raise an error naming it rather than leaving it
+    out, since an output file that is missing lines no longer lines up with the corpus."""
+    from more_itertools import chunked
+    from eval import lazy_map
     logging.info(f"Writing predictions to {output_file} using {decoder} decoder")
+    check_decoder(model, decoder)
+    if pool is not None:
+        model._prepare_for_threads()
+
+    def tag_batch(numbered_batch: Tuple[int, List[Sentence]]) -> List[Sentence]:
+        i, batch = numbered_batch
+        try:
+            return decode_batch(model, batch, corpus, decoder)
+        except Exception:
+            # decode the sentences one at a time, to find out which one is bad
+            tagged_batch = []
+            for j, sentence in enumerate(batch):
+                try:
+                    tagged_batch.extend(decode_batch(model, [sentence], corpus, decoder))
+                except Exception as e:
+                    raise ValueError(f"Error tagging sentence {i * batch_size + j}: {str(e)}") from e
+            return tagged_batch
     
     try:
         with open(output_file, 'w') as f:
-            for i, sentence in enumerate(corpus):
-                try:
-                    #  tagged sentence based on model type and decoder
-                    if isinstance(model, EnhancedHMM):
-                        tagged = model.decode(sentence, corpus, method=decoder)
-                    else:
-                        if decoder == "viterbi":
-                            tagged = model.viterbi_tagging(sentence, corpus)
-                        elif decoder == "posterior":
-                            tagged = model.posterior_tagging(sentence, corpus)
-                        else:
-                            raise ValueError(f"Unknown decoder type: {decoder}")
-                    
-                    #  tagged sentence
+            for tagged_batch in lazy_map(tag_batch, enumerate(chunked(corpus, batch_size)), pool):
+                #  tagged sentences
+                for tagged in tagged_batch:
                     print(" ".join(f"{word}_{tag}" for word, tag in tagged), file=f)
                     
-                except Exception as e:
-                    logging.warning(f"Error tagging sentence {i}: {str(e)}")
-                    continue
-                    
     except Exception as e:
         logging.error(f"Error writing to {output_file}: {str(e)}")
         raise
 
+def check_decoder(model: Union[HiddenMarkovModel, ConditionalRandomField], decoder: str) -> None:
+    from hmm import EnhancedHMM
+    if decoder not in ("viterbi", "posterior") and not isinstance(model, EnhancedHMM):
+        raise ValueError(f"Unknown decoder type: {decoder}")
+
+def decode_batch(model: Union[HiddenMarkovModel, ConditionalRandomField],
+                 batch: List[Sentence],
+                 corpus: TaggedCorpus,
+                 decoder: str) -> List[Sentence]:
+    """tags a batch of sentences from the corpus, based on model type and decoder"""
+    from hmm import EnhancedHMM
+    if isinstance(model, EnhancedHMM):
+        return model.decode_batch(batch, corpus, method=decoder)
+    elif decoder == "viterbi":
+        return model.viterbi_tagging_batch(batch, corpus)
+    else:
+        return model.posterior_tagging_batch(batch, corpus)
+
+def stream_tagging(model: Union[HiddenMarkovModel, ConditionalRandomField],
+                   lines: Iterable[str],
+                   out: TextIO,
+                   decoder: str = "viterbi",
+                   batch_size: int = 64) -> int:
+    """tags a stream of sentences, one per line, and writes each micro-batch of batch_size
+    tagged sentences to out (as word/tag lines) as soon as it is done.  only one micro-batch
+    is in memory at a time, so this works in a shell pipeline over input of any size.
+    words are integerized against the model's vocab, with unknown words mapped to OOV;
+    tags in the input are ignored.  returns the number of sentences tagged."""
+    from more_itertools import chunked
+    from corpus import TaggedCorpus, parse_sentence
+    check_decoder(model, decoder)
+    corpus = TaggedCorpus(tagset=model.tagset, vocab=model.vocab)   # no files; it just integerizes
+    count = 0
+    for batch in chunked((parse_sentence(line).desupervise() for line in lines), batch_size):
+        for tagged in decode_batch(model, batch, corpus, decoder):
+            print(tagged, file=out)
+        out.flush()
+        count += len(batch)
+    return count
+
 '''
 
 def optimize_hyperparams(model_class, train_corpus: TaggedCorpus, 
@@ -314,6 +469,13 @@ def main() -> None:
     logging.root.setLevel(args.logging_level)
     logging.basicConfig(level=args.logging_level)
 
+    if args.fast:
+        from typechecking import set_fast
+        set_fast(True)    # before the models are imported, so that they aren't instrumented at all
+    import torch
+    model_class = import_model_class(args)
+    from eval import model_cross_entropy, viterbi_error_rate
+
     # Specify hardware device where all tensors should be computed and
     # stored.  This will give errors unless you have such a device.
     # E.g., 'gpu' will work in a Kaggle Notebook where you have
@@ -329,41 +491,56 @@ def main() -> None:
             exit(1)
     torch.set_default_device(args.device)
         
+    eval_pool: Optional[Executor] = None
     try:
+        if args.stream:
+            logging.info(f"Loading existing model from {args.load_path}")
+            model = model_class.load(args.load_path, device=args.device)
+            decoder = args.awesome_decoder if args.awesome else args.decoder
+            with (sys.stdin if args.input == "-" else open(args.input)) as lines, \
+                 (sys.stdout if args.output_file is None else open(args.output_file, 'w')) as out:
+                count = stream_tagging(model, lines, out, decoder=decoder, batch_size=args.decode_batch_size)
+            logging.info(f"Tagged {count} sentences with the {decoder} decoder")
+            return
+
         if args.load_path:
             logging.info(f"Loading existing model from {args.load_path}")
-            model = args.model_class.load(args.load_path, device=args.device)
-            train_corpus = TaggedCorpus(*[Path(t) for t in args.train], 
-                                      tagset=model.tagset, vocab=model.vocab)
+            model = model_class.load(args.load_path, device=args.device)
+            train_corpus = read_corpus(args.train, tagset=model.tagset, vocab=model.vocab)
         else:
             # load training corpus to get tagset and vocab
             if args.train:
                 logging.info(f"Creating corpus from training files: {args.train}")
-                train_corpus = TaggedCorpus(*[Path(t) for t in args.train])
+                train_corpus = read_corpus(args.train)
                 logging.info(f"Created corpus with {len(train_corpus.tagset)} tags and {len(train_corpus.vocab)} words")
             else:
                 logging.info(f"Creating corpus from input file: {args.input}")
-                train_corpus = TaggedCorpus(Path(args.input))
+                train_corpus = read_corpus([args.input])
                 logging.info(f"Created corpus with {len(train_corpus.tagset)} tags and {len(train_corpus.vocab)} words")
 
             #  model according to type
-            logging.info(f"Initializing new {args.model_class.__name__}")
-            model = args.model_class(
+            logging.info(f"Initializing new {model_class.__name__}")
+            hmm_options = {} if args.crf else {"sparse": args.sparse}
+            model = model_class(
                 train_corpus.tagset,
                 train_corpus.vocab,
-                unigram=args.unigram
+                unigram=args.unigram,
+                **hmm_options
             )
 
         # evaluation data, sharing tagset and vocab with model
         logging.info(f"Loading evaluation data from {args.input}")
-        eval_corpus = TaggedCorpus(Path(args.input), tagset=model.tagset, vocab=model.vocab)
+        # (integerized once, since we'll iterate over it at every evaluation)
+        eval_corpus = read_corpus([args.input], tagset=model.tagset, vocab=model.vocab, integerized=True)
         
         # same as given
+        eval_pool = ThreadPoolExecutor(args.eval_workers) if args.eval_workers > 1 else None
         if args.loss == 'cross_entropy':
-            loss = lambda x: model_cross_entropy(x, eval_corpus)
+            loss = lambda x: model_cross_entropy(x, eval_corpus, batch_size=args.eval_batch_size, pool=eval_pool)
             logging.info("Using cross-entropy loss for evaluation")
         else:
-            loss = lambda x: viterbi_error_rate(x, eval_corpus, show_cross_entropy=False)
+            loss = lambda x: viterbi_error_rate(x, eval_corpus, show_cross_entropy=False,
+                                                batch_size=args.eval_batch_size, pool=eval_pool)
             logging.info("Using Viterbi error rate for evaluation")
 
         # train if needed 
@@ -379,7 +556,7 @@ def main() -> None:
                 "save_path": args.save_path
             }
             
-            if isinstance(model, ConditionalRandomField):
+            if args.crf:
 
                 train_params.update({
                     "minibatch_size": args.batch_size,
@@ -392,12 +569,18 @@ def main() -> None:
             else:
                 # for only hmm
                 train_params.update({
-                    "λ": args.λ
+                    "λ": args.λ,
+                    "batch_size": args.estep_batch_size,
+                    "workers": args.workers
                 })
                 logging.info(f"Training HMM with lambda={args.λ}")
             
             # select the right train params
-            model.train(**train_params)
+            if args.profile:
+                with (nullcontext(sys.stderr) if args.profile == "-" else open(args.profile, 'w')) as profile:
+                    model.train(**train_params, profiler=Profiler(profile, label=type(model).__name__))
+            else:
+                model.train(**train_params)
             logging.info("Training completed")
 
         logging.info("Evaluating model...")
@@ -413,13 +596,16 @@ def main() -> None:
             logging.info(f"Using standard decoder: {decoder}")
         
         output_path = Path(args.output_file)
-        write_tagging(model, eval_corpus, output_path, decoder=decoder)
+        write_tagging(model, eval_corpus, output_path, decoder=decoder, batch_size=args.decode_batch_size,
+                      pool=eval_pool)
         logging.info(f"Wrote {decoder} tagging to {output_path}")
 
     except Exception as e:
         logging.error(f"An error occurred: {str(e)}")
         logging.debug("Details:", exc_info=True)
         raise
+    finally:
+        if eval_pool: eval_pool.shutdown()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+
+# Tests for corpus.py.
+# Run them with `python -m pytest`.
+
+from pathlib import Path
+
+import pytest
+
+from corpus import TaggedCorpus
+
+
+@pytest.mark.parametrize("bucket_batches", [1, 2, 50])
+def test_minibatches_cover_each_epoch(tmp_path: Path, bucket_batches: int):
+    path = tmp_path / "corpus"
+    path.write_text("".join(" ".join(["w"] * (i % 7)) + "\n" for i in range(30)))
+    corpus = TaggedCorpus(path, integerized=True)
+    minibatches = iter(corpus.draw_minibatches_forever(4, bucket_batches=bucket_batches))
+    for epoch in range(3):
+        epoch_batches = [next(minibatches) for _ in range(8)]      # 30 sentences = 7 × 4 + 2
+        assert [len(batch) for batch in epoch_batches[:-1]] == [4] * 7
+        assert len(epoch_batches[-1]) == 2                        # the short one is last
+        assert sorted(i for batch in epoch_batches for i in batch.tolist()) == list(range(30))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+# Tests for the training code in crf.py, on a small corpus.
+# Run them with `python -m pytest`.
+
+import random
+from pathlib import Path
+
+import pytest
+import torch
+
+from corpus import TaggedCorpus
+from crf import ConditionalRandomField
+
+CORPUS = ("papa/N ate/V the/D caviar/N\n"
+          "papa ate/V\n"
+          "spoon/N\n"
+          "the/D spoon/N ate/V the/D caviar/N\n"
+          "caviar ate the spoon\n"
+          "the/D papa/N ate/V\n")
+
+
+@pytest.fixture
+def corpus(tmp_path: Path) -> TaggedCorpus:
+    path = tmp_path / "corpus"
+    path.write_text(CORPUS)
+    return TaggedCorpus(path)
+
+
+def trained_crf(corpus: TaggedCorpus, unigram: bool, sparse_updates: bool) -> ConditionalRandomField:
+    """A CRF trained for a few minibatches, from the same random start each time."""
+    torch.manual_seed(0)
+    random.seed(0)    # for the order of the minibatches
+    crf = ConditionalRandomField(corpus.tagset, corpus.vocab, unigram=unigram)
+    crf.train(corpus, loss=lambda crf: 1.0, minibatch_size=2, eval_interval=100, lr=0.1, reg=1.0,
+              max_steps=3 * len(corpus), save_path=None, sparse_updates=sparse_updates)
+    return crf
+
+
+@pytest.mark.parametrize("unigram", [False, True])
+def test_sparse_updates_match_dense(corpus: TaggedCorpus, unigram: bool):
+    sparse = trained_crf(corpus, unigram, sparse_updates=True)
+    dense = trained_crf(corpus, unigram, sparse_updates=False)
+    assert torch.allclose(sparse.WA, dense.WA, atol=1e-5)
+    assert torch.allclose(sparse.WB, dense.WB, atol=1e-5)
+    assert torch.allclose(sparse.B, dense.B, atol=1e-5)
+
+
+def test_sparse_decay_keeps_structural_zeros(corpus: TaggedCorpus):
+    crf = ConditionalRandomField(corpus.tagset, corpus.vocab)
+    crf._start_sparse_updates()
+    crf._log_decay = -1e4          # so much decay that the factor underflows to 0
+    crf._refresh_columns(torch.tensor([0, 1]))
+    crf._flush_sparse_updates()
+    assert not crf.WB.isnan().any()
+    assert (crf.WB[[crf.eos_t, crf.bos_t]] == float('-inf')).all()
+    assert (crf.WB[:crf.eos_t] == 0).all()
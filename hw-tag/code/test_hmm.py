@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+# Tests for the batched trellis code in hmm.py, on a small random HMM.
+# Run them with `python -m pytest`.
+
+import itertools
+import math
+from typing import List, Optional
+
+import pytest
+import torch
+
+from corpus import BOS_TAG, BOS_WORD, EOS_TAG, EOS_WORD, IntegerizedSentence, Tag, TaggedCorpus, Word
+from hmm import HiddenMarkovModel
+from integerize import Integerizer
+
+TAGS = ["N", "V", "D"]
+WORDS = ["papa", "ate", "the", "caviar", "spoon"]
+
+
+def make_hmm(unigram: bool = False, sparse: bool = False) -> HiddenMarkovModel:
+    """A small HMM with random parameters (the same ones every time)."""
+    torch.manual_seed(0)
+    tagset: Integerizer[Tag] = Integerizer([Tag(t) for t in TAGS] + [EOS_TAG, BOS_TAG])
+    vocab: Integerizer[Word] = Integerizer([Word(w) for w in WORDS] + [EOS_WORD, BOS_WORD])
+    return HiddenMarkovModel(tagset, vocab, unigram=unigram, sparse=sparse)
+
+
+def make_sentence(hmm: HiddenMarkovModel, words: List[int], tags: List[Optional[int]]) -> IntegerizedSentence:
+    """An integerized sentence with the given word and tag ids, padded with BOS and EOS."""
+    return ([(hmm.V + 1, hmm.bos_t)]                     # BOS_WORD is the last word of the vocab
+            + list(zip(words, tags))
+            + [(hmm.V, hmm.eos_t)])
+
+
+def mixed_batch(hmm: HiddenMarkovModel) -> List[IntegerizedSentence]:
+    """Sentences of different lengths: raw, fully tagged, and partly tagged."""
+    return [make_sentence(hmm, [0, 1, 2], [None, None, None]),
+            make_sentence(hmm, [3], [0]),
+            make_sentence(hmm, [0, 1, 2, 3, 4], [0, None, 2, None, None]),
+            make_sentence(hmm, [4, 4], [None, None]),
+            make_sentence(hmm, [2, 3, 1, 0], [2, 0, 1, 0]),
+            make_sentence(hmm, [1, 0, 3, 2], [None, None, None, 1])]
+
+
+@pytest.mark.parametrize("unigram", [False, True])
+@pytest.mark.parametrize("sparse", [False, True])
+def test_E_step_batch_matches_per_sentence(unigram: bool, sparse: bool):
+    hmm = make_hmm(unigram=unigram, sparse=sparse)
+    batch = mixed_batch(hmm)
+
+    hmm._zero_counts()
+    hmm.E_step_batch(batch)
+    batch_A, batch_B = hmm.A_counts, hmm.B_counts
+
+    hmm._zero_counts()
+    for isent in batch:
+        hmm.E_step(isent)
+    one_A, one_B = hmm.A_counts, hmm.B_counts
+
+    if sparse:
+        batch_B, one_B = batch_B.to_dense(), one_B.to_dense()
+    assert torch.allclose(batch_A, one_A, atol=1e-5)
+    assert torch.allclose(batch_B, one_B, atol=1e-5)
+    # every word token gets exactly one emission count, and every edge one transition count
+    assert batch_B.sum().item() == pytest.approx(sum(len(isent) - 2 for isent in batch), abs=1e-4)
+    assert batch_A.sum().item() == pytest.approx(sum(len(isent) - 1 for isent in batch), abs=1e-4)
+
+
+def brute_force_logprob(hmm: HiddenMarkovModel, isent: IntegerizedSentence) -> float:
+    """log p(words, known tags), by summing over every tagging that is consistent with
+    the known tags."""
+    interior = isent[1:-1]
+    choices = [range(hmm.eos_t) if t is None else [t] for _, t in interior]   # tags other than EOS, BOS
+    total = 0.0
+    for tags in itertools.product(*choices):
+        path = [hmm.bos_t, *tags, hmm.eos_t]
+        p = 1.0
+        for s, t in zip(path, path[1:]):
+            p *= hmm.A[s, t].item()
+        for (w, _), t in zip(interior, tags):
+            p *= hmm.B[t, w].item()
+        total += p
+    return math.log(total)
+
+
+@pytest.mark.parametrize("unigram", [False, True])
+def test_clamped_forward_matches_brute_force(unigram: bool):
+    hmm = make_hmm(unigram=unigram)
+    batch = mixed_batch(hmm)
+    log_Z = hmm.forward_batch(batch)
+    for isent, lp in zip(batch, log_Z.tolist()):
+        assert lp == pytest.approx(brute_force_logprob(hmm, isent), abs=1e-4)
+
+
+@pytest.mark.parametrize("unigram", [False, True])
+def test_path_logprob_matches_clamped_forward(unigram: bool):
+    hmm = make_hmm(unigram=unigram)
+    batch = [isent for isent in mixed_batch(hmm) if all(t is not None for _, t in isent)]
+    assert batch
+    word_ids, tag_ids, lengths = hmm._pad_batch(batch)
+    path = hmm._path_logprob(word_ids, tag_ids, lengths)
+    _, clamped = hmm._forward_trellis(hmm._clamped_emissions(word_ids, tag_ids), lengths)
+    assert torch.allclose(path, clamped, atol=1e-5)
+
+
+@pytest.mark.parametrize("unigram", [False, True])
+def test_forward_and_backward_agree(unigram: bool):
+    hmm = make_hmm(unigram=unigram)
+    batch = mixed_batch(hmm) + [make_sentence(hmm, [], [])]
+    result = hmm.forward_backward(batch)
+    assert torch.allclose(result.beta[:, 0, hmm.bos_t], result.log_Z, atol=1e-5)
+    for isent in batch:
+        assert hmm.backward_pass(isent).item() == pytest.approx(hmm.forward_pass(isent).item(), abs=1e-5)
+
+
+@pytest.mark.parametrize("unigram", [False, True])
+@pytest.mark.parametrize("sparse", [False, True])
+def test_supervised_counts_match_E_step(tmp_path, unigram: bool, sparse: bool):
+    hmm = make_hmm(unigram=unigram, sparse=sparse)
+    path = tmp_path / "corpus"
+    path.write_text("papa/N ate/V the/D caviar/N\n"
+                    "papa ate/V\n"
+                    "spoon/N\n"
+                    "\n"
+                    "the/D spoon/N ate/V the/D caviar/N\n"
+                    "caviar\n")
+    corpus = TaggedCorpus(path, tagset=hmm.tagset, vocab=hmm.vocab, integerized=True)
+
+    hmm._zero_counts()
+    for i in range(len(corpus)):
+        if corpus.integerized_sentence(i).is_supervised():
+            hmm.E_step(corpus.integerized_sentence(i))
+    for chunk in (1, 3, 7, 1 << 20):    # chunk boundaries inside and between sentences
+        A_counts, B_counts, unsupervised = hmm._supervised_counts(corpus, chunk=chunk)
+        if sparse:
+            B_counts = B_counts.to_dense()
+        assert unsupervised.tolist() == [1, 5]
+        assert torch.allclose(A_counts, hmm.A_counts)
+        assert torch.allclose(B_counts, hmm.B_counts.to_dense() if sparse else hmm.B_counts)
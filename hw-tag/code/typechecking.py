@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Runtime type checking of the models, which can be switched off for speed.
+
+hmm.py and crf.py decorate methods (and the EnhancedHMM class) with the
+`typechecked` below rather than with typeguard's own.  It applies typeguard's
+decorator, which checks the types of the arguments and return value on every
+call (including the jaxtyping dtypes and shapes), but it also remembers the
+undecorated method.  set_fast(True) installs the undecorated methods in their
+classes, and set_fast(False) puts the checked ones back.
+
+Checking is on by default, so that debugging runs catch type errors.  For
+production runs, set the environment variable HW_TAG_FAST=1, or call
+set_fast(True) (as tag.py --fast does).  If that happens before hmm.py is
+imported, typeguard isn't even imported, and the methods are only instrumented
+if the checks are later switched back on, which makes startup faster.
+"""
+import inspect
+import os
+from typing import Any, Callable, List, Optional, TypeVar
+
+FAST_ENV = "HW_TAG_FAST"
+
+T = TypeVar("T")
+
+_fast: bool = os.environ.get(FAST_ENV, "") not in ("", "0")
+
+class _Method:
+    """A method that has a checked and an unchecked version.  The checked one is
+    made on demand, since typeguard is slow to instrument a whole module."""
+
+    def __init__(self, owner: type, name: str, unchecked: Callable):
+        self.owner = owner
+        self.name = name
+        self.unchecked = unchecked
+        self._checked: Optional[Callable] = None
+
+    def checked(self) -> Callable:
+        if self._checked is None:
+            import typeguard
+            self._checked = typeguard.typechecked(self.unchecked)
+            self._checked.__dict__.update(self.unchecked.__dict__)   # e.g., __override__ from @override
+        return self._checked
+
+    def install(self) -> None:
+        setattr(self.owner, self.name, self.unchecked if _fast else self.checked())
+
+_methods: List[_Method] = []
+
+def is_fast() -> bool:
+    """Are the unchecked methods installed?"""
+    return _fast
+
+def set_fast(fast: bool) -> None:
+    """Install the unchecked methods (fast=True) or the checked ones (fast=False)
+    in every class that has methods decorated with typechecked."""
+    global _fast
+    _fast = fast
+    for method in _methods:
+        method.install()
+
+def _register(owner: type, name: str, unchecked: Callable) -> None:
+    method = _Method(owner, name, unchecked)
+    _methods.append(method)
+    method.install()
+
+class _CheckedMethod:
+    """Stands in for a decorated method until its class has been created, at
+    which point it registers the method and replaces itself with it."""
+
+    def __init__(self, unchecked: Callable):
+        self.unchecked = unchecked
+
+    def __set_name__(self, owner: type, name: str) -> None:
+        for attr, value in vars(self).items():      # e.g., __override__ from @override
+            if attr != "unchecked":
+                setattr(self.unchecked, attr, value)
+        _register(owner, name, self.unchecked)
+
+def typechecked(target: T) -> T:
+    """Like typeguard.typechecked, for a method or a whole class (whose plain
+    methods are then all checked), but the checks can be switched off with set_fast()."""
+    if isinstance(target, type):
+        for name, value in list(vars(target).items()):
+            if inspect.isfunction(value):
+                _register(target, name, value)
+        return target
+    return _CheckedMethod(target)  # type: ignore[return-value]